@@ -1,3 +1,4 @@
+from collections.abc import MutableMapping
 from enum import Enum
 from PySide6 import QtCore
 from dataclasses import dataclass
@@ -9,12 +10,109 @@ class AnnotationSource(Enum):
     AUTOMATIC = 3
 
 
+def _field(name: str):
+    """
+    Annotation attribute stored in the annotation until it is added to a model, then in the annotation store
+    """
+    def getter(self):
+        if self.store is None:
+            return self._fields[name]
+        return self.store.get_field(self.row, name)
+
+    def setter(self, value):
+        if self.store is None:
+            self._fields[name] = value
+        else:
+            self.store.set_field(self.row, name, value)
+
+    return property(getter, setter)
+
+
+class AnnotationMetadata(MutableMapping):
+    """
+    Dictionary view of the metadata of an annotation (the fields stored in columns and any other field)
+    Fields set to None are not part of the metadata.
+    """
+
+    def __init__(self, annotation):
+        self.annotation = annotation
+
+    def _extra(self, create: bool = False) -> dict:
+        if self.annotation.store is None:
+            return self.annotation._extra
+        return self.annotation.store.get_extra(self.annotation.row, create)
+
+    def __getitem__(self, key):
+        if key in Annotation.METADATA_FIELDS:
+            value = getattr(self.annotation, key)
+            if value is None:
+                raise KeyError(key)
+            return value
+        return self._extra()[key]
+
+    def __setitem__(self, key, value):
+        if key in Annotation.METADATA_FIELDS:
+            setattr(self.annotation, key, value)
+        else:
+            self._extra(create=True)[key] = value
+
+    def __delitem__(self, key):
+        if key in Annotation.METADATA_FIELDS:
+            if getattr(self.annotation, key) is None:
+                raise KeyError(key)
+            setattr(self.annotation, key, None)
+        else:
+            del self._extra(create=True)[key]
+
+    def __iter__(self):
+        for key in Annotation.METADATA_FIELDS:
+            if getattr(self.annotation, key) is not None:
+                yield key
+        yield from list(self._extra())
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
 class Annotation(QtCore.QObject):
+    """
+    Time-frequency annotation.
+
+    An annotation owns its fields until it is added to a model, then it becomes a proxy of a row of the model
+    annotation store (see AnnotationStore) and its fields are read and written in the store columns. Annotations of a
+    model are only created when needed (e.g. by the views), the store keeps a single proxy per row while it is
+    referenced. An annotation removed from the model gets its fields back.
+    """
 
     annotation_changed = QtCore.Signal(object)
     annotation_selected = QtCore.Signal(object)
     annotation_hovered = QtCore.Signal(object)
 
+    # Fields stored in the annotation store columns, any other metadata field is stored as it is
+    FIELDS = ("id", "source", "label", "group", "start", "length", "low", "high", "author", "comment", "symbol_rate",
+              "confidence", "selected")
+    # Fields that are part of the annotation metadata
+    METADATA_FIELDS = ("start", "length", "low", "high", "author", "comment", "symbol_rate", "confidence")
+
+    id = _field("id")
+    source = _field("source")
+    # Annotation group ID
+    group = _field("group")
+    label = _field("label")
+    # Starting time in seconds
+    start = _field("start")
+    # Duration time in seconds
+    length = _field("length")
+    # Higher frequency
+    high = _field("high")
+    # Lowest frequency
+    low = _field("low")
+    author = _field("author")
+    comment = _field("comment")
+    symbol_rate = _field("symbol_rate")
+    confidence = _field("confidence")
+    selected = _field("selected")
+
     def __init__(self,
                  annotation_id: int = None,
                  source: AnnotationSource = None,
@@ -23,59 +121,65 @@ class Annotation(QtCore.QObject):
                  **kwargs):
 
         super(Annotation, self).__init__()
+        # Annotation store and row, None until the annotation is added to a model
+        self.store = None
+        self.row = None
+
+        self._fields = dict.fromkeys(self.FIELDS)
+        self._extra = {}
+
         # Annotation ID
         self.id = annotation_id
-        # Annotation group ID
         self.group = group or None
         self.label = label or None
         # Annotation source
         self.source = source
-        # Starting time in seconds
-        self.start = kwargs.get('start', 0)
-        # Duration time in seconds
-        self.length = kwargs.get('length', 1)
-        # Higher frequency
-        self.high = kwargs.get('high', None)
-        # Lowest frequency
-        self.low = kwargs.get('low', None)
-        # Metadata dictionary
-        self.metadata = kwargs
-        # List of labels
-        self.labels = []
-
+        self.start = kwargs.pop('start', 0)
+        self.length = kwargs.pop('length', 1)
+        self.high = kwargs.pop('high', None)
+        self.low = kwargs.pop('low', None)
         self.selected = False
 
-    @property
-    def author(self):
-        return self.metadata.get('author', None)
+        # Any other metadata field
+        for key, value in kwargs.items():
+            self.metadata[key] = value
 
-    @property
-    def comment(self):
-        return self.metadata.get('comment', None)
+        # List of labels
+        self.labels = []
 
-    @property
-    def symbol_rate(self):
-        return self.metadata.get('symbol_rate', None)
+    @classmethod
+    def from_store(cls, store, row: int):
+        """
+        Creates the proxy of a row of an annotation store
+        """
+        annotation = cls()
+        annotation.attach(store, row)
+        return annotation
+
+    def attach(self, store, row: int):
+        """
+        Turns the annotation into the proxy of a row of an annotation store
+        """
+        self.store = store
+        self.row = row
+        self._fields = None
+        self._extra = None
+
+    def detach(self):
+        """
+        Copies the fields out of the annotation store, the annotation is no longer a proxy
+        """
+        fields = {name: getattr(self, name) for name in self.FIELDS}
+        extra = dict(self.store.get_extra(self.row))
+
+        self.store = None
+        self.row = None
+        self._fields = fields
+        self._extra = extra
 
     @property
-    def confidence(self):
-        return self.metadata.get('confidence', None)
-
-    @author.setter
-    def author(self, author):
-        self.metadata['author'] = author
-
-    @comment.setter
-    def comment(self, comment):
-        self.metadata['comment'] = comment
-
-    @symbol_rate.setter
-    def symbol_rate(self, symbol_rate):
-        self.metada['symbol_rate'] = symbol_rate
-
-    @confidence.setter
-    def confidence(self, confidence):
-        self.metadata['confidence'] = confidence
+    def metadata(self):
+        return AnnotationMetadata(self)
 
     def add_field(self, key, value):
         self.metadata[key] = value
@@ -115,4 +219,4 @@ class Annotation(QtCore.QObject):
             "label": self.label,
             "confidence": self.confidence,
             "group": self.group
-        }
\ No newline at end of file
+        }
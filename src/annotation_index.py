@@ -0,0 +1,243 @@
+import numpy as np
+
+
+class AnnotationIndex:
+    """
+    Time-frequency index of annotation rectangles (start, end, low, high).
+
+    Annotations are identified by integer keys (rows of the annotation store). Bounds are stored in a numpy array, the
+    first `sorted_count` rows are sorted by start time, so an interval query only visits the rows whose start lies in
+    [start - max_length, end] (binary search). Rows inserted or updated since the last rebuild are kept unsorted after
+    them and scanned in a single vectorized pass. The sorted part is rebuilt lazily by the first query after enough
+    changes, inserting is O(1) (amortized) and bulk loads are vectorized.
+
+    Missing frequencies (NaN) span the whole band.
+    """
+
+    # Rows allocated for an empty index
+    INITIAL_CAPACITY = 1024
+    # Unsorted rows that trigger a rebuild of the sorted part (at least this many and a quarter of the sorted rows)
+    REBUILD_ROWS = 1024
+
+    # Bounds columns
+    START = 0
+    END = 1
+    LOW = 2
+    HIGH = 3
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.bounds = np.empty((self.INITIAL_CAPACITY, 4), dtype=np.float64)
+        # Key of each row
+        self.keys = np.empty(self.INITIAL_CAPACITY, dtype=np.int64)
+        # Removed (or updated) rows are invalidated and dropped by the next rebuild
+        self.valid = np.zeros(self.INITIAL_CAPACITY, dtype=bool)
+        # Row of each key (-1 if not indexed)
+        self.position = np.full(self.INITIAL_CAPACITY, -1, dtype=np.int64)
+
+        # Used rows and indexed keys
+        self.row_count = 0
+        self.key_count = 0
+
+        self.sorted_count = 0
+        # Longest annotation of the sorted rows
+        self.max_length = 0.0
+
+    def __contains__(self, key: int):
+        return 0 <= key < len(self.position) and self.position[key] >= 0
+
+    @classmethod
+    def make_bounds(cls, start, length, low, high) -> np.ndarray:
+        """
+        Returns the (start, end, low, high) bounds of rectangles (scalars or arrays)
+        """
+        bounds = np.empty((np.size(start), 4), dtype=np.float64)
+        bounds[:, cls.START] = start
+        bounds[:, cls.END] = bounds[:, cls.START] + length
+        # Missing frequencies span the whole band
+        bounds[:, cls.LOW] = np.where(np.isnan(low), -np.inf, low)
+        bounds[:, cls.HIGH] = np.where(np.isnan(high), np.inf, high)
+        return bounds
+
+    def _reserve(self, count: int, max_key: int):
+        if self.row_count + count > len(self.valid):
+            capacity = max(2 * len(self.valid), self.row_count + count)
+            self.bounds = np.resize(self.bounds, (capacity, 4))
+            self.keys = np.resize(self.keys, capacity)
+            self.valid = np.concatenate((self.valid, np.zeros(capacity - len(self.valid), dtype=bool)))
+
+        if max_key >= len(self.position):
+            capacity = max(2 * len(self.position), max_key + 1)
+            self.position = np.concatenate((self.position, np.full(capacity - len(self.position), -1, dtype=np.int64)))
+
+    def insert(self, keys, bounds: np.ndarray):
+        """
+        Adds rectangles (vectorized)
+        :param keys: Key or array of keys (not indexed yet)
+        :param bounds: Bounds array (see make_bounds)
+        """
+        keys = np.atleast_1d(np.asarray(keys, dtype=np.int64))
+        if not len(keys):
+            return
+
+        self._reserve(len(keys), int(keys.max()))
+        first = self.row_count
+        last = first + len(keys)
+
+        self.bounds[first:last] = bounds
+        self.keys[first:last] = keys
+        self.valid[first:last] = True
+        self.position[keys] = np.arange(first, last)
+
+        self.row_count = last
+        self.key_count += len(keys)
+
+    def remove(self, keys):
+        """
+        Removes rectangles (vectorized)
+        :param keys: Key or array of keys, keys not indexed are ignored
+        """
+        keys = np.atleast_1d(np.asarray(keys, dtype=np.int64))
+        keys = np.unique(keys[(keys >= 0) & (keys < len(self.position))])
+        keys = keys[self.position[keys] >= 0]
+
+        self.valid[self.position[keys]] = False
+        self.position[keys] = -1
+        self.key_count -= len(keys)
+
+    def update(self, keys, bounds: np.ndarray):
+        """
+        Updates the bounds of rectangles (e.g. after an ROI edit), vectorized
+        :param keys: Key or array of keys, keys not indexed are ignored
+        :param bounds: Bounds array (see make_bounds)
+        """
+        keys = np.atleast_1d(np.asarray(keys, dtype=np.int64))
+        bounds = bounds.reshape(-1, 4)
+
+        indexed = (keys >= 0) & (keys < len(self.position))
+        indexed[indexed] = self.position[keys[indexed]] >= 0
+        keys, bounds = keys[indexed], bounds[indexed]
+
+        moved = ~np.all(self.bounds[self.position[keys]] == bounds, axis=1)
+        if not np.any(moved):
+            return
+
+        # Moved to the unsorted rows
+        self.remove(keys[moved])
+        self.insert(keys[moved], bounds[moved])
+
+    def _rebuild(self):
+        """
+        Sorts the valid rows by start and drops the invalid ones
+        """
+        live = np.flatnonzero(self.valid[:self.row_count])
+        order = live[np.argsort(self.bounds[live, self.START], kind='stable')]
+        count = len(order)
+
+        self.bounds[:count] = self.bounds[order]
+        self.keys[:count] = self.keys[order]
+        self.valid[:] = False
+        self.valid[:count] = True
+        self.position[self.keys[:count]] = np.arange(count)
+
+        self.row_count = self.sorted_count = count
+        lengths = self.bounds[:count, self.END] - self.bounds[:count, self.START]
+        self.max_length = float(lengths.max()) if count else 0.0
+
+    def _candidates(self, start: float, end: float) -> np.ndarray:
+        """
+        Returns the valid rows that may intersect [start, end] in time
+        """
+        unsorted_count = self.row_count - self.sorted_count
+        if unsorted_count > max(self.REBUILD_ROWS, self.sorted_count // 4) or \
+                self.row_count - self.key_count > self.row_count // 2:
+            self._rebuild()
+
+        starts = self.bounds[:self.sorted_count, self.START]
+        first = np.searchsorted(starts, start - self.max_length, side='left')
+        last = np.searchsorted(starts, end, side='right')
+
+        rows = np.concatenate((np.arange(first, last), np.arange(self.sorted_count, self.row_count)))
+        return rows[self.valid[rows]]
+
+    def query(self, start: float, end: float, low: float = None, high: float = None,
+              strict: bool = False) -> np.ndarray:
+        """
+        Returns the rectangles intersecting a time-frequency window
+        :param start: Window start time
+        :param end: Window end time
+        :param low: Window lowest frequency (None for no limit)
+        :param high: Window highest frequency (None for no limit)
+        :param strict: Only rectangles sharing some area with the window (touching edges do not intersect)
+        :return: Array of keys
+        """
+        low = -np.inf if low is None else low
+        high = np.inf if high is None else high
+
+        rows = self._candidates(start, end)
+        bounds = self.bounds[rows]
+
+        if strict:
+            mask = (bounds[:, self.START] < end) & (bounds[:, self.END] > start) & \
+                   (bounds[:, self.LOW] < high) & (bounds[:, self.HIGH] > low)
+        else:
+            mask = (bounds[:, self.START] <= end) & (bounds[:, self.END] >= start) & \
+                   (bounds[:, self.LOW] <= high) & (bounds[:, self.HIGH] >= low)
+
+        return self.keys[rows[mask]]
+
+    def duplicates(self, bounds: np.ndarray, exclude: int = None) -> np.ndarray:
+        """
+        Returns the rectangles with the given bounds
+        :param bounds: Bounds (see make_bounds)
+        :param exclude: Key left out of the result
+        :return: Array of keys
+        """
+        start, end, low, high = bounds.reshape(4)
+        rows = self._candidates(start, end)
+        keys = self.keys[rows[np.all(self.bounds[rows] == bounds.reshape(1, 4), axis=1)]]
+        return keys[keys != exclude] if exclude is not None else keys
+
+    def overlaps(self, bounds: np.ndarray, exclude: int = None) -> np.ndarray:
+        """
+        Returns the rectangles sharing some area with the given bounds
+        :param bounds: Bounds (see make_bounds)
+        :param exclude: Key left out of the result
+        :return: Array of keys
+        """
+        start, end, low, high = bounds.reshape(4)
+        keys = self.query(start, end, low, high, strict=True)
+        return keys[keys != exclude] if exclude is not None else keys
+
+    def nearest(self, bounds: np.ndarray, count: int = 1, frequency_scale: float = 1.0,
+                exclude: int = None) -> np.ndarray:
+        """
+        Returns the rectangles closest to the given bounds (gap between rectangles, 0 if they overlap)
+        :param bounds: Bounds (see make_bounds)
+        :param count: Number of rectangles
+        :param frequency_scale: Seconds per Hz used to compare time and frequency gaps
+        :param exclude: Key left out of the result
+        :return: Array of keys sorted by distance
+        """
+        start, end, low, high = bounds.reshape(4)
+
+        rows = np.flatnonzero(self.valid[:self.row_count])
+        if exclude is not None:
+            rows = rows[self.keys[rows] != exclude]
+
+        count = min(count, len(rows))
+        if count <= 0:
+            return np.empty(0, dtype=np.int64)
+
+        row_bounds = self.bounds[rows]
+        time_gap = np.maximum(np.maximum(row_bounds[:, self.START] - end, start - row_bounds[:, self.END]), 0)
+        frequency_gap = np.maximum(np.maximum(row_bounds[:, self.LOW] - high, low - row_bounds[:, self.HIGH]), 0)
+        # Unbounded frequencies (inf - inf) do not add distance
+        frequency_gap = np.nan_to_num(frequency_gap, nan=0.0)
+        distance = np.hypot(time_gap, frequency_gap * frequency_scale)
+
+        closest = np.argpartition(distance, count - 1)[:count]
+        closest = closest[np.argsort(distance[closest], kind='stable')]
+        return self.keys[rows[closest]]
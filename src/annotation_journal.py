@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+
+class AnnotationJournal:
+    """
+    Append-only journal of annotation changes.
+
+    Each line is a JSON record {"op": ADD | MODIFY | DELETE, "id": annotation id, ...}. Records are appended and synced
+    on every save, so saving costs the changed annotations only and a crash never loses a saved change. A truncated
+    last line (crash while appending) is cut off before the next append, and corrupt lines are skipped when reading. Replaying the records is idempotent: ADD and MODIFY
+    replace the annotation with the same id and DELETE of an unknown id is ignored.
+    """
+
+    # Bytes read at once while looking for the end of the last complete line
+    TAIL_BLOCK = 4096
+
+    ADD = "add"
+    MODIFY = "modify"
+    DELETE = "delete"
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.record_count = len(self.read())
+
+    def read(self):
+        """
+        Reads the journal records
+        :return: List of records in order
+        """
+        records = []
+
+        try:
+            with open(self.path, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logging.warning(f"Ignoring corrupt record in annotation journal {self.path}")
+        except FileNotFoundError:
+            pass
+
+        return records
+
+    def append(self, records: list):
+        """
+        Appends records and syncs them to disk
+        """
+        if not records:
+            return
+
+        self._truncate_partial_line()
+
+        with open(self.path, 'a') as journal_file:
+            journal_file.write("".join(json.dumps(record) + "\n" for record in records))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+        self.record_count += len(records)
+
+    def _truncate_partial_line(self):
+        """
+        Cuts the journal back to its last complete line, so a record partially written by a crash is not glued to the
+        next appended record
+        """
+        try:
+            journal_file = open(self.path, 'rb+')
+        except FileNotFoundError:
+            return
+
+        with journal_file:
+            end = journal_file.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(position - self.TAIL_BLOCK, 0)
+                journal_file.seek(start)
+                block = journal_file.read(position - start)
+                newline = block.rfind(b"\n")
+                if newline >= 0:
+                    position = start + newline + 1
+                    break
+                position = start
+
+            if position < end:
+                logging.warning(f"Truncating incomplete record in annotation journal {self.path}")
+                journal_file.truncate(position)
+
+    def rewrite(self, records: list):
+        """
+        Replaces the journal records atomically (temporary file renamed over the journal)
+        """
+        if not records:
+            self.clear()
+            return
+
+        fd, temp_file = tempfile.mkstemp(prefix=self.path.name + ".", suffix=".tmp", dir=self.path.parent)
+        try:
+            with os.fdopen(fd, 'w') as journal_file:
+                journal_file.write("".join(json.dumps(record) + "\n" for record in records))
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            os.replace(temp_file, self.path)
+        except BaseException:
+            os.unlink(temp_file)
+            raise
+
+        self.record_count = len(records)
+
+    def clear(self):
+        self.path.unlink(missing_ok=True)
+        self.record_count = 0
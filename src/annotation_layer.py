@@ -0,0 +1,168 @@
+import numpy as np
+
+from PySide6 import QtCore, QtGui
+
+import pyqtgraph as pg
+
+from annotation_store import AnnotationStore
+from labels_model import LabelsModel
+
+
+class AnnotationLayer(pg.GraphicsObject):
+    """
+    Draws the annotations of a store that are not being edited as rectangles, a single path per label colour.
+
+    Only the annotations intersecting a window around the view range are drawn (queried with the store index). The
+    paths are rebuilt when the view range leaves the window, when the window gets much larger than the view range
+    (zoom in) and when the annotations change, so panning and zooming only repaint the cached paths. Annotations
+    edited with an AnnotationROI are hidden (see set_hidden_rows), selected annotations without ROI are drawn with a
+    wider pen.
+    """
+
+    # Row of the annotation under the mouse cursor
+    annotation_hovered = QtCore.Signal(int)
+
+    # Margin of the drawn window around the view range (fraction of the view range on each side)
+    WINDOW_MARGIN = 1.0
+    # View range area below which (fraction of the window area) the paths are rebuilt
+    MIN_VIEW_FRACTION = 1 / 16
+    # Pen width added to the selected annotations (as AnnotationROI.select_roi)
+    SELECTED_WIDTH = 2
+
+    def __init__(self, store: AnnotationStore, labels: LabelsModel, bounds: QtCore.QRectF):
+        """
+        :param store: Annotation store
+        :param labels: Labels model (label colours)
+        :param bounds: Plot area (time on x, frequency on y)
+        """
+        super(AnnotationLayer, self).__init__()
+
+        self.store = store
+        self.labels = labels
+        self.bounds = QtCore.QRectF(bounds)
+
+        # Rows drawn by another item
+        self.hidden_rows = np.empty(0, dtype=np.int64)
+        # (pen, path) of each colour, drawn window (None when outdated)
+        self.paths = []
+        self.window = None
+        self.last_hovered = None
+
+        self.setAcceptHoverEvents(True)
+
+        self.store.annotations_added.connect(self.invalidate)
+        self.store.annotations_removed.connect(self.invalidate)
+        self.store.annotations_changed.connect(self.invalidate)
+        self.store.annotations_selected.connect(self.invalidate)
+        self.labels.dataChanged.connect(self.invalidate)
+
+    @QtCore.Slot()
+    def invalidate(self, *args):
+        self.window = None
+        self.update()
+
+    def set_hidden_rows(self, rows):
+        self.hidden_rows = np.fromiter(rows, dtype=np.int64)
+        self.invalidate()
+
+    def set_bounds(self, bounds: QtCore.QRectF):
+        """
+        Changes the plot area (capture that grew in tail mode)
+        """
+        self.prepareGeometryChange()
+        self.bounds = QtCore.QRectF(bounds)
+        self.invalidate()
+
+    def boundingRect(self) -> QtCore.QRectF:
+        return self.bounds
+
+    def get_visible_rows(self, start: float, end: float, low: float, high: float,
+                         hidden: bool = False) -> np.ndarray:
+        """
+        Returns the drawn rows intersecting a time-frequency window
+        :param hidden: Include the hidden rows
+        """
+        rows = self.store.index.query(start, end, low, high)
+        if not hidden:
+            rows = rows[~np.isin(rows, self.hidden_rows)]
+        # Annotations without frequency bounds cannot be drawn
+        columns = self.store.columns
+        return rows[~(np.isnan(columns["low"][rows]) | np.isnan(columns["high"][rows]))]
+
+    def _get_window(self) -> QtCore.QRectF:
+        view_box = self.getViewBox()
+        return view_box.viewRect() if view_box is not None else self.bounds
+
+    def build(self, view: QtCore.QRectF):
+        """
+        Builds the paths of the annotations in a window around a view range (vectorized)
+        """
+        window = view.adjusted(-view.width() * self.WINDOW_MARGIN, -view.height() * self.WINDOW_MARGIN,
+                               view.width() * self.WINDOW_MARGIN, view.height() * self.WINDOW_MARGIN)
+        rows = self.get_visible_rows(window.left(), window.right(), window.top(), window.bottom())
+
+        columns = self.store.columns
+        labels = columns["label"][rows]
+        selected = columns["selected"][rows]
+
+        self.paths = []
+        # Rows of each colour (labels may share a colour) and selection state
+        rows_by_colour = {}
+        for code in np.unique(labels).tolist():
+            colour = self.labels.get_label_colour(self.store.categories["label"].decode(code))
+            for is_selected in (False, True):
+                mask = (labels == code) & (selected == is_selected)
+                if mask.any():
+                    rows_by_colour.setdefault((colour, is_selected), []).append(rows[mask])
+
+        for (colour, is_selected), colour_rows in rows_by_colour.items():
+            colour_rows = np.concatenate(colour_rows)
+            x = columns["start"][colour_rows] / self.store.sample_rate
+            w = columns["length"][colour_rows] / self.store.sample_rate
+            y = columns["low"][colour_rows]
+            h = columns["high"][colour_rows] - y
+
+            # Closed rectangles of 5 points, not connected to the next one
+            xs = np.stack((x, x + w, x + w, x, x), axis=1).ravel()
+            ys = np.stack((y, y, y + h, y + h, y), axis=1).ravel()
+            connect = np.tile(np.array([1, 1, 1, 1, 0], dtype=np.int32), len(colour_rows))
+
+            pen = pg.mkPen(colour)
+            if is_selected:
+                pen.setWidth(pen.width() + self.SELECTED_WIDTH)
+            self.paths.append((pen, pg.arrayToQPath(xs, ys, connect=connect)))
+
+        self.window = window
+
+    def paint(self, painter: QtGui.QPainter, option, widget=None):
+        view = self._get_window()
+        if self.window is None or not self.window.contains(view) or \
+                view.width() * view.height() < self.window.width() * self.window.height() * self.MIN_VIEW_FRACTION:
+            self.build(view)
+
+        for pen, path in self.paths:
+            painter.setPen(pen)
+            painter.drawPath(path)
+
+    def hoverEvent(self, ev):
+        if ev.isExit():
+            self.last_hovered = None
+            return
+
+        x, y = ev.pos().x(), ev.pos().y()
+        rows = self.get_visible_rows(x, x, y, y, hidden=True)
+        if not len(rows):
+            self.last_hovered = None
+            return
+
+        # Smallest annotation under the cursor, nothing to do if it is already edited
+        columns = self.store.columns
+        areas = columns["length"][rows] * (columns["high"][rows] - columns["low"][rows])
+        row = int(rows[np.argmin(areas)])
+        if row in self.hidden_rows:
+            self.last_hovered = None
+            return
+
+        if row != self.last_hovered:
+            self.last_hovered = row
+            self.annotation_hovered.emit(row)
@@ -4,8 +4,7 @@ import pyqtgraph as pg
 from annotation import Annotation
 from data_model import DataModel
 from annotation_roi import AnnotationROI
-
-from scipy import signal, fftpack
+import spectrogram_engine as engine
 
 colors = [(38, 70, 83), (42, 157, 143), (233, 196, 106), (244, 162, 97), (231, 111, 81)]
 
@@ -76,15 +75,9 @@ class AnnotationPlot(pg.GraphicsLayoutWidget):
         # Read data from model using just plot time boundaries
         plot_data = self.model.read_time(plot_time_start, plot_time_end - plot_time_start)
 
-        # Compute spectrogram
-        f, t, sxx = signal.spectrogram(plot_data, fs=self.model.get_sample_rate(), return_onesided=False)
-
-        # Frequency shift for both sides
-        f = fftpack.fftshift(f)
-        sxx = fftpack.fftshift(sxx, axes=0)
-
-        # Spectrogram log scale
-        sxx_log = 10 * np.log10(sxx)
+        # Compute spectrogram (frequency 0 in the middle) in log scale
+        sxx = engine.spectrogram(plot_data, self.model.get_sample_rate(), engine.DEFAULT_NPERSEG)
+        sxx_log, power_min, power_max = engine.power_to_db(sxx)
 
         y = plot_time_start
         h = plot_time_end - plot_time_start
@@ -92,7 +85,7 @@ class AnnotationPlot(pg.GraphicsLayoutWidget):
         x = self.model.get_central_frequency() - self.model.get_sample_rate() / 2
         w = self.model.get_sample_rate()
 
-        self.spectrogram_image.setImage(sxx_log, rect=[x, y, w, h])
+        self.spectrogram_image.setImage(sxx_log, levels=(power_min, power_max), rect=[x, y, w, h])
 
         self.spectrogram_plot.setLimits(xMin=x, xMax=x + w, yMin=y, yMax=y + h)
 
@@ -123,7 +116,8 @@ class AnnotationPlot(pg.GraphicsLayoutWidget):
         #       )
 
         if draw_model_annotations:
-            for model_annotation in self.model.annotations:
+            # Only the annotations inside the plot limits
+            for model_annotation in self.model.get_annotations_in(y, y + h, x, x + w):
                 if model_annotation != annotation:
                     model_annotation_y = model_annotation.start
                     model_annotation_x = model_annotation.low
@@ -156,13 +150,8 @@ class AnnotationPlot(pg.GraphicsLayoutWidget):
         #                                 scaling='spectrum',
         #                                 return_onesided=False)
 
-        f, p = signal.welch(x=annotation_data,
-                            fs=self.model.get_sample_rate(),
-                            scaling='spectrum',
-                            return_onesided=False)
-
-        f = fftpack.fftshift(f)
-        p = fftpack.fftshift(p, axes=0)
+        # Frequency 0 in the middle
+        f, p = engine.welch(annotation_data, self.model.get_sample_rate(), scaling='spectrum')
 
         self.periodogram_plot.clear()
         self.periodogram_plot.plot(f, p)
@@ -16,6 +16,8 @@ class AnnotationROI(pg.ROI):
 
     export_roi_signal = QtCore.Signal(object)
     open_roi_signal = QtCore.Signal(object)
+    # Emitted when the mouse cursor leaves the ROI
+    leave_roi_signal = QtCore.Signal(object)
 
     def __init__(self, annotation: Annotation, is_selectable=True, is_time_x_axis=True, **kwargs):
 
@@ -107,6 +109,17 @@ class AnnotationROI(pg.ROI):
         # We inform the view box about the changes
         self.informViewBoundsChanged()
 
+    def hoverEvent(self, ev):
+        super(AnnotationROI, self).hoverEvent(ev)
+        if ev.isExit():
+            self.leave_roi_signal.emit(self)
+
+    def is_hovered(self) -> bool:
+        """
+        Returns if the mouse cursor is over the ROI or one of its handles
+        """
+        return self.isUnderMouse() or any(handle.isUnderMouse() for handle in self.getHandles())
+
     @QtCore.Slot()
     def remove_roi(self):
         self.sigRemoveRequested.emit(self)
@@ -0,0 +1,427 @@
+import weakref
+
+import numpy as np
+
+from PySide6 import QtCore
+
+from annotation import Annotation, AnnotationSource
+from annotation_index import AnnotationIndex
+
+
+class Categories:
+    """
+    Categorical values (labels, groups, ...) stored as integer codes, -1 for None
+    """
+
+    NONE = -1
+
+    def __init__(self):
+        self.names = []
+        self.codes = {}
+
+    def encode(self, name) -> int:
+        if name is None:
+            return self.NONE
+
+        code = self.codes.get(name)
+        if code is None:
+            code = self.codes[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+    def encode_many(self, names) -> np.ndarray:
+        return np.fromiter((self.encode(name) for name in names), dtype=np.int32, count=len(names))
+
+    def decode(self, code: int):
+        return None if code < 0 else self.names[code]
+
+
+class AnnotationStore(QtCore.QObject):
+    """
+    Columnar storage of the annotations of a model.
+
+    Every field is a numpy column (start and length in samples, low and high frequencies, categorical label, group,
+    author and comment codes, confidence, ...), so an annotation costs tens of bytes instead of a QObject with a
+    metadata dictionary. Rows are never reused while the store lives: a removed row is only flagged. The time-frequency
+    index of the rows (see AnnotationIndex) is kept up to date by the store.
+
+    Annotation objects are proxies created on demand (see proxy), a single proxy exists per row while it is
+    referenced. The store acts as a sequence of the proxies of its live rows in insertion order.
+
+    Changes are signalled by the store with an array of the changed rows, a single signal for each batch (see
+    append_many, remove_many and set_fields). Changes made through a proxy are announced by emitting the proxy
+    annotation_changed signal (as before), the store forwards them.
+    """
+
+    annotations_added = QtCore.Signal(object)
+    annotations_removed = QtCore.Signal(object)
+    annotations_changed = QtCore.Signal(object)
+    # Selection changes made through the proxies
+    annotations_selected = QtCore.Signal(object)
+
+    # Rows allocated for an empty store
+    INITIAL_CAPACITY = 1024
+
+    # Column types, fields missing from an annotation are stored as -1 (integers and codes) or NaN
+    COLUMNS = {
+        "id": np.int64,
+        "source": np.int8,
+        "start": np.int64,
+        "length": np.int64,
+        "low": np.float64,
+        "high": np.float64,
+        "label": np.int32,
+        "group": np.int32,
+        "author": np.int32,
+        "comment": np.int32,
+        "symbol_rate": np.float64,
+        "confidence": np.float64,
+        "selected": np.bool_,
+        "alive": np.bool_,
+    }
+    # Columns storing categorical codes
+    CATEGORICAL = ("label", "group", "author", "comment")
+    # Columns defining the time-frequency bounds
+    BOUNDS = frozenset(("start", "length", "low", "high"))
+
+    def __init__(self, sample_rate: float = 1.0):
+        super(AnnotationStore, self).__init__()
+        self.reset(sample_rate)
+
+    def reset(self, sample_rate: float = None):
+        """
+        Removes every annotation (without signals)
+        :param sample_rate: Sample rate used to convert start and length to seconds, None to keep the current one
+        """
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+        self.columns = {name: np.empty(self.INITIAL_CAPACITY, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+        self.columns["alive"][:] = False
+        self.categories = {name: Categories() for name in self.CATEGORICAL}
+        # Metadata fields without column of each row (only rows that have any)
+        self.extra = {}
+
+        self.row_count = 0
+        # Live rows in order, None when outdated
+        self._rows = None
+
+        self.proxies = weakref.WeakValueDictionary()
+        self.index = AnnotationIndex()
+
+    def __len__(self):
+        return len(self.get_rows())
+
+    def __iter__(self):
+        for row in self.get_rows():
+            yield self.proxy(int(row))
+
+    def __getitem__(self, position: int) -> Annotation:
+        return self.proxy(int(self.get_rows()[position]))
+
+    def get_rows(self) -> np.ndarray:
+        """
+        Returns the live rows in insertion order
+        """
+        if self._rows is None:
+            self._rows = np.flatnonzero(self.columns["alive"][:self.row_count])
+        return self._rows
+
+    def get_position(self, annotation: Annotation) -> int:
+        """
+        Returns the position of an annotation in the sequence of live rows
+        """
+        if annotation.store is not self:
+            raise ValueError("Annotation is not in the store")
+        return int(np.searchsorted(self.get_rows(), annotation.row))
+
+    def proxy(self, row: int) -> Annotation:
+        """
+        Returns the annotation of a row, created if there is none
+        """
+        annotation = self.proxies.get(row)
+        if annotation is None:
+            annotation = Annotation.from_store(self, row)
+            self._bind(annotation)
+        return annotation
+
+    def _bind(self, annotation: Annotation):
+        self.proxies[annotation.row] = annotation
+        annotation.annotation_changed.connect(self._proxy_changed)
+        annotation.annotation_selected.connect(self._proxy_selected)
+
+    @QtCore.Slot(object)
+    def _proxy_changed(self, annotation: Annotation):
+        if annotation.store is self:
+            self.annotations_changed.emit(np.array([annotation.row]))
+
+    @QtCore.Slot(object)
+    def _proxy_selected(self, annotation: Annotation):
+        if annotation.store is self:
+            self.annotations_selected.emit(np.array([annotation.row]))
+
+    def _reserve(self, count: int):
+        capacity = len(self.columns["alive"])
+        if self.row_count + count <= capacity:
+            return
+
+        capacity = max(2 * capacity, self.row_count + count)
+        for name, column in self.columns.items():
+            self.columns[name] = np.resize(column, capacity)
+        self.columns["alive"][self.row_count:] = False
+
+    def to_samples(self, times) -> np.ndarray:
+        return np.round(np.asarray(times, dtype=np.float64) * self.sample_rate).astype(np.int64)
+
+    def get_bounds(self, rows) -> np.ndarray:
+        """
+        Returns the time-frequency bounds of rows (see AnnotationIndex.make_bounds)
+        """
+        return AnnotationIndex.make_bounds(self.columns["start"][rows] / self.sample_rate,
+                                           self.columns["length"][rows] / self.sample_rate,
+                                           self.columns["low"][rows],
+                                           self.columns["high"][rows])
+
+    def get_annotation_bounds(self, annotation: Annotation) -> np.ndarray:
+        """
+        Returns the bounds an annotation has (or would have) in the store
+        """
+        if annotation.store is self:
+            return self.get_bounds([annotation.row])
+
+        return AnnotationIndex.make_bounds(self.to_samples(annotation.start) / self.sample_rate,
+                                           self.to_samples(annotation.length) / self.sample_rate,
+                                           np.nan if annotation.low is None else annotation.low,
+                                           np.nan if annotation.high is None else annotation.high)
+
+    def extend(self, start, length, low=None, high=None, label=None, group=None, author=None, comment=None,
+               symbol_rate=None, confidence=None, source: AnnotationSource = None, ids=None, extra=None) -> np.ndarray:
+        """
+        Adds annotations from columns without creating any annotation object (no signal is emitted)
+        :param start: Start sample of each annotation
+        :param length: Length in samples of each annotation
+        :param low: Lowest frequencies (None values as NaN)
+        :param high: Highest frequencies (None values as NaN)
+        :param label: Labels (None values for no label)
+        :param group: Groups
+        :param author: Authors
+        :param comment: Comments
+        :param symbol_rate: Symbol rates
+        :param confidence: Confidences
+        :param source: Source of all the annotations
+        :param ids: Annotation ids (-1 for None)
+        :param extra: Other metadata fields of each annotation (list of dictionaries or None)
+        :return: Rows of the annotations
+        """
+        count = len(start)
+        self._reserve(count)
+        rows = np.arange(self.row_count, self.row_count + count)
+
+        columns = self.columns
+        columns["start"][rows] = start
+        columns["length"][rows] = length
+        columns["id"][rows] = -1 if ids is None else ids
+        columns["source"][rows] = source.value if source else 0
+        columns["selected"][rows] = False
+
+        for name, values in (("low", low), ("high", high), ("symbol_rate", symbol_rate), ("confidence", confidence)):
+            columns[name][rows] = np.nan if values is None else np.array(values, dtype=np.float64)
+
+        for name, values in (("label", label), ("group", group), ("author", author), ("comment", comment)):
+            columns[name][rows] = Categories.NONE if values is None else self.categories[name].encode_many(values)
+
+        if extra is not None:
+            for row, fields in zip(rows, extra):
+                if fields:
+                    self.extra[int(row)] = dict(fields)
+
+        columns["alive"][rows] = True
+        self.row_count += count
+        self._rows = None
+
+        self.index.insert(rows, self.get_bounds(rows))
+
+        return rows
+
+    def append(self, annotation: Annotation) -> int:
+        """
+        Adds an annotation, the annotation becomes the proxy of the new row
+        :return: Row of the annotation
+        """
+        return int(self.append_many([annotation])[0])
+
+    def append_many(self, annotations: list) -> np.ndarray:
+        """
+        Adds annotations, each annotation becomes the proxy of its new row (a single signal is emitted)
+        :return: Rows of the annotations
+        """
+        if any(annotation.store is not None for annotation in annotations):
+            raise ValueError("Annotation already in a store")
+
+        count = len(annotations)
+        self._reserve(count)
+        rows = np.arange(self.row_count, self.row_count + count)
+
+        for name in Annotation.FIELDS:
+            self.columns[name][rows] = self._encode(name, [getattr(annotation, name) for annotation in annotations])
+
+        for row, annotation in zip(rows.tolist(), annotations):
+            extra = dict(annotation.metadata._extra())
+            if extra:
+                self.extra[row] = extra
+            annotation.attach(self, row)
+            self._bind(annotation)
+
+        self.columns["alive"][rows] = True
+        self.row_count += count
+        self._rows = None
+
+        self.index.insert(rows, self.get_bounds(rows))
+        if count:
+            self.annotations_added.emit(rows)
+
+        return rows
+
+    def remove(self, row: int):
+        """
+        Removes a row, its proxy (if any) gets the annotation fields back
+        """
+        self.remove_many([row])
+
+    def remove_many(self, rows):
+        """
+        Removes rows, their proxies (if any) get the annotation fields back (a single signal is emitted)
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        rows = np.unique(rows[self.columns["alive"][rows]])
+        if not len(rows):
+            return
+
+        for row in rows.tolist():
+            annotation = self.proxies.pop(row, None)
+            if annotation is not None:
+                annotation.annotation_changed.disconnect(self._proxy_changed)
+                annotation.annotation_selected.disconnect(self._proxy_selected)
+                annotation.detach()
+
+        self.columns["alive"][rows] = False
+        self.columns["selected"][rows] = False
+        self._rows = None
+        self.index.remove(rows)
+
+        self.annotations_removed.emit(rows)
+
+    def get_field(self, row: int, name: str):
+        value = self.columns[name][row]
+
+        if name in self.CATEGORICAL:
+            return self.categories[name].decode(value)
+        if name in ("start", "length"):
+            return value / self.sample_rate
+        if name == "id":
+            return None if value < 0 else int(value)
+        if name == "source":
+            return AnnotationSource(value) if value else None
+        if name == "selected":
+            return bool(value)
+        return None if np.isnan(value) else float(value)
+
+    def set_field(self, row: int, name: str, value):
+        """
+        Sets a field of a row (no signal is emitted, the proxy signals the change)
+        """
+        self.columns[name][row] = self._encode(name, [value])[0]
+
+        if name in self.BOUNDS:
+            self.index.update(row, self.get_bounds([row]))
+
+    def set_fields(self, rows, **values):
+        """
+        Sets fields of rows (a single signal is emitted)
+        :param rows: Rows of the annotations
+        :param values: Value of each field, same value for every row or list with a value per row
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        if not len(rows):
+            return
+
+        for name, value in values.items():
+            if not isinstance(value, (list, tuple, np.ndarray)):
+                value = [value] * len(rows)
+            self.columns[name][rows] = self._encode(name, value)
+
+        if self.BOUNDS.intersection(values):
+            self.index.update(rows, self.get_bounds(rows))
+
+        self.annotations_changed.emit(rows)
+
+    def _encode(self, name: str, values: list) -> np.ndarray:
+        """
+        Returns the column values of field values (see get_field)
+        """
+        if name in self.CATEGORICAL:
+            return self.categories[name].encode_many(values)
+        if name in ("start", "length"):
+            return self.to_samples(values)
+        if name == "id":
+            return np.array([-1 if value is None else value for value in values], dtype=np.int64)
+        if name == "source":
+            return np.array([value.value if value else 0 for value in values], dtype=np.int8)
+        if name == "selected":
+            return np.array(values, dtype=bool)
+        return np.array([np.nan if value is None or value == "" else value for value in values], dtype=np.float64)
+
+    def get_extra(self, row: int, create: bool = False) -> dict:
+        """
+        Returns the metadata fields without column of a row
+        """
+        if create:
+            return self.extra.setdefault(row, {})
+        return self.extra.get(row, {})
+
+    def get_values(self, name: str, rows=None) -> list:
+        """
+        Returns the decoded values of a categorical column
+        :param name: Column name (see CATEGORICAL)
+        :param rows: Rows, None for the live rows
+        """
+        rows = self.get_rows() if rows is None else rows
+        names = self.categories[name].names
+        return [None if code < 0 else names[code] for code in self.columns[name][rows]]
+
+    def get_used_values(self, name: str) -> list:
+        """
+        Returns the values of a categorical column used by live rows
+        """
+        codes = np.unique(self.columns[name][self.get_rows()])
+        return [self.categories[name].names[code] for code in codes if code >= 0]
+
+    def to_dict(self, row: int) -> dict:
+        """
+        Returns the metadata of a row (same as Annotation.to_dict) without creating its proxy
+        """
+        symbol_rate = self.get_field(row, "symbol_rate")
+        return {
+            "start": self.get_field(row, "start"),
+            "length": self.get_field(row, "length"),
+            "low": self.get_field(row, "low"),
+            "high": self.get_field(row, "high"),
+            "author": self.get_field(row, "author"),
+            "comment": self.get_field(row, "comment"),
+            "symbol_rate": "" if symbol_rate is None else symbol_rate,
+            "label": self.get_field(row, "label"),
+            "confidence": self.get_field(row, "confidence"),
+            "group": self.get_field(row, "group")
+        }
+
+    def get_selected_rows(self) -> np.ndarray:
+        rows = self.get_rows()
+        return rows[self.columns["selected"][rows]]
+
+    def nbytes(self) -> int:
+        """
+        Returns the memory used by the columns and the index
+        """
+        index = self.index
+        return sum(column.nbytes for column in self.columns.values()) + index.bounds.nbytes + index.keys.nbytes + \
+            index.valid.nbytes + index.position.nbytes
@@ -0,0 +1,406 @@
+import typing
+
+import numpy as np
+
+from PySide6 import QtCore, QtWidgets, QtGui
+
+from annotation_store import AnnotationStore
+
+
+class AnnotationTreeModel(QtCore.QAbstractItemModel):
+    """
+    Tree of the annotations of a store: groups, annotations of each group and fields of each annotation.
+
+    Nothing is created per annotation: the annotations of each group are kept as a sorted array of store rows
+    (group-to-row index) and the items are identified by their internal id:
+    - 0 for a group
+    - (group position + 1) << 1 for an annotation
+    - ((store row + 1) << 1) | 1 for a field of an annotation
+    The annotations of a group are fetched lazily (see canFetchMore and fetchMore), FETCH_SIZE at a time.
+    """
+
+    # Annotations of a group exposed by each fetchMore
+    FETCH_SIZE = 1000
+    # Contiguous blocks of removed rows above which the model is reset instead of removing each block
+    REMOVE_BLOCKS = 64
+
+    # Field rows of an annotation (title, field)
+    FIELDS = (("Start", "start"),
+              ("Duration", "length"),
+              ("Low freq.", "low"),
+              ("High freq.", "high"),
+              ("Author", "author"),
+              ("Comment", "comment"),
+              ("Label", "label"))
+    LABEL_ROW = 6
+    # Fields displayed as numbers
+    NUMERIC_FIELDS = ("start", "length", "low", "high")
+
+    ROW_HEIGHT = 20
+
+    def __init__(self, store: AnnotationStore, groups: list = (), parent=None):
+        """
+        :param store: Annotation store
+        :param groups: Groups listed even if they have no annotation (e.g. the model groups)
+        """
+        super(AnnotationTreeModel, self).__init__(parent)
+        self.store = store
+
+        self.group_font = QtGui.QFont()
+        self.group_font.setWeight(QtGui.QFont.Bold)
+        self.group_font.setPointSize(10)
+
+        self.build(groups)
+
+        self.store.annotations_added.connect(self.add_rows)
+        self.store.annotations_removed.connect(self.remove_rows)
+        self.store.annotations_changed.connect(self.update_rows)
+
+    def build(self, groups: list):
+        """
+        Builds the group-to-row index of the store (vectorized)
+        """
+        categories = self.store.categories["group"]
+
+        # Group code of each group position and position of each group code
+        self.group_codes = []
+        self.group_position = {}
+        # Sorted store rows of each group, number of them exposed to the view
+        self.group_rows = []
+        self.fetched = []
+        # Group position under which each store row is listed (-1 if not listed)
+        self.listed_group = np.full(len(self.store.columns["group"]), -1, dtype=np.int64)
+
+        for group in groups:
+            self._add_group(categories.encode(group))
+        # Annotations without group
+        self._add_group(categories.NONE)
+
+        rows = self.store.get_rows()
+        positions = self._get_group_positions(self.store.columns["group"][rows])
+        self.listed_group[rows] = positions
+
+        order = np.argsort(positions, kind='stable')
+        bounds = np.searchsorted(positions[order], np.arange(len(self.group_codes) + 1))
+        for position in range(len(self.group_codes)):
+            self.group_rows[position] = rows[order[bounds[position]:bounds[position + 1]]]
+
+    def _add_group(self, code: int) -> int:
+        if code not in self.group_position:
+            self.group_position[code] = len(self.group_codes)
+            self.group_codes.append(code)
+            self.group_rows.append(np.empty(0, dtype=np.int64))
+            self.fetched.append(0)
+        return self.group_position[code]
+
+    def _get_group_positions(self, codes: np.ndarray) -> np.ndarray:
+        """
+        Returns the group position of group codes, new groups are added (without signals)
+        """
+        for code in np.unique(codes).tolist():
+            self._add_group(code)
+
+        # Lookup table shifted by one for the codes of annotations without group (-1)
+        lookup = np.full(max(self.group_position) + 2, -1, dtype=np.int64)
+        for code, position in self.group_position.items():
+            lookup[code + 1] = position
+        return lookup[codes + 1]
+
+    def _reserve(self):
+        size = len(self.store.columns["group"])
+        if size > len(self.listed_group):
+            self.listed_group = np.concatenate((self.listed_group,
+                                                np.full(size - len(self.listed_group), -1, dtype=np.int64)))
+
+    @staticmethod
+    def _is_group(index: QtCore.QModelIndex) -> bool:
+        return index.isValid() and index.internalId() == 0
+
+    @staticmethod
+    def _is_annotation(index: QtCore.QModelIndex) -> bool:
+        return index.isValid() and index.internalId() != 0 and not index.internalId() & 1
+
+    @staticmethod
+    def _is_field(index: QtCore.QModelIndex) -> bool:
+        return index.isValid() and bool(index.internalId() & 1)
+
+    def get_row(self, index: QtCore.QModelIndex) -> int:
+        """
+        Returns the store row of an annotation or field index (None for a group)
+        """
+        if self._is_annotation(index):
+            return int(self.group_rows[(index.internalId() >> 1) - 1][index.row()])
+        if self._is_field(index):
+            return (index.internalId() >> 1) - 1
+        return None
+
+    def get_annotation_index(self, row: int) -> QtCore.QModelIndex:
+        """
+        Returns the index of the annotation of a store row, fetching the annotations of its group up to it
+        """
+        if row >= len(self.listed_group) or self.listed_group[row] < 0:
+            return QtCore.QModelIndex()
+
+        position = int(self.listed_group[row])
+        annotation_position = int(np.searchsorted(self.group_rows[position], row))
+        group_index = self.index(position, 0)
+        while self.fetched[position] <= annotation_position:
+            self.fetchMore(group_index)
+
+        return self.index(annotation_position, 0, group_index)
+
+    def index(self, row: int, column: int, parent: QtCore.QModelIndex = QtCore.QModelIndex()) -> QtCore.QModelIndex:
+        if not self.hasIndex(row, column, parent):
+            return QtCore.QModelIndex()
+
+        if not parent.isValid():
+            return self.createIndex(row, column, 0)
+        if self._is_group(parent):
+            return self.createIndex(row, column, (parent.row() + 1) << 1)
+        if self._is_annotation(parent):
+            return self.createIndex(row, column, ((self.get_row(parent) + 1) << 1) | 1)
+        return QtCore.QModelIndex()
+
+    def parent(self, index: QtCore.QModelIndex = QtCore.QModelIndex()) -> QtCore.QModelIndex:
+        if self._is_annotation(index):
+            return self.createIndex((index.internalId() >> 1) - 1, 0, 0)
+
+        if self._is_field(index):
+            row = self.get_row(index)
+            position = int(self.listed_group[row])
+            if position < 0:
+                # Removed annotation
+                return QtCore.QModelIndex()
+            annotation_position = int(np.searchsorted(self.group_rows[position], row))
+            return self.createIndex(annotation_position, 0, (position + 1) << 1)
+
+        return QtCore.QModelIndex()
+
+    def rowCount(self, parent: QtCore.QModelIndex = QtCore.QModelIndex()) -> int:
+        if parent.column() > 0:
+            return 0
+        if not parent.isValid():
+            return len(self.group_codes)
+        if self._is_group(parent):
+            return self.fetched[parent.row()]
+        if self._is_annotation(parent):
+            return len(self.FIELDS)
+        return 0
+
+    def columnCount(self, parent: QtCore.QModelIndex = QtCore.QModelIndex()) -> int:
+        return 2
+
+    def hasChildren(self, parent: QtCore.QModelIndex = QtCore.QModelIndex()) -> bool:
+        if self._is_group(parent):
+            return parent.column() == 0 and len(self.group_rows[parent.row()]) > 0
+        return super(AnnotationTreeModel, self).hasChildren(parent)
+
+    def canFetchMore(self, parent: QtCore.QModelIndex) -> bool:
+        return self._is_group(parent) and self.fetched[parent.row()] < len(self.group_rows[parent.row()])
+
+    def fetchMore(self, parent: QtCore.QModelIndex) -> None:
+        if not self.canFetchMore(parent):
+            return
+
+        position = parent.row()
+        first = self.fetched[position]
+        last = min(first + self.FETCH_SIZE, len(self.group_rows[position])) - 1
+
+        self.beginInsertRows(parent.siblingAtColumn(0), first, last)
+        self.fetched[position] = last + 1
+        self.endInsertRows()
+
+    def headerData(self, section: int, orientation: QtCore.Qt.Orientation, role: int = ...) -> typing.Any:
+        if orientation == QtCore.Qt.Orientation.Horizontal and role == QtCore.Qt.ItemDataRole.DisplayRole:
+            return ("Groups", "Values")[section]
+        return None
+
+    def data(self, index: QtCore.QModelIndex, role: int = ...) -> typing.Any:
+        if not index.isValid():
+            return None
+
+        if role == QtCore.Qt.ItemDataRole.SizeHintRole:
+            return QtCore.QSize(0, self.ROW_HEIGHT)
+
+        if self._is_group(index):
+            if role == QtCore.Qt.ItemDataRole.DisplayRole and index.column() == 0:
+                group = self.store.categories["group"].decode(self.group_codes[index.row()])
+                return "Ungrouped" if group is None else group
+            if role == QtCore.Qt.ItemDataRole.FontRole:
+                return self.group_font
+            if role == QtCore.Qt.ItemDataRole.BackgroundRole:
+                return QtWidgets.QApplication.palette().brush(QtGui.QPalette.Normal, QtGui.QPalette.Dark)
+            return None
+
+        if self._is_annotation(index):
+            if role == QtCore.Qt.ItemDataRole.DisplayRole and index.column() == 0:
+                return "Annotation"
+            return None
+
+        title, name = self.FIELDS[index.row()]
+        if role == QtCore.Qt.ItemDataRole.DisplayRole:
+            if index.column() == 0:
+                return title
+            value = self.store.get_field(self.get_row(index), name)
+            if value is None:
+                return ""
+            return f"{value:.02f}" if name in self.NUMERIC_FIELDS else value
+        if role == QtCore.Qt.ItemDataRole.EditRole and index.column() == 1:
+            return self.store.get_field(self.get_row(index), name)
+
+        return None
+
+    def setData(self, index: QtCore.QModelIndex, value: typing.Any, role: int = ...) -> bool:
+        if role != QtCore.Qt.ItemDataRole.EditRole or not self._is_field(index) or index.row() != self.LABEL_ROW:
+            return False
+
+        # Edited through the annotation so that every view of the annotation follows the change (the store signals
+        # the change to this model)
+        annotation = self.store.proxy(self.get_row(index))
+        annotation.label = value or None
+        annotation.annotation_changed.emit(annotation)
+        return True
+
+    def flags(self, index: QtCore.QModelIndex) -> QtCore.Qt.ItemFlags:
+        if not index.isValid():
+            return QtCore.Qt.ItemFlag.NoItemFlags
+
+        if self._is_annotation(index):
+            return QtCore.Qt.ItemFlag.ItemIsEnabled | QtCore.Qt.ItemFlag.ItemIsSelectable
+        if self._is_field(index) and index.row() == self.LABEL_ROW and index.column() == 1:
+            return QtCore.Qt.ItemFlag.ItemIsEnabled | QtCore.Qt.ItemFlag.ItemIsSelectable | \
+                QtCore.Qt.ItemFlag.ItemIsEditable
+        return QtCore.Qt.ItemFlag.ItemIsEnabled
+
+    def _insert_groups(self, codes: np.ndarray):
+        """
+        Adds the groups of group codes that are not listed yet
+        """
+        codes = [code for code in np.unique(codes).tolist() if code not in self.group_position]
+        if not codes:
+            return
+
+        first = len(self.group_codes)
+        self.beginInsertRows(QtCore.QModelIndex(), first, first + len(codes) - 1)
+        for code in codes:
+            self._add_group(code)
+        self.endInsertRows()
+
+    @QtCore.Slot(object)
+    def add_rows(self, rows: np.ndarray):
+        """
+        Lists new store rows (rows are added to the store in increasing order)
+        """
+        self._reserve()
+        codes = self.store.columns["group"][rows]
+        self._insert_groups(codes)
+        self._list_rows(rows, self._get_group_positions(codes))
+
+    def _list_rows(self, rows: np.ndarray, positions: np.ndarray):
+        """
+        Adds sorted store rows to the annotations of their groups
+        """
+        for position in np.unique(positions).tolist():
+            new_rows = rows[positions == position]
+            self.listed_group[new_rows] = position
+
+            # Rows inserted among the fetched annotations (or after them if all are fetched) are exposed to the view,
+            # the others are fetched later
+            insert_at = np.searchsorted(self.group_rows[position], new_rows)
+            fetched = self.fetched[position]
+            if fetched == len(self.group_rows[position]):
+                exposed = insert_at <= fetched
+            else:
+                exposed = insert_at < fetched
+
+            group_index = self.index(position, 0)
+            exposed_rows = new_rows[exposed]
+            # Position of the exposed rows once inserted
+            exposed_at = insert_at[exposed] + np.arange(len(exposed_rows))
+            for first, last in self._get_blocks(exposed_at):
+                self.beginInsertRows(group_index, first, last)
+                group_rows = self.group_rows[position]
+                block_rows = exposed_rows[(exposed_at >= first) & (exposed_at <= last)]
+                self.group_rows[position] = np.concatenate((group_rows[:first], block_rows, group_rows[first:]))
+                self.fetched[position] += last - first + 1
+                self.endInsertRows()
+
+            hidden_rows = new_rows[~exposed]
+            group_rows = self.group_rows[position]
+            self.group_rows[position] = np.insert(group_rows, np.searchsorted(group_rows, hidden_rows), hidden_rows)
+
+    @QtCore.Slot(object)
+    def remove_rows(self, rows: np.ndarray):
+        """
+        Unlists removed store rows
+        """
+        rows = rows[self.listed_group[rows] >= 0]
+        positions = self.listed_group[rows]
+
+        # Blocks of removed annotations exposed to the view, in decreasing order
+        blocks = []
+        for position in np.unique(positions).tolist():
+            group_rows = self.group_rows[position]
+            removed = np.searchsorted(group_rows, rows[positions == position])
+            exposed = removed[removed < self.fetched[position]]
+            blocks.extend((position, first, last) for first, last in reversed(self._get_blocks(exposed)))
+
+        if len(blocks) > self.REMOVE_BLOCKS:
+            self.beginResetModel()
+            self._unlist_rows(rows, positions)
+            self.endResetModel()
+            return
+
+        for position, first, last in blocks:
+            self.beginRemoveRows(self.index(position, 0), first, last)
+            group_rows = self.group_rows[position]
+            self.group_rows[position] = np.concatenate((group_rows[:first], group_rows[last + 1:]))
+            self.listed_group[group_rows[first:last + 1]] = -1
+            self.fetched[position] -= last - first + 1
+            self.endRemoveRows()
+
+        # Annotations that were not exposed yet
+        rows = rows[self.listed_group[rows] >= 0]
+        self._unlist_rows(rows, self.listed_group[rows])
+
+    def _unlist_rows(self, rows: np.ndarray, positions: np.ndarray):
+        for position in np.unique(positions).tolist():
+            group_rows = self.group_rows[position]
+            keep = ~np.isin(group_rows, rows[positions == position])
+            # Fetched annotations that are removed
+            self.fetched[position] -= int(np.count_nonzero(~keep[:self.fetched[position]]))
+            self.group_rows[position] = group_rows[keep]
+        self.listed_group[rows] = -1
+
+    @QtCore.Slot(object)
+    def update_rows(self, rows: np.ndarray):
+        """
+        Updates changed store rows, annotations that changed group are moved
+        """
+        rows = np.unique(rows[self.listed_group[rows] >= 0])
+        codes = self.store.columns["group"][rows]
+        self._insert_groups(codes)
+
+        positions = self._get_group_positions(codes)
+        moved = positions != self.listed_group[rows]
+        if np.any(moved):
+            self.remove_rows(rows[moved])
+            self._list_rows(rows[moved], positions[moved])
+
+        for row in rows[~moved].tolist():
+            position = int(self.listed_group[row])
+            if np.searchsorted(self.group_rows[position], row) < self.fetched[position]:
+                self.dataChanged.emit(self.createIndex(0, 1, ((row + 1) << 1) | 1),
+                                      self.createIndex(len(self.FIELDS) - 1, 1, ((row + 1) << 1) | 1))
+
+    @staticmethod
+    def _get_blocks(positions: np.ndarray) -> list:
+        """
+        Returns the (first, last) contiguous blocks of sorted positions
+        """
+        if not len(positions):
+            return []
+        breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+        firsts = positions[np.concatenate(([0], breaks))]
+        lasts = positions[np.concatenate((breaks - 1, [len(positions) - 1]))]
+        return list(zip(firsts.tolist(), lasts.tolist()))
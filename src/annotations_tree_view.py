@@ -1,227 +1,114 @@
 import logging
 
-from PySide6 import QtCore, QtWidgets, QtGui
+import numpy as np
 
-from annotation import Annotation
+from PySide6 import QtCore, QtWidgets
+
+from annotations_tree_model import AnnotationTreeModel
 from sigmf_model import SigMFModel
 
 logging = logging.getLogger("SpectroGrasp")
 
 
-class AnnotationTreeItem(QtWidgets.QTreeWidgetItem):
-
-    def __init__(self, annotation: Annotation):
-        super(AnnotationTreeItem, self).__init__()
-
-        self.annotation = annotation
-        self.setupUI()
-
-    def setupUI(self):
-
-        self.setText(0, "Annotation")
-        self.setSizeHint(0, QtCore.QSize(0, 20))
-        # Annotation item flags:
-        # - Selectable (annotation select)
-        # - Drag enabled (annotation drag/drop group)
-        # - Drop disabled (annotation cannot be destination of a drop)
-        self.setFlags(self.flags() & ~QtCore.Qt.ItemIsDropEnabled | QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsDragEnabled)
-
-        self.start_item = self.create_annotation_field_item("Start")
-        self.duration_item = self.create_annotation_field_item("Duration")
-        self.low_freq_item = self.create_annotation_field_item("Low freq.")
-        self.high_freq_item = self.create_annotation_field_item("High freq.")
-        self.author_item = self.create_annotation_field_item("Author")
-        self.comment_item = self.create_annotation_field_item("Comment")
-        self.label_item = self.create_annotation_field_item("Label")
-
-        self.update_annotation_data()
-
-    def create_annotation_field_item(self, label):
-        item = QtWidgets.QTreeWidgetItem(self)
-        item.setData(0, QtCore.Qt.ItemDataRole.DisplayRole, label)
-        item.setSizeHint(0, QtCore.QSize(0, 20))
-        # Annotation field item flags: Not selectable, drag disabled, drop disabled
-        item.setFlags(item.flags() &
-                      ~QtCore.Qt.ItemIsSelectable &
-                      ~QtCore.Qt.ItemIsDragEnabled &
-                      ~QtCore.Qt.ItemIsDropEnabled)
-        return item
-
-    def update_annotation_data(self):
-        self.start_item.setData(1, QtCore.Qt.ItemDataRole.DisplayRole, f"{self.annotation.start:.02f}")
-        self.duration_item.setData(1, QtCore.Qt.ItemDataRole.DisplayRole, f"{self.annotation.length:.02f}")
-        self.low_freq_item.setData(1, QtCore.Qt.ItemDataRole.DisplayRole, f"{self.annotation.low:.02f}")
-        self.high_freq_item.setData(1, QtCore.Qt.ItemDataRole.DisplayRole, f"{self.annotation.high:.02f}")
-        self.author_item.setData(1, QtCore.Qt.ItemDataRole.DisplayRole, self.annotation.author)
-        self.comment_item.setData(1, QtCore.Qt.ItemDataRole.DisplayRole, self.annotation.comment)
-
-
-class AnnotationTreeView(QtWidgets.QTreeWidget):
-    
+class LabelSelectionDelegate(QtWidgets.QStyledItemDelegate):
+    """
+    Edits annotation labels with a combo box of the model labels, the editor only exists while editing
+    """
+
+    def __init__(self, labels_model, parent=None):
+        super(LabelSelectionDelegate, self).__init__(parent)
+        self.labels_model = labels_model
+
+    def createEditor(self, parent: QtWidgets.QWidget, option: 'QStyleOptionViewItem',
+                     index: QtCore.QModelIndex) -> QtWidgets.QWidget:
+        label_combobox = QtWidgets.QComboBox(parent)
+        label_combobox.setModel(self.labels_model)
+        label_combobox.setModelColumn(0)
+        label_combobox.setEditable(True)
+        return label_combobox
+
+    def setEditorData(self, editor: QtWidgets.QComboBox, index: QtCore.QModelIndex) -> None:
+        label = index.data(QtCore.Qt.ItemDataRole.EditRole)
+        if label:
+            editor.setCurrentText(label)
+        else:
+            editor.setCurrentIndex(-1)
+
+    def setModelData(self, editor: QtWidgets.QComboBox, model: QtCore.QAbstractItemModel,
+                     index: QtCore.QModelIndex) -> None:
+        logging.debug(f"Change annotation label from {index.data(QtCore.Qt.ItemDataRole.EditRole)} to "
+                      f"{editor.currentText()}")
+        model.setData(index, editor.currentText(), QtCore.Qt.ItemDataRole.EditRole)
+
+
+class AnnotationTreeView(QtWidgets.QTreeView):
+    """
+    Annotations of the model by group (see AnnotationTreeModel)
+    """
+
     def __init__(self, parent=None):
         super(AnnotationTreeView, self).__init__(parent)
 
-        self.setColumnCount(1)
-        self.setHeaderLabels(["Groups", "Values"])
         self.setAlternatingRowColors(True)
         self.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
-        self.setColumnWidth(0, 125)
+        # Rows are laid out without querying each of them
+        self.setUniformRowHeights(True)
+        self.setEditTriggers(QtWidgets.QAbstractItemView.DoubleClicked |
+                             QtWidgets.QAbstractItemView.SelectedClicked)
 
         # self.setDragEnabled(False)
         # self.setDragDropMode(QtWidgets.QAbstractItemView.InternalMove)
         # self.setDefaultDropAction(QtCore.Qt.DropAction.MoveAction)
         # self.setDropIndicatorShown(True)
 
-        # root = self.invisibleRootItem()
-        # root.setFlags(root.flags() & ~QtCore.Qt.ItemIsDropEnabled)
+        self.model = None
+        self.tree_model = None
 
-        self.annotation_items = []
-        self.groups = {}
-
-        self.root_item_font = QtGui.QFont()
-        self.root_item_font.setWeight(QtGui.QFont.Bold)
-        self.root_item_font.setPointSize(10)
+        # Annotations of the last group in view are fetched when scrolling to the bottom
+        self.verticalScrollBar().valueChanged.connect(self.scrolled)
 
     def set_model(self, model: SigMFModel):
-        # Clean widget
-        self.clear()
-        self.model = model
-
-        for group in self.model.groups.groups:
-            group_item = self.create_group_item(group)
-            self.groups[group] = group_item
+        if self.tree_model is not None:
+            self.model.annotations.annotations_selected.disconnect(self.select_annotations)
+            self.tree_model.deleteLater()
 
-        # We create a group for annotations without group
-        self.groups[None] = self.create_group_item("Ungrouped")
-
-        self.addTopLevelItems(list(self.groups.values()))
-
-        # Add every annotation in the model to the view
-        for annotation in self.model.annotations:
-            self.add_annotation(annotation)
-
-        # Add new annotation every time a new annotation is added to the model
-        self.model.annotation_added.connect(self.add_annotation)
-        self.model.annotation_removed.connect(self.remove_annotation)
-
-    def create_group_item(self, group_label):
-        new_group_item = QtWidgets.QTreeWidgetItem(self)
-        new_group_item.setText(0, group_label)
-        new_group_item.setFont(0, self.root_item_font)
-        new_group_item.setBackground(0, self.palette().brush(QtGui.QPalette.Normal, QtGui.QPalette.Dark))
-        new_group_item.setFirstColumnSpanned(True)
-        new_group_item.setFlags(new_group_item.flags() & ~QtCore.Qt.ItemIsDragEnabled | QtCore.Qt.ItemIsDropEnabled)
-        new_group_item.setExpanded(True)
-        return new_group_item
-
-    @QtCore.Slot(object)
-    def add_annotation(self, annotation: Annotation):
-        logging.debug("Adding annotation to TreeView")
-        annotation_item = AnnotationTreeItem(annotation)
-
-        annotation_label_combobox = QtWidgets.QComboBox(self)
-        annotation_label_combobox.setModel(self.model.labels)
-        annotation_label_combobox.setModelColumn(0)
-        annotation_label_combobox.setEditable(True)
-
-        self.setItemWidget(annotation_item.label_item, 1, annotation_label_combobox)
+        self.model = model
+        self.tree_model = AnnotationTreeModel(model.annotations, model.groups.groups, self)
+        self.tree_model.rowsInserted.connect(self.rows_inserted)
 
-        annotation_item.label_item.setFlags(annotation_item.label_item.flags() | QtCore.Qt.ItemIsSelectable)
+        self.setModel(self.tree_model)
+        self.setItemDelegateForColumn(1, LabelSelectionDelegate(model.labels, self))
+        self.setColumnWidth(0, 125)
 
-        if annotation.label:
-            annotation_label_combobox.setCurrentText(annotation.label)
-        else:
-            annotation_label_combobox.setCurrentIndex(-1)
+        self.rows_inserted(QtCore.QModelIndex(), 0, self.tree_model.rowCount() - 1)
 
-        annotation_label_combobox.currentIndexChanged.connect(
-            lambda idx:
-                self.update_annotation_label(
-                    annotation_label_combobox.itemText(idx),
-                    annotation
-                )
-        )
+        self.model.annotations.annotations_selected.connect(self.select_annotations)
 
-        # Add group to tree view
-        if annotation.group not in self.groups.keys():
-            new_group = self.create_group_item(annotation.group)
-            self.groups[annotation.group] = new_group
-            self.addTopLevelItem(new_group)
+    @QtCore.Slot(QtCore.QModelIndex, int, int)
+    def rows_inserted(self, parent: QtCore.QModelIndex, first: int, last: int):
+        if parent.isValid():
+            return
 
-        self.groups[annotation.group].addChild(annotation_item)
+        # Group rows span both columns and are expanded (their first annotations are fetched)
+        for row in range(first, last + 1):
+            self.setFirstColumnSpanned(row, parent, True)
+            self.expand(self.tree_model.index(row, 0))
 
-        annotation.annotation_changed.connect(self.update_annotation)
-        annotation.annotation_selected.connect(self.select_annotation)
+    @QtCore.Slot(int)
+    def scrolled(self, value: int):
+        if self.tree_model is None or value < self.verticalScrollBar().maximum():
+            return
 
-    @QtCore.Slot(object)
-    def remove_annotation(self, annotation: Annotation):
-        for item_idx in range(self.groups[annotation.group].childCount()):
-            item = self.groups[annotation.group].child(item_idx)
-            if item.annotation == annotation:
-                self.groups[annotation.group].removeChild(item)
-                break
+        index = self.indexAt(self.viewport().rect().bottomLeft())
+        while index.isValid() and index.parent().isValid():
+            index = index.parent()
 
-    @QtCore.Slot(object)
-    def update_annotation(self, annotation: Annotation):
-        # Find the updated annotation
-        for group_key, group_item in self.groups.items():
-            for item_idx in range(group_item.childCount()):
-                item = group_item.child(item_idx)
-                if item.annotation == annotation:
-                    if annotation.group != group_key:
-                        # Changed groups
-                        group_item.removeChild(item)
-                        if annotation.group not in self.groups.keys():
-                            #New group
-                            new_group = self.create_group_item(annotation.group)
-                            new_group.addChild(item)
-                            self.groups[annotation.group] = new_group
-                            self.addTopLevelItems(self.groups.values())
-                        else:
-                            # Add to group
-                            self.groups[annotation.group].addChild(item)
-                    else:
-                        # Group did not changed
-                        pass
-                    # Update annotation item
-                    item.update_annotation_data()
-                    self.itemWidget(item.label_item, 1).setCurrentText(annotation.label)
-                    return
-
-        logging.warning(f"Updated annotation at {annotation.start} not found in the tree view")
+        if index.isValid() and self.tree_model.canFetchMore(index):
+            self.tree_model.fetchMore(index)
 
     @QtCore.Slot(object)
-    def select_annotation(self, annotation: Annotation):
-        for item_idx in range(self.groups[annotation.group].childCount()):
-            item = self.groups[annotation.group].child(item_idx)
-            if item.annotation == annotation:
-                item.setExpanded(annotation.selected)
-                # item.setSelected(annotation.selected)
-                break
-
-    def change_annotation_label(self, edit: QtWidgets.QLineEdit, annotation: Annotation):
-        label_text = edit.text()
-        if label_text and label_text not in self.model.labels.stringList():
-            res = QtWidgets.QMessageBox.question(self, "Add label", f"Do you want to add {label_text} to the model?")
-            if res == QtWidgets.QMessageBox.Yes:
-                logging.debug(f"Adding label {label_text} to model")
-                self.model.labels.setStringList(self.model.labels.stringList() + [label_text])
-            else:
-                pass
-        annotation.label = label_text
-        annotation.annotation_changed.emit(annotation)
-
-    # def startDrag(self, supportedActions: typing.Union[QtCore.Qt.DropActions, QtCore.Qt.DropAction]) -> None:
-    #     print(f"Drag start with {len(self.selectedItems())} items")
-    #     super().startDrag(supportedActions)
-    #
-    # def dropEvent(self, event: QtGui.QDropEvent) -> None:
-    #     item = self.itemAt(event.pos())
-    #     if item.parent():
-    #         item = item.parent()
-    #     print(f"Drop at {item.text(0)}")
-    #     super().dropEvent(event)
-
-    def update_annotation_label(self, label, annotation: Annotation):
-        logging.debug(f"Change annotation label from {annotation.label} to {label}")
-        annotation.label = label
-        annotation.annotation_changed.emit(annotation)
+    def select_annotations(self, rows: np.ndarray):
+        for row in rows.tolist():
+            index = self.tree_model.get_annotation_index(row)
+            if index.isValid():
+                self.setExpanded(index, bool(self.model.annotations.columns["selected"][row]))
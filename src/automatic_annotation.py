@@ -13,6 +13,7 @@ from automatic_annotation_dialog import AutomaticAnnotationDialog
 from automatic_annotation_parameters_dialog import AutomaticAnnotationParametersDialog
 
 from data_model import DataModel
+from read_ahead import ReadAhead
 from annotation import Annotation, AnnotationSource
 
 
@@ -20,18 +21,82 @@ class AutomaticAnnotationWorker(QtCore.QThread):
 
     detection_signal = QtCore.Signal(float, float, float, float)
 
-    def __init__(self, x, dt, threshold_t, threshold_f):
+    # Number of time chunks (dt) analysed at once
+    BLOCK_CHUNKS = 1024
+    # Number of time chunks shared by consecutive blocks. Bursts shorter than half of it are found whole in one block,
+    # even when they cross a block boundary.
+    OVERLAP_CHUNKS = 128
+    # Memory (bytes) of the blocks read by the normalization pass kept for the detection pass
+    CACHE_BYTES = 2**28
+
+    def __init__(self, model: DataModel, dt, threshold_t, threshold_f):
 
         super().__init__()
 
-        self.x = x
+        self.model = model
         self.dt = dt
         self.threshold_t = threshold_t
         self.threshold_f = threshold_f
 
+        # Sample index of the block being analysed
+        self.block_offset = 0
+        # Detections starting in [owned_start, owned_stop) belong to the block being analysed, the others are found
+        # (whole) by the neighbouring block
+        self.owned_start = 0
+        self.owned_stop = 0
+
     def run(self) -> None:
 
-        analyse.time_segmentation(self.x,
+        block_size = self.BLOCK_CHUNKS * self.dt
+        overlap = self.OVERLAP_CHUNKS * self.dt
+        sample_count = self.model.get_sample_count()
+
+        # Blocks are read ahead while the previous block is analysed
+        with ReadAhead(self.model) as reader:
+            # Data needs to be normalized (look up documentation), the mean amplitude is accumulated block by block.
+            # The first blocks are kept, the detection pass only reads the blocks that did not fit in memory.
+            amplitude_sum = 0.0
+            cached_blocks = []
+            cached_bytes = 0
+            uncached_offset = None
+            for offset, block in reader.iter_blocks(block_size, overlap):
+                # Samples shared with the previous block are counted once
+                amplitude_sum += np.sum(np.abs(block[overlap if offset > 0 else 0:]))
+
+                if uncached_offset is None and cached_bytes + block.nbytes <= self.CACHE_BYTES:
+                    cached_blocks.append((offset, block))
+                    cached_bytes += block.nbytes
+                elif uncached_offset is None:
+                    uncached_offset = offset
+
+                if self.isInterruptionRequested():
+                    return
+            scale = amplitude_sum / sample_count
+
+            for offset, block in cached_blocks:
+                self.analyse_block(offset, block / scale, block_size, overlap, sample_count)
+                if self.isInterruptionRequested():
+                    return
+            del cached_blocks
+
+            if uncached_offset is None:
+                return
+
+            for offset, block in reader.iter_blocks(block_size, overlap, uncached_offset):
+                self.analyse_block(offset, block / scale, block_size, overlap, sample_count)
+                if self.isInterruptionRequested():
+                    return
+
+    def analyse_block(self, offset: int, block: np.ndarray, block_size: int, overlap: int, sample_count: int):
+        """
+        Detects the bursts of a normalized block
+        Consecutive blocks share overlap samples, the detections are split between them at the middle of the overlap.
+        """
+        self.block_offset = offset
+        self.owned_start = offset + overlap // 2 if offset > 0 else 0
+        self.owned_stop = offset + block_size - overlap // 2 if offset + len(block) < sample_count else sample_count
+
+        analyse.time_segmentation(block,
                                   self.dt,
                                   self.threshold_t,
                                   self.threshold_f,
@@ -40,8 +105,13 @@ class AutomaticAnnotationWorker(QtCore.QThread):
 
     def detection_callback(self, x_chunks: np.ndarray, start_sample: int, det: detection.Detection) -> None:
         # self.sleep(1)
-        self.detection_signal.emit(det.start_sample,
-                                   det.end_sample,
+        # Detection samples are relative to the analysed block
+        if not self.owned_start <= self.block_offset + det.start_sample < self.owned_stop:
+            # Found (whole) by the neighbouring block
+            return
+
+        self.detection_signal.emit(self.block_offset + det.start_sample,
+                                   self.block_offset + det.end_sample,
                                    det.get_last_lfreq(),
                                    det.get_last_hfreq())
 
@@ -50,6 +120,9 @@ class AutomaticAnnotation(QtCore.QObject):
 
     automatic_annotation_detected = QtCore.Signal(object)
 
+    # Delay (ms) during which accepted detections are collected and added to the model at once
+    ADD_DELAY = 100
+
     def __init__(self, model: DataModel, parent=None):
         super(AutomaticAnnotation, self).__init__()
 
@@ -61,6 +134,13 @@ class AutomaticAnnotation(QtCore.QObject):
         self.automatic_annotation_dialog = AutomaticAnnotationDialog(parent=parent, model=model)
 
         self.automatic_annotation_dialog.cancel_automatic_annotation_signal.connect(self.stop_automatic_annotation)
+
+        # Detections found after all annotations have been accepted, added to the model in batches
+        self.accepted_annotations = []
+        self.add_timer = QtCore.QTimer(self)
+        self.add_timer.setSingleShot(True)
+        self.add_timer.setInterval(self.ADD_DELAY)
+        self.add_timer.timeout.connect(self.add_accepted_annotations)
         # self.automatic_annotation_dialog.accept_all_automatic_annotation.connect()
 
     def configure_automatic_annotation(self):
@@ -70,13 +150,8 @@ class AutomaticAnnotation(QtCore.QObject):
 
     def start_automatic_annotation(self):
 
-        # TODO: Optimization for huge
-        data = self.model.read_samples()
-        # Data needs to be normalized (look up documentation)
-        data = data/np.mean(np.abs(data))
-
         # Initialize worker with automatic annotation parameters
-        self.worker = AutomaticAnnotationWorker(data,
+        self.worker = AutomaticAnnotationWorker(self.model,
                                                 self.automatic_annotation_parameters.dt,
                                                 self.automatic_annotation_parameters.threshold_t,
                                                 self.automatic_annotation_parameters.threshold_f)
@@ -95,6 +170,7 @@ class AutomaticAnnotation(QtCore.QObject):
 
     @QtCore.Slot()
     def worker_finished(self):
+        self.add_accepted_annotations()
         # Inform the automatic annotation dialog that the process has finished
         self.automatic_annotation_dialog.automatic_annotation_detection_finished()
 
@@ -116,16 +192,24 @@ class AutomaticAnnotation(QtCore.QObject):
                                           comment="Automatic annotation")
 
         if self.automatic_annotation_dialog.result() == QtWidgets.QDialog.Accepted:
-            # Add annotation to the model
-            self.model.add_annotation(automatic_annotation)
+            # Add annotation to the model with the next batch
+            self.accepted_annotations.append(automatic_annotation)
+            if not self.add_timer.isActive():
+                self.add_timer.start()
         else:
             # Add annotation to the automatic annotation dialog
             self.automatic_annotation_dialog.add_annotation(automatic_annotation)
 
+    @QtCore.Slot()
+    def add_accepted_annotations(self):
+        self.add_timer.stop()
+        annotations, self.accepted_annotations = self.accepted_annotations, []
+        self.model.add_annotations(annotations)
+
     @QtCore.Slot()
     def stop_automatic_annotation(self):
         if self.worker.isRunning():
             logging.info("Automatic annotation canceled  (worker that was running)")
-            self.worker.quit()
+            self.worker.requestInterruption()
         else:
             logging.info("Automatic annotation canceled")
@@ -241,8 +241,7 @@ class AutomaticAnnotationDialog(QtWidgets.QDialog):
     @QtCore.Slot()
     def accept_all_annotations(self):
         logging.debug(f"Accept all automatic annotation")
-        for annotation_idx in range(self.current_annotation_index, len(self.automatic_annotations)):
-            self.model.add_annotation(self.automatic_annotations[annotation_idx])
+        self.model.add_annotations(self.automatic_annotations[self.current_annotation_index:])
         self.accept()
         # self.clean_up()
 
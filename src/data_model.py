@@ -1,30 +1,51 @@
 import logging
+import threading
 
 import numpy as np
 
 from pyqtgraph.Qt import QtCore
 
 from annotation import Annotation
+from annotation_store import AnnotationStore
 from labels_model import LabelsModel
 from groups_model import GroupsModel
+from read_ahead import ReadAhead
 
 class DataModel(QtCore.QObject):
 
-    annotation_added = QtCore.Signal(object)
-    annotation_removed = QtCore.Signal(object)
+    # Lists of annotations added, removed or changed at once
+    annotations_added = QtCore.Signal(list)
+    annotations_removed = QtCore.Signal(list)
+    annotations_changed = QtCore.Signal(list)
     modified_status = QtCore.Signal(bool)
+    # Previous and new sample count, emitted when samples are appended to a capture still being written
+    samples_appended = QtCore.Signal(int, int)
+
+    # Number of samples read at once when exporting annotations
+    EXPORT_BLOCK_SIZE = 2**20
+
+    # Number of samples converted at once (intermediates stay in cache)
+    CONVERT_CHUNK_SIZE = 2**16
 
     def __init__(self):
         # Initalize base class
         super(DataModel, self).__init__()
         # Modified status of the file
         self._modified = False
-        # Annotation list, default empty
-        self.annotations = []
+        # Annotations (columns and time-frequency index), default empty
+        self.annotations = AnnotationStore()
 
         self.labels = LabelsModel([])
         self.groups = GroupsModel([])
 
+        # read_samples, read_time and iter_blocks return complex64 samples, integer captures are converted (and
+        # scaled to [-1.0, 1.0) with autoscale)
+        self.autoscale = True
+
+        # Serializes the reads of the underlying data (e.g. DigitalRF readers are not thread safe), spectrogram tasks
+        # read the model from worker threads. Reentrant, reads call other reading methods.
+        self.read_lock = threading.RLock()
+
     def get_sample_rate(self):
         """Abstract method
         Returns the sample rate of the data
@@ -46,12 +67,105 @@ class DataModel(QtCore.QObject):
         #TODO Sample count should return the total sample count per dimension (capture, channel)?
         raise NotImplementedError
 
+    def get_cache_path(self):
+        """Abstract method
+        Returns the folder, next to the data, where derived data (e.g. spectrogram tiles) is stored
+        :return: Cache folder path
+        """
+        raise NotImplementedError
+
+    def convert_samples(self, samples: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Converts samples in the storage format to complex64
+        Complex64 samples are returned as they are (no copy), otherwise they are converted and
+        scaled chunk by chunk into a single preallocated buffer.
+        :param samples: Complex or real samples, (I, Q) pairs with shape (count, 2) or (r, i) records
+        :param out: Preallocated complex64 buffer with shape (count,), None to allocate
+        :return: Converted samples
+        """
+        samples = np.asarray(samples)
+
+        if samples.dtype.names:
+            # (r, i) records, viewed as (I, Q) pairs
+            samples = samples.view(samples.dtype[0]).reshape(-1, 2)
+
+        if samples.dtype == np.complex64:
+            return samples
+
+        count = samples.shape[0]
+        if out is None:
+            out = np.empty(count, dtype=np.complex64)
+        components = out.view(np.float32).reshape(count, 2)
+
+        is_pairs = samples.ndim == 2
+        scale = None
+        offset = 0
+
+        if self.autoscale and samples.dtype.kind in 'iu':
+            bits = samples.dtype.itemsize * 8
+            scale = np.float32(2.0 ** -(bits - 1))
+            offset = 2 ** (bits - 1) if samples.dtype.kind == 'u' else 0
+
+        for first in range(0, count, self.CONVERT_CHUNK_SIZE):
+            last = min(first + self.CONVERT_CHUNK_SIZE, count)
+
+            if samples.dtype.kind == 'c':
+                out[first:last] = samples[first:last]
+                continue
+
+            if is_pairs:
+                target = components[first:last]
+            else:
+                # Real samples
+                target = components[first:last, 0]
+                components[first:last, 1] = 0
+
+            target[...] = samples[first:last]
+            if offset:
+                target -= offset
+            if scale is not None:
+                target *= scale
+
+        return out
+
     def read_samples(self, start=0, count=None):
         raise NotImplementedError
 
     def read_time(self, start=0, length=None):
         raise NotImplementedError
 
+    def iter_blocks(self, block_size: int, overlap: int = 0, start: int = 0, stop: int = None):
+        """
+        Iterates over the samples in blocks of fixed size, only one block is held in memory at a time
+        :param block_size: Number of samples of each block (the last block might be shorter)
+        :param overlap: Number of samples shared by consecutive blocks
+        :param start: First sample index
+        :param stop: Last sample index (excluded), None until the end of the data
+        :return: Generator of (offset, block) tuples, where offset is the sample index of the first sample of block
+        """
+        if overlap >= block_size:
+            raise ValueError(f"Block overlap ({overlap}) must be smaller than block size ({block_size})")
+
+        stop = self.get_sample_count() if stop is None else min(stop, self.get_sample_count())
+
+        for offset in self._block_offsets(block_size, overlap, start, stop):
+            # read_samples takes the read lock
+            yield offset, self.read_samples(offset, min(block_size, stop - offset))
+
+    @staticmethod
+    def _block_offsets(block_size: int, overlap: int, start: int, stop: int):
+        """
+        Returns the offset of each block when iterating from start to stop
+        """
+        step = block_size - overlap
+        offset = start
+        while offset < stop:
+            yield offset
+            if offset + block_size >= stop:
+                # Last block reached the end
+                break
+            offset += step
+
     def save(self, file: None):
         raise NotImplementedError
 
@@ -64,10 +178,10 @@ class DataModel(QtCore.QObject):
         return self.annotations[idx]
 
     def get_selected_annotations(self):
-        return [a for a in self.annotations if a.selected]
+        return self._get_proxies(self.annotations.get_selected_rows())
 
     def get_selected_annotation_count(self):
-        return len(self.get_selected_annotations())
+        return len(self.annotations.get_selected_rows())
 
     def get_annotation_idx(self, annotation: Annotation) -> int:
         """
@@ -75,7 +189,7 @@ class DataModel(QtCore.QObject):
         :param annotation:
         :return:
         """
-        return self.annotations.index(annotation)
+        return self.annotations.get_position(annotation)
 
     def annotation_count(self):
         """
@@ -84,32 +198,84 @@ class DataModel(QtCore.QObject):
         """
         return len(self.annotations)
 
+    def _get_proxies(self, rows) -> list:
+        return [self.annotations.proxy(int(row)) for row in rows]
+
+    def get_annotations_in(self, start: float, end: float, low: float = None, high: float = None) -> list:
+        """
+        Returns the annotations intersecting a time-frequency window (e.g. the visible area of a view)
+        :param start: Window start time
+        :param end: Window end time
+        :param low: Window lowest frequency (None for no limit)
+        :param high: Window highest frequency (None for no limit)
+        :return: List of annotations
+        """
+        return self._get_proxies(self.annotations.index.query(start, end, low, high))
+
+    def get_duplicated_annotations(self, annotation: Annotation) -> list:
+        """
+        Returns the annotations of the model with the same time and frequency bounds as an annotation
+        """
+        bounds = self.annotations.get_annotation_bounds(annotation)
+        return self._get_proxies(self.annotations.index.duplicates(bounds, exclude=annotation.row))
+
+    def get_overlapping_annotations(self, annotation: Annotation) -> list:
+        """
+        Returns the annotations of the model sharing some time-frequency area with an annotation
+        """
+        bounds = self.annotations.get_annotation_bounds(annotation)
+        return self._get_proxies(self.annotations.index.overlaps(bounds, exclude=annotation.row))
+
+    def get_nearest_annotations(self, annotation: Annotation, count: int = 1) -> list:
+        """
+        Returns the annotations of the model closest to an annotation
+        Time and frequency gaps are compared relative to the capture duration and the sample rate, as in the
+        spectrogram.
+        :param annotation: Reference annotation
+        :param count: Maximum number of annotations
+        :return: List of annotations sorted by distance
+        """
+        bounds = self.annotations.get_annotation_bounds(annotation)
+        frequency_scale = self.sample_to_time(self.get_sample_count()) / self.get_sample_rate()
+        return self._get_proxies(self.annotations.index.nearest(bounds, count, frequency_scale,
+                                                                exclude=annotation.row))
+
     def add_annotation(self, annotation: Annotation) -> None:
         """ Add the annotation to the model
         :param annotation: Annotation to be added
         :return:
         """
-        annotation_rect = QtCore.QRectF(annotation.start, annotation.low, annotation.length, annotation.high)
+        self.add_annotations([annotation])
 
-        for ma in self.annotations:
-            model_annotation_rect = QtCore.QRectF(ma.start, ma.low, ma.length, ma.high)
+    def add_annotations(self, annotations: list) -> None:
+        """
+        Adds annotations to the model, a single annotations_added signal is emitted
+        :param annotations: Annotations to be added
+        """
+        if not annotations:
+            return
 
-            if annotation_rect == model_annotation_rect:
+        for annotation in annotations:
+            if len(self.annotations.index.duplicates(self.annotations.get_annotation_bounds(annotation))):
                 logging.warning("Adding duplicated annotation to model is not valid")
                 # raise ValueError("Duplicated annotation")
 
-        # Add annotation to the list
-        self.annotations.append(annotation)
+        # Add annotations to the store, each annotation becomes the proxy of its row
+        self.annotations.append_many(annotations)
 
-        # Signal that a new annotation has been added
-        self.annotation_added.emit(annotation)
+        # Signal that new annotations have been added
+        self.annotations_added.emit(list(annotations))
 
         self._modified = True
 
     def export_annotations(self, annotation: Annotation, file: str):
+        start = self.time_to_sample(annotation.start)
+        stop = start + self.time_to_sample(annotation.length)
         try:
-            annotation_data = self.read_time(annotation.start, annotation.length)
-            annotation_data.tofile(file)
+            # The next block is read while the current one is written
+            with open(file, 'wb') as export_file, ReadAhead(self) as reader:
+                for _, annotation_data in reader.iter_blocks(self.EXPORT_BLOCK_SIZE, start=start, stop=stop):
+                    annotation_data.tofile(export_file)
         except Exception as export_error:
             logging.error(f"Error export annotation {export_error}")
         else:
@@ -118,9 +284,7 @@ class DataModel(QtCore.QObject):
     # TODO: Check if this the correct place to put selected annotation functionality
 
     def remove_selected_annotations(self):
-        for selected_annotation in self.get_selected_annotations():
-            self.remove_annotation(selected_annotation)
-            self._modified = True
+        self.remove_annotations(self.get_selected_annotations())
 
     def merge_selected_annotations(self):
         selected_annotation = self.get_selected_annotations()
@@ -134,11 +298,57 @@ class DataModel(QtCore.QObject):
         :param annotation: Annotation to be removed
         :return:
         """
-        # Remove annotation to the list
-        self.annotations.remove(annotation)
-        self.annotation_removed.emit(annotation)
+        self.remove_annotations([annotation])
+
+    def remove_annotations(self, annotations: list) -> None:
+        """
+        Removes annotations from the model, a single annotations_removed signal is emitted
+        :param annotations: Annotations to be removed
+        """
+        if not annotations:
+            return
+
+        if any(annotation.store is not self.annotations for annotation in annotations):
+            raise ValueError("Annotation is not in the model")
+
+        # Remove annotations from the store, the annotations get their fields back
+        self.annotations.remove_many([annotation.row for annotation in annotations])
+        self.annotations_removed.emit(list(annotations))
         self._modified = True
 
+    def update_annotations(self, annotations: list, **fields) -> None:
+        """
+        Sets fields of annotations of the model, a single annotations_changed signal is emitted
+        The annotation_changed signal of each annotation is not emitted, views handle annotations_changed instead.
+        :param annotations: Annotations to be updated
+        :param fields: Value of each field (e.g. group="burst"), same value for every annotation or list with a value
+        per annotation
+        """
+        if not annotations:
+            return
+
+        if any(annotation.store is not self.annotations for annotation in annotations):
+            raise ValueError("Annotation is not in the model")
+
+        self.annotations.set_fields([annotation.row for annotation in annotations], **fields)
+        self.annotations_changed.emit(list(annotations))
+        self._modified = True
+
+    def time_span_to_samples(self, start=0, length=None):
+        """
+        Gets the samples read by read_time (in read_samples indices), so that read-ahead wrappers read the same ones
+        :param start: Start time mark
+        :param length: Length in seconds, None until the end of the data
+        :return: Tuple (first sample index, sample count)
+        """
+        start_sample = self.time_to_sample(start)
+        if length:
+            count = min(self.time_to_sample(length), self.get_sample_count() - start_sample)
+        else:
+            count = self.get_sample_count() - start_sample
+
+        return start_sample, count
+
     def time_to_sample(self, time: float) -> int:
         """
         Gets the sample index of a time mark
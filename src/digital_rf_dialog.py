@@ -38,8 +38,7 @@ class DigitalRFDialog(QtWidgets.QDialog):
         self.ui.digitalrf_dialog_label_sampling_rate_value.setText(f"{self.model.get_sample_rate()} Hz")
         self.ui.digitalrf_dialog_label_num_samples_value.setText(f"{self.model.get_sample_count()} samples")
 
-        # Not the best way to access these properties
-        channel_properties = self.model.digitalrf_data.get_properties(self.model.get_channel())
+        channel_properties = self.model.properties
 
         if channel_properties['is_continuous']:
             self.ui.digitalrf_dialog_checkbox_continous.setCheckState(QtCore.Qt.CheckState.Checked)
@@ -0,0 +1,281 @@
+import hashlib
+import logging
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+
+import digital_rf as drf
+from digital_rf import list_drf
+
+
+def directory_signature(channel_path) -> str:
+    """
+    Cheap signature of the files of a DigitalRF channel
+    Only the channel folder is listed: the modification time of each subdirectory changes when data files are added,
+    renamed (the writer renames temporary files when complete) or removed, no data file is opened or listed.
+    :param channel_path: Channel folder
+    :return: Signature string
+    """
+    entries = []
+    with os.scandir(channel_path) as scan:
+        for entry in scan:
+            if entry.is_dir() and re.fullmatch(list_drf.RE_SUBDIR, entry.name):
+                entries.append(f"{entry.name}:{entry.stat().st_mtime_ns}")
+
+    return hashlib.sha1("\n".join(sorted(entries)).encode()).hexdigest()
+
+
+class ContinuousBlockIndex:
+    """
+    Index of the continuous blocks of a DigitalRF channel.
+
+    DigitalRF channels may have gaps (dropouts) between continuous blocks of samples. The index is built from
+    DigitalRFReader.get_continuous_blocks (file metadata only, no samples are read) and maps the sample offsets used by
+    the model to channel sample indexes according to a gap policy:
+    - FILL_ZEROS / FILL_NAN: model samples cover the whole channel bounds, gaps are read as zeros or NaN
+    - SKIP: model samples are the concatenation of the continuous blocks, gaps are removed
+
+    Reads only touch the blocks intersecting the requested range, so a long channel is read in bounded chunks.
+
+    Finding the bounds and blocks opens every data file of the channel, so the result of the scan is persisted in an
+    index file and reused while the directory signature of the channel does not change.
+    """
+
+    FILL_ZEROS = "zeros"
+    FILL_NAN = "nan"
+    SKIP = "skip"
+
+    POLICIES = (FILL_ZEROS, FILL_NAN, SKIP)
+
+    def __init__(self, reader: drf.DigitalRFReader, channel: str, sub_channel: int = 0, policy: str = FILL_ZEROS,
+                 properties: dict = None, channel_path: Path = None, index_file: Path = None):
+        """
+        :param reader: DigitalRF reader
+        :param channel: Channel name
+        :param sub_channel: Sub channel index
+        :param policy: Gap policy (FILL_ZEROS, FILL_NAN or SKIP)
+        :param properties: Channel properties (None to read them)
+        :param channel_path: Channel folder used to detect changes (None to always scan)
+        :param index_file: File where the scan is persisted (None to always scan)
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown gap policy {policy}")
+
+        self.reader = reader
+        self.channel = channel
+        self.sub_channel = sub_channel
+        self.policy = policy
+        self.channel_path = channel_path
+
+        properties = properties or reader.get_properties(channel)
+        self.sample_rate = properties["sample_rate_numerator"] / properties["sample_rate_denominator"]
+
+        self.index_file = index_file
+        self.signature = directory_signature(channel_path) if channel_path else None
+
+        if not self._load(index_file):
+            self._scan()
+            self._save(index_file)
+
+        self._update_offsets()
+
+        if len(self.block_starts) > 1:
+            logging.info(f"DigitalRF channel {channel} has {len(self.block_starts) - 1} gaps, "
+                         f"using gap policy {policy}")
+
+    def _update_offsets(self):
+        if self.policy == self.SKIP:
+            # Model offset of each block (and the end of the last one)
+            self.block_offsets = np.concatenate(([0], np.cumsum(self.block_lengths)))
+        else:
+            self.block_offsets = self.block_starts - self.first_index
+
+    def extend(self, last_index: int) -> bool:
+        """
+        Adds the samples written after the indexed bounds (only the new files are scanned)
+        :param last_index: New last (included) channel sample index
+        :return: True if the index grew
+        """
+        if last_index is None or last_index <= self.last_index:
+            return False
+
+        blocks = self.reader.get_continuous_blocks(self.last_index + 1, last_index, self.channel)
+        block_starts = np.fromiter(blocks.keys(), dtype=np.int64, count=len(blocks))
+        block_lengths = np.fromiter(blocks.values(), dtype=np.int64, count=len(blocks))
+
+        if len(block_starts) and len(self.block_starts) and \
+                block_starts[0] == self.block_starts[-1] + self.block_lengths[-1]:
+            # The new samples continue the last block
+            self.block_lengths = self.block_lengths.copy()
+            self.block_lengths[-1] += block_lengths[0]
+            block_starts, block_lengths = block_starts[1:], block_lengths[1:]
+
+        self.block_starts = np.concatenate((self.block_starts, block_starts))
+        self.block_lengths = np.concatenate((self.block_lengths, block_lengths))
+        self.last_index = last_index
+        self._update_offsets()
+
+        if self.channel_path:
+            self.signature = directory_signature(self.channel_path)
+            self._save(self.index_file)
+
+        return True
+
+    def _scan(self):
+        """
+        Finds the channel bounds and continuous blocks (opens the data files)
+        """
+        # Channel bounds (last sample included)
+        self.first_index, self.last_index = self.reader.get_bounds(self.channel)
+
+        blocks = self.reader.get_continuous_blocks(self.first_index, self.last_index, self.channel)
+        # Channel sample index and length of each continuous block
+        self.block_starts = np.fromiter(blocks.keys(), dtype=np.int64, count=len(blocks))
+        self.block_lengths = np.fromiter(blocks.values(), dtype=np.int64, count=len(blocks))
+
+    def _load(self, index_file: Path) -> bool:
+        """
+        Loads a persisted scan if the channel files did not change
+        :return: True if loaded
+        """
+        if index_file is None or self.signature is None:
+            return False
+
+        try:
+            with np.load(index_file) as index:
+                if str(index["signature"]) != self.signature or str(index["channel"]) != self.channel:
+                    logging.info(f"DigitalRF index {index_file} is outdated")
+                    return False
+                self.first_index, self.last_index = (int(bound) for bound in index["bounds"])
+                self.block_starts = index["block_starts"]
+                self.block_lengths = index["block_lengths"]
+        except (OSError, KeyError, ValueError):
+            return False
+
+        return True
+
+    def _save(self, index_file: Path):
+        if index_file is None or self.signature is None:
+            return
+
+        try:
+            index_file.parent.mkdir(parents=True, exist_ok=True)
+            # Written next to the index and renamed, a reader never sees a partial file
+            temp_file = index_file.with_name(index_file.name + ".tmp")
+            with open(temp_file, 'wb') as index:
+                np.savez(index,
+                         signature=self.signature,
+                         channel=self.channel,
+                         bounds=np.array([self.first_index, self.last_index], dtype=np.int64),
+                         block_starts=self.block_starts,
+                         block_lengths=self.block_lengths)
+            os.replace(temp_file, index_file)
+        except OSError as error:
+            logging.warning(f"DigitalRF index {index_file} could not be saved: {error}")
+
+    def is_outdated(self) -> bool:
+        """
+        Returns True if the channel files changed since the index was built
+        """
+        return self.channel_path is not None and directory_signature(self.channel_path) != self.signature
+
+    @property
+    def sample_count(self) -> int:
+        if self.policy == self.SKIP:
+            return int(self.block_offsets[-1])
+        return int(self.last_index - self.first_index + 1)
+
+    def get_gaps(self):
+        """
+        Returns the gaps between continuous blocks
+        :return: Tuple of arrays (model offset, length in channel samples) of each gap
+        """
+        gap_starts = self.block_starts[:-1] + self.block_lengths[:-1]
+        gap_lengths = self.block_starts[1:] - gap_starts
+        return self.sample_to_index_offset(gap_starts), gap_lengths
+
+    def sample_to_index_offset(self, indexes):
+        """
+        Converts channel sample indexes (outside gaps for SKIP policy) to model sample offsets
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if self.policy != self.SKIP:
+            return indexes - self.first_index
+
+        block = np.clip(np.searchsorted(self.block_starts, indexes, side='right') - 1, 0, len(self.block_starts) - 1)
+        return self.block_offsets[block] + indexes - self.block_starts[block]
+
+    def sample_to_index(self, samples):
+        """
+        Converts model sample offsets to channel sample indexes (vectorized)
+        :param samples: Model sample offset or array of offsets
+        :return: Channel sample indexes
+        """
+        samples = np.asarray(samples, dtype=np.int64)
+        if self.policy != self.SKIP:
+            return samples + self.first_index
+
+        block = np.clip(np.searchsorted(self.block_offsets, samples, side='right') - 1, 0, len(self.block_starts) - 1)
+        return self.block_starts[block] + samples - self.block_offsets[block]
+
+    def sample_to_time(self, samples):
+        """
+        Converts model sample offsets to absolute times (vectorized)
+        :param samples: Model sample offset or array of offsets
+        :return: Seconds since the UNIX epoch of each sample (gaps taken into account)
+        """
+        return self.sample_to_index(samples) / self.sample_rate
+
+    def read(self, start: int, count: int) -> np.ndarray:
+        """
+        Reads samples across gaps
+        :param start: First model sample offset
+        :param count: Number of samples
+        :return: Samples (gaps filled according to the policy)
+        """
+        count = max(min(count, self.sample_count - start), 0)
+
+        # Blocks intersecting the range
+        block_offsets = self.block_offsets[:len(self.block_starts)]
+        first_block = max(np.searchsorted(block_offsets, start, side='right') - 1, 0)
+        last_block = np.searchsorted(block_offsets, start + count, side='left')
+
+        samples = None
+
+        for block in range(first_block, last_block):
+            block_offset = self.block_offsets[block]
+            read_start = max(start, block_offset)
+            read_end = min(start + count, block_offset + self.block_lengths[block])
+            if read_end <= read_start:
+                continue
+
+            index = self.block_starts[block] + read_start - block_offset
+            data = self._read_block(index, read_end - read_start)
+
+            if read_end - read_start == count:
+                # Range inside a continuous block, no copy needed
+                return data
+
+            if samples is None:
+                samples = self._allocate(count, data.dtype)
+            samples[read_start - start:read_end - start] = data
+
+        if samples is None:
+            # The range is a gap
+            samples = self._allocate(count, np.complex64)
+
+        return samples
+
+    def _read_block(self, index: int, count: int) -> np.ndarray:
+        data = self.reader.read(index, index + count - 1, self.channel, self.sub_channel)
+        # The range is inside a continuous block, the reader returns a single block
+        return next(iter(data.values()))
+
+    def _allocate(self, count: int, dtype) -> np.ndarray:
+        if self.policy == self.FILL_NAN:
+            if not np.issubdtype(dtype, np.inexact):
+                raise ValueError(f"Gaps of {dtype} samples cannot be filled with NaN")
+            return np.full(count, np.nan, dtype=dtype)
+        return np.zeros(count, dtype=dtype)
@@ -1,21 +1,46 @@
 import logging
 import digital_rf as drf
+import numpy as np
+
+from PySide6 import QtCore
 
 from data_model import DataModel
-from annotation import Annotation, AnnotationSource
+from digitalrf_blocks import ContinuousBlockIndex
+from annotation import AnnotationSource
+from annotation_journal import AnnotationJournal
 
 import shutil
+import threading
 from pathlib import Path
 
 
 class DigitalRFModel(DataModel):
 
     METADATA_FOLDER = "spectrogram"
-
-    def __init__(self, channel_properties: str, metadata: str = None):
+    CACHE_FOLDER = "spectrogram_cache"
+    # Persisted channel scan (see ContinuousBlockIndex), stored in the cache folder
+    INDEX_FILE = "block_index.npz"
+    # Interval (ms) between checks of the channel bounds in tail mode
+    TAIL_INTERVAL = 1000
+    # Annotation journal stored next to the metadata folder
+    JOURNAL_SUFFIX = "_journal.jsonl"
+    # Number of journal records that triggers a compaction into a new metadata folder
+    COMPACTION_RECORDS = 10000
+    # Complete metadata folders (saved or compacted) are written next to the metadata folder under these suffixes,
+    # then swapped with it. The replaced folder is kept under BACKUP_SUFFIX until the swap is done
+    SAVE_SUFFIX = "_new"
+    COMPACT_SUFFIX = "_compact"
+    BACKUP_SUFFIX = "_bk"
+
+    # Compacted metadata folder and number of journal records it includes (emitted by the compaction thread)
+    compaction_finished = QtCore.Signal(object, int)
+
+    def __init__(self, channel_properties: str, metadata: str = None,
+                 gap_policy: str = ContinuousBlockIndex.FILL_ZEROS):
         """
         :param channel_properties: drf_properties.h5 file (absolute or relative) path
         :param metadata: dmd_properties.h5 file (absolute or relative path)
+        :param gap_policy: How gaps between continuous blocks are read (see ContinuousBlockIndex)
         """
 
         super(DigitalRFModel, self).__init__()
@@ -24,7 +49,29 @@ class DigitalRFModel(DataModel):
         self.digitalrf_data = drf.DigitalRFReader(str(self.channel_path.parent))
         self.channel = self.channel_path.stem
 
+        # Channel properties and sample rate do not change, time conversions do not read the channel
+        self.properties = self.digitalrf_data.get_properties(self.channel)
+        self.sample_rate = int(self.properties["sample_rate_numerator"]/self.properties["sample_rate_denominator"])
+
         self.sub_channel = 0
+        self.gap_policy = gap_policy
+        # Continuous blocks of the channel, built on first access
+        self.block_index = None
+
+        # Tail mode follows a channel that is still being written
+        self.tail_timer = QtCore.QTimer(self)
+        self.tail_timer.setInterval(self.TAIL_INTERVAL)
+        self.tail_timer.timeout.connect(self.poll_tail)
+
+        # Changes since the last save by annotation id (see AnnotationJournal)
+        self.pending_changes = {}
+        self.compaction_thread = None
+        self.compaction_finished.connect(self._compaction_finished)
+
+        self.annotations.annotations_added.connect(self._annotations_added)
+        self.annotations.annotations_removed.connect(self._annotations_removed)
+        self.annotations.annotations_changed.connect(self._annotations_modified)
+
         self.parse_metadata(metadata)
 
     def parse_metadata(self, metadata: str):
@@ -32,6 +79,7 @@ class DigitalRFModel(DataModel):
         if metadata is None:
             # Empty metadata try to use defaults
             # TODO choose metadata precedence between default folders "metadata" and METADATA_FOLDER
+            self._recover_metadata_folder(self.channel_path.joinpath(self.METADATA_FOLDER))
             if self.channel_path.joinpath(self.METADATA_FOLDER).exists():
                 self.metadata_path = self.channel_path.joinpath(self.METADATA_FOLDER)
             else:
@@ -41,46 +89,159 @@ class DigitalRFModel(DataModel):
             self.metadata_path = Path(metadata).resolve().parent
             logging.debug(f"Using metadata folder {self.channel_path}")
 
+        self._recover_metadata_folder(self.metadata_path)
+
         # self.metadata_path = Path(metadata).resolve(strict=True).parent
+        self.labels.reset()
+        self.groups.reset()
+        self.pending_changes = {}
+        # Metadata of each annotation by id
+        values_by_id = {}
+
         try:
             metadata_reader = drf.DigitalMetadataReader(str(self.metadata_path))
         except IOError as error:
             logging.warning(f"Metadata {self.metadata_path} for channel {self.get_channel()} not found")
         else:
-            self.annotations.clear()
-            self.labels.reset()
-            self.groups.reset()
-
             # Get channel boundaries
-            start, end = self.digitalrf_data.get_bounds(self.get_channel())
+            start, end = self.get_bounds()
             # Create an annotation from each read element
             for key, value in metadata_reader.read(start, end).items():
                 # Logging possible errors
                 # if key != self.time_to_sample(value.get('start')):
                 #     logging.warning(f"Mismatch between metadata index ({key}) and annotation start {value.get('start')}")
 
-                # Fixme: Adapt annotation parsing to the right format
-                annotation = Annotation(
-                    source=AnnotationSource.FILE,
-                    start=value.get('start'),
-                    length=value.get('length'),
-                    high=value.get('high'),
-                    low=value.get('low'),
-                    author=value.get('author'),
-                    comment=value.get('comment'),
-                    group=value.get('group', None),
-                    symbol_rate=value.get('symbol_rate'),
-                    confidence=value.get('confidence'),
-                    label=value.get('label', None)
-                )
-                self.annotations.append(annotation)
-
-           # print({a.label for a in self.annotations if a.label})
-            for label in {a.label for a in self.annotations if a.label}:
-                self.labels.add_label(label)
-            # print({a.group for a in self.annotations if a.group}
-            for group in {a.group for a in self.annotations if a.group}:
-                self.groups.add_group(group)
+                # Metadata written before annotation ids were stored get them in reading order
+                values_by_id[value.get('id', len(values_by_id))] = value
+
+        # Changes saved after the metadata folder was written
+        self.journal = AnnotationJournal(self.get_journal_path(self.metadata_path))
+        for record in self.journal.read():
+            if record["op"] == AnnotationJournal.DELETE:
+                values_by_id.pop(record["id"], None)
+            else:
+                values_by_id[record["id"]] = record["data"]
+
+        if self.journal.record_count:
+            logging.debug(f"Replayed {self.journal.record_count} annotation changes from {self.journal.path}")
+
+        self.next_annotation_id = max(values_by_id, default=-1) + 1
+        # Ids of the annotations of the model
+        self.annotation_ids = set(values_by_id)
+
+        # Annotations are loaded into the store columns, no annotation object is created
+        # Fixme: Adapt annotation parsing to the right format
+        values = list(values_by_id.values())
+        self.annotations.reset(self.get_sample_rate())
+        self.annotations.extend(
+            start=self.annotations.to_samples([value.get('start') for value in values]),
+            length=self.annotations.to_samples([value.get('length') for value in values]),
+            high=[self._number(value.get('high')) for value in values],
+            low=[self._number(value.get('low')) for value in values],
+            author=[value.get('author') or None for value in values],
+            comment=[value.get('comment') or None for value in values],
+            group=[value.get('group') or None for value in values],
+            symbol_rate=[self._number(value.get('symbol_rate')) for value in values],
+            confidence=[self._number(value.get('confidence')) for value in values],
+            label=[value.get('label') or None for value in values],
+            source=AnnotationSource.FILE,
+            ids=list(values_by_id.keys())
+        )
+
+        for label in self.annotations.get_used_values("label"):
+            self.labels.add_label(label)
+        for group in self.annotations.get_used_values("group"):
+            self.groups.add_group(group)
+
+    def _recover_metadata_folder(self, metadata_dir: Path):
+        """
+        Finishes or rolls back a metadata folder swap interrupted by a crash (see _swap_metadata_folder). The journal is
+        only rewritten after a swap, its records are then replayed over the new folder
+        :param metadata_dir: Metadata folder
+        """
+        backup_dir = Path(str(metadata_dir) + self.BACKUP_SUFFIX)
+        new_dirs = [Path(str(metadata_dir) + suffix) for suffix in (self.SAVE_SUFFIX, self.COMPACT_SUFFIX)]
+
+        if backup_dir.exists():
+            if not metadata_dir.exists():
+                # Crash between the two renames, the new folder was complete
+                new_dir = next((new_dir for new_dir in new_dirs if new_dir.exists()), None)
+                if new_dir is not None:
+                    logging.warning(f"Finishing interrupted swap of {new_dir} to {metadata_dir}")
+                    new_dir.rename(metadata_dir)
+                else:
+                    logging.warning(f"Restoring {metadata_dir} from {backup_dir}")
+                    backup_dir.rename(metadata_dir)
+            # Crash after the swap, the backup is no longer needed
+            shutil.rmtree(backup_dir, ignore_errors=True)
+
+        if self.compaction_thread is not None and self.compaction_thread.is_alive():
+            return
+
+        # Folders whose writing was interrupted
+        for new_dir in new_dirs:
+            if new_dir.exists():
+                logging.warning(f"Removing incomplete metadata folder {new_dir}")
+                shutil.rmtree(new_dir, ignore_errors=True)
+
+    def _swap_metadata_folder(self, new_dir: Path, metadata_dir: Path):
+        """
+        Replaces a metadata folder by a completely written one. The backup of the old folder only exists while the new
+        folder is complete, so _recover_metadata_folder can finish an interrupted swap on the next open
+        :param new_dir: Complete metadata folder
+        :param metadata_dir: Metadata folder to replace (might not exist)
+        """
+        backup_dir = Path(str(metadata_dir) + self.BACKUP_SUFFIX)
+
+        if metadata_dir.exists():
+            if backup_dir.exists():
+                shutil.rmtree(backup_dir)
+            metadata_dir.rename(backup_dir)
+        new_dir.rename(metadata_dir)
+
+    @staticmethod
+    def _number(value):
+        # Empty metadata fields are read as empty strings
+        return None if value is None or value == "" else float(value)
+
+    def get_journal_path(self, metadata_dir: Path) -> Path:
+        """
+        Returns the annotation journal of a metadata folder (stored next to it)
+        """
+        return metadata_dir.with_name(metadata_dir.name + self.JOURNAL_SUFFIX)
+
+    @QtCore.Slot(object)
+    def _annotations_added(self, rows):
+        ids = self.annotations.columns["id"]
+
+        for row in rows.tolist():
+            annotation_id = int(ids[row])
+            if annotation_id < 0 or annotation_id in self.annotation_ids:
+                annotation_id = ids[row] = self.next_annotation_id
+                self.next_annotation_id += 1
+            self.annotation_ids.add(annotation_id)
+
+            if self.pending_changes.get(annotation_id) == AnnotationJournal.DELETE:
+                self.pending_changes[annotation_id] = AnnotationJournal.MODIFY
+            else:
+                self.pending_changes[annotation_id] = AnnotationJournal.ADD
+
+    @QtCore.Slot(object)
+    def _annotations_removed(self, rows):
+        for annotation_id in self.annotations.columns["id"][rows].tolist():
+            self.annotation_ids.discard(annotation_id)
+
+            if self.pending_changes.get(annotation_id) == AnnotationJournal.ADD:
+                # Never saved
+                del self.pending_changes[annotation_id]
+            else:
+                self.pending_changes[annotation_id] = AnnotationJournal.DELETE
+
+    @QtCore.Slot(object)
+    def _annotations_modified(self, rows):
+        for annotation_id in self.annotations.columns["id"][rows].tolist():
+            self.pending_changes.setdefault(annotation_id, AnnotationJournal.MODIFY)
+        self._modified = True
 
     def get_channels(self):
         return self.digitalrf_data.get_channels()
@@ -92,115 +253,284 @@ class DigitalRFModel(DataModel):
         return self.sub_channel
 
     def set_sub_channel(self, sub_channel: int):
-        properties = self.digitalrf_data.get_properties(self.get_channel())
-        if sub_channel < properties["num_subchannels"]:
+        if sub_channel < self.properties["num_subchannels"]:
             self.sub_channel = sub_channel
+            self.block_index = None
         else:
             raise ValueError(f"Current channel {self.channel} does not have subchannel {sub_channel}")
 
+    def get_gap_policy(self):
+        return self.gap_policy
+
+    def set_gap_policy(self, gap_policy: str):
+        if gap_policy not in ContinuousBlockIndex.POLICIES:
+            raise ValueError(f"Unknown gap policy {gap_policy}")
+        self.gap_policy = gap_policy
+        self.block_index = None
+
+    def get_block_index(self) -> ContinuousBlockIndex:
+        # Built once even when several worker threads need it at the same time
+        with self.read_lock:
+            if self.block_index is None:
+                self.block_index = ContinuousBlockIndex(self.digitalrf_data,
+                                                        self.get_channel(),
+                                                        self.get_sub_channel(),
+                                                        self.gap_policy,
+                                                        self.properties,
+                                                        self.channel_path,
+                                                        self.get_cache_path().joinpath(self.INDEX_FILE))
+            return self.block_index
+
+    def is_tail(self):
+        return self.tail_timer.isActive()
+
+    def set_tail(self, enabled: bool):
+        """
+        Enables or disables the tail mode, in tail mode the channel bounds are polled and samples_appended is emitted
+        when new samples are written
+        """
+        if enabled:
+            self.tail_timer.start()
+        else:
+            self.tail_timer.stop()
+
+    @QtCore.Slot()
+    def poll_tail(self):
+        with self.read_lock:
+            block_index = self.get_block_index()
+            previous_count = block_index.sample_count
+
+            # Only the first and last data files are opened
+            _, last_index = self.digitalrf_data.get_bounds(self.get_channel())
+            extended = block_index.extend(last_index)
+
+        if extended:
+            logging.debug(f"DigitalRF channel {self.channel} grew to {block_index.sample_count} samples")
+            self.samples_appended.emit(previous_count, block_index.sample_count)
+
+    def get_bounds(self):
+        """
+        Returns the first and last (included) channel sample indexes
+        """
+        block_index = self.get_block_index()
+        return block_index.first_index, block_index.last_index
+
+    def refresh(self) -> bool:
+        """
+        Checks whether the channel files changed (cheap listing of the channel folder) and drops the cached index if so
+        :return: True if the channel changed
+        """
+        with self.read_lock:
+            if self.block_index is not None and self.block_index.is_outdated():
+                self.block_index = None
+                return True
+        return False
+
+    def get_cache_path(self):
+        return self.channel_path.joinpath(self.CACHE_FOLDER)
+
     def get_sample_count(self):
-        start, end = self.digitalrf_data.get_bounds(self.get_channel())
-        return end - start
+        return self.get_block_index().sample_count
 
     def get_sample_rate(self):
-        properties = self.digitalrf_data.get_properties(self.get_channel())
-        return int(properties["sample_rate_numerator"]/properties["sample_rate_denominator"])
+        return self.sample_rate
 
     def get_central_frequency(self, idx=None):
         # TODO: Extract the central frequency from wherever is stored
         return 0
 
     def read_samples(self, start=None, count=None):
-        # Read until the end of the file
-        start_sample, end_sample = self.digitalrf_data.get_bounds(self.get_channel())
+        start = start or 0
 
-        if start:
-            read_start = start + start_sample
-        else:
-            read_start = start_sample
+        if count is None:
+            # Read until the end of the channel
+            count = self.get_sample_count() - start
 
-        if count:
-            read_end = read_start + count
-        else:
-            # Read until the end of the file
-            read_end = end_sample
+        with self.read_lock:
+            samples = self.get_block_index().read(start, count)
 
-        samples = self.digitalrf_data.read(read_start, read_end, self.get_channel(), self.get_sub_channel())
+        return self.convert_samples(samples)
 
-        # Get the first (and only) continuous block
-        return next(iter(samples.items()))[1]
+    def iter_blocks(self, block_size: int, overlap: int = 0, start: int = 0, stop: int = None):
+        if overlap >= block_size:
+            raise ValueError(f"Block overlap ({overlap}) must be smaller than block size ({block_size})")
 
-    def read_time(self, start=0, length=None):
+        # Continuous blocks are indexed once for the whole iteration
+        block_index = self.get_block_index()
+        stop = block_index.sample_count if stop is None else min(stop, block_index.sample_count)
 
-        start_sample = self.time_to_sample(start)
+        for offset in self._block_offsets(block_size, overlap, start, stop):
+            # The lock is not held while the caller processes the block
+            with self.read_lock:
+                samples = block_index.read(offset, min(block_size, stop - offset))
+            yield offset, self.convert_samples(samples)
 
-        if length:
-            end_sample = start_sample + self.time_to_sample(length)
-        else:
-            _, end_sample = self.digitalrf_data.get_bounds(self.get_channel())
+    def sample_to_times(self, samples):
+        """
+        Converts sample indexes to absolute times taking gaps into account (vectorized)
+        :param samples: Sample index or array of indexes
+        :return: Seconds since the UNIX epoch
+        """
+        return self.get_block_index().sample_to_time(samples)
 
-        samples = self.read_samples(start_sample, end_sample - start_sample)
+    def read_time(self, start=0, length=None):
+
+        start_sample, count = self.time_span_to_samples(start, length)
+
+        samples = self.read_samples(start_sample, count)
 
         return samples
 
     def save(self, path: str = None):
 
         if path:
-            # Save as
+            # Save as, all the annotations are written to a new metadata folder
             metadata_dir = Path(path)
+            self._write_metadata_folder(metadata_dir, self._metadata_entries())
+            self.metadata_path = metadata_dir
+            self.journal = AnnotationJournal(self.get_journal_path(metadata_dir))
+            self.journal.clear()
+        elif not self.metadata_path.exists():
+            # First save
+            self._write_metadata_folder(self.metadata_path, self._metadata_entries())
+            self.journal.clear()
         else:
-            # Save
-            metadata_dir = self.metadata_path
+            # Save, only the changes since the last save are appended to the journal
+            rows = self.annotations.get_rows()
+            ids = self.annotations.columns["id"][rows]
+            changed = np.isin(ids, list(self.pending_changes))
+            entries = dict(zip(ids[changed].tolist(), self._metadata_entries(rows[changed])))
+
+            records = []
+            for annotation_id, operation in self.pending_changes.items():
+                if operation == AnnotationJournal.DELETE:
+                    records.append({"op": operation, "id": annotation_id})
+                else:
+                    sample, data = entries[annotation_id]
+                    records.append({"op": operation, "id": annotation_id, "sample": sample, "data": data})
+
+            self.journal.append(records)
+            logging.debug(f"Saved {len(records)} annotation changes to {self.journal.path}")
+
+            if self.journal.record_count >= self.COMPACTION_RECORDS:
+                self.compact()
+
+        self.pending_changes.clear()
+        self._modified = False
+
+    def _metadata_entries(self, rows=None):
+        """
+        Returns the channel sample index and the metadata stored for annotations
+        :param rows: Rows of the annotation store, None for all the annotations
+        :return: List of (sample index, metadata) tuples
+        """
+        annotations = self.annotations
+        rows = annotations.get_rows() if rows is None else rows
 
-        # Since we cannot overwrite metadata in then DigitalRF python implementation we need to create a new metadata
-        # every time we need to save it. Therefore we will follow these steps when saving
-        # - We rename old metadata folder to a backup folder
-        # - Create new metadata folder
-        # - Write metadata folder
-        # - If no error, remove backup folder
-        # - If error, restore backup folder
+        # Transform annotation start to channel sample index
+        samples = self.get_block_index().sample_to_index(annotations.columns["start"][rows])
 
-        first_sample_index, last_sample_index = self.digitalrf_data.get_bounds(self.get_channel())
+        entries = []
+        for row, sample in zip(rows, samples.tolist()):
+            data = annotations.to_dict(row)
+            data["id"] = int(annotations.columns["id"][row])
+            entries.append((sample, data))
 
-        try:
-            metadata_backup_dir = Path(str(metadata_dir) + "_bk")
+        return entries
 
-            if metadata_dir.exists():
-                metadata_dir.rename(metadata_backup_dir)
+    def compact(self):
+        """
+        Writes the saved annotations to a new metadata folder in the background, the journal records it includes are
+        removed once it replaces the current folder. Must be called right after a save (no pending changes).
+        """
+        if self.compaction_thread is not None and self.compaction_thread.is_alive():
+            return
+
+        metadata_dir = self.metadata_path
+        compact_dir = Path(str(metadata_dir) + self.COMPACT_SUFFIX)
+        # Snapshot of the saved state, taken in the GUI thread
+        entries = self._metadata_entries()
+        record_count = self.journal.record_count
+
+        def run():
+            try:
+                if compact_dir.exists():
+                    shutil.rmtree(compact_dir)
+                compact_dir.mkdir(parents=False)
+                self._write_metadata(compact_dir, entries)
+            except Exception as error:
+                logging.error(f"Error compacting annotations of {metadata_dir}: {error}")
+                shutil.rmtree(compact_dir, ignore_errors=True)
+            else:
+                self.compaction_finished.emit(compact_dir, record_count)
+
+        logging.info(f"Compacting {record_count} annotation changes into {compact_dir}")
+        self.compaction_thread = threading.Thread(target=run, name="annotation_compaction", daemon=True)
+        self.compaction_thread.start()
+
+    @QtCore.Slot(object, int)
+    def _compaction_finished(self, compact_dir: Path, record_count: int):
+        metadata_dir = Path(str(compact_dir)[:-len(self.COMPACT_SUFFIX)])
+
+        if metadata_dir != self.metadata_path:
+            # Saved somewhere else meanwhile
+            shutil.rmtree(compact_dir, ignore_errors=True)
+            return
 
-            metadata_dir.mkdir(parents=False, exist_ok=True)
+        # Records are replayed idempotently and in order, a crash before the journal rewrite only replays changes
+        # already included in the new folder (the swap is finished on the next open if needed)
+        self._swap_metadata_folder(compact_dir, metadata_dir)
+        self.journal.rewrite(self.journal.read()[record_count:])
+        shutil.rmtree(Path(str(metadata_dir) + self.BACKUP_SUFFIX), ignore_errors=True)
 
-            properties = self.digitalrf_data.get_properties(self.get_channel())
+        logging.info(f"Annotations of {metadata_dir} compacted")
 
-            metadata_writer = drf.DigitalMetadataWriter(
-                metadata_dir=str(metadata_dir),
-                subdir_cadence_secs=properties['subdir_cadence_secs'],
-                # Going from miliseconds in the data to seconds in the metadata
-                file_cadence_secs=max(round(properties['file_cadence_millisecs']/1000), 1),
-                sample_rate_numerator=properties['sample_rate_numerator'],
-                sample_rate_denominator=properties['sample_rate_denominator'],
-                file_name=self.METADATA_FOLDER
-            )
+    def _write_metadata(self, metadata_dir: Path, entries: list):
+        """
+        Writes annotations to an empty metadata folder
+        :param metadata_dir: Metadata folder
+        :param entries: List of (channel sample index, metadata) tuples
+        """
+        properties = self.properties
+
+        metadata_writer = drf.DigitalMetadataWriter(
+            metadata_dir=str(metadata_dir),
+            subdir_cadence_secs=properties['subdir_cadence_secs'],
+            # Going from miliseconds in the data to seconds in the metadata
+            file_cadence_secs=max(round(properties['file_cadence_millisecs']/1000), 1),
+            sample_rate_numerator=properties['sample_rate_numerator'],
+            sample_rate_denominator=properties['sample_rate_denominator'],
+            file_name=self.METADATA_FOLDER
+        )
 
-            for annotation in self.annotations:
-                # Transform annotation time start to sample index
-                annotation_sample_index = self.time_to_sample(annotation.start) + first_sample_index
-                metadata_writer.write(samples=annotation_sample_index, data=annotation.to_dict())
+        for sample, data in entries:
+            metadata_writer.write(samples=sample, data=data)
+
+    def _write_metadata_folder(self, metadata_dir: Path, entries: list):
+
+        # Since we cannot overwrite metadata in then DigitalRF python implementation we need to create a new metadata
+        # every time we need to save it. Therefore we will follow these steps when saving
+        # - Write a new metadata folder next to the old one
+        # - If error, remove the new folder, the old one is untouched
+        # - If no error, swap the new folder with the old one (see _swap_metadata_folder)
+        # - Remove the old folder
+
+        new_dir = Path(str(metadata_dir) + self.SAVE_SUFFIX)
+
+        try:
+            if new_dir.exists():
+                shutil.rmtree(new_dir)
+            new_dir.mkdir(parents=False)
+
+            self._write_metadata(new_dir, entries)
 
         except Exception as error:
-            # Something went wrong Restore backup
-            logging.error(f"Error saving {metadata_dir}, restoring backup folder {metadata_backup_dir}")
-            # Remove current metadata folder
-            if metadata_dir.exists():
-                shutil.rmtree(metadata_dir)
-            # Restore backup if any
-            if metadata_backup_dir.exists():
-                metadata_backup_dir.rename(metadata_dir)
+            # Something went wrong, the old folder is untouched
+            logging.error(f"Error saving {metadata_dir}, removing {new_dir}")
+            shutil.rmtree(new_dir, ignore_errors=True)
             raise
-        else:
-            # No error, clean up backup
-            logging.debug(f"No error saving {metadata_dir}, removing backup folder {metadata_backup_dir}")
-            if metadata_backup_dir.exists():
-                shutil.rmtree(metadata_backup_dir)
-            self.metadata_path = metadata_dir
-            self._modified = False
+
+        self._swap_metadata_folder(new_dir, metadata_dir)
+        # No error, clean up backup
+        logging.debug(f"No error saving {metadata_dir}, removing backup folder")
+        shutil.rmtree(Path(str(metadata_dir) + self.BACKUP_SUFFIX), ignore_errors=True)
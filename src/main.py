@@ -101,6 +101,14 @@ class SpectroGraspMainWindow(QtWidgets.QMainWindow):
         menu_files.addActions([action_save, action_save_as])
         menu_files.addSeparator()
 
+        # Action follow a channel still being written
+        self.action_tail = QtGui.QAction(text="Follow DigitalRF channel", parent=self)
+        self.action_tail.setCheckable(True)
+        self.action_tail.triggered.connect(self._tail_triggered)
+
+        menu_files.addActions([self.action_tail])
+        menu_files.addSeparator()
+
         # Action quit app
         action_quit = QtGui.QAction(text="Quit", parent=self)
         action_quit.triggered.connect(self.close)
@@ -145,11 +153,13 @@ class SpectroGraspMainWindow(QtWidgets.QMainWindow):
         file = QtWidgets.QFileDialog.getOpenFileName(
             dir=self.settings.value('dir/last_sigmf_dir'),
             caption="Select SigMF files",
-            filter="SigMF (*.sigmf)")
+            filter="SigMF (*.sigmf *.sigmf-meta)")
 
         if file[0]:
             logging.debug(f"Opening sigmf file {file[0]}")
 
+            self._stop_tail()
+
             try:
                 self.model = SigMFModel(file[0])
             except Exception as error:
@@ -198,6 +208,8 @@ class SpectroGraspMainWindow(QtWidgets.QMainWindow):
         else:
             self.settings.setValue("dir/last_digitalrf_dir", file[0])
 
+        self._stop_tail()
+
         try:
             self.model = DigitalRFModel(file[0])
         except ValueError as value_error:
@@ -287,6 +299,18 @@ class SpectroGraspMainWindow(QtWidgets.QMainWindow):
         else:
             event.accept()
 
+    def _stop_tail(self):
+        if isinstance(self.model, DigitalRFModel):
+            self.model.set_tail(False)
+        self.action_tail.setChecked(False)
+
+    @QtCore.Slot(bool)
+    def _tail_triggered(self, checked):
+        if isinstance(self.model, DigitalRFModel):
+            self.model.set_tail(checked)
+        else:
+            self.action_tail.setChecked(False)
+
     @QtCore.Slot()
     def _automatic_annotation(self):
         if self.model:
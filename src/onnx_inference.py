@@ -2,11 +2,15 @@ import numpy as np
 
 from PySide6 import QtCore
 from data_model import DataModel
+from read_ahead import ReadAhead
 
 from onnx_model_dialog import ONNXModelDialog
 
 class ONNXInference(QtCore.QObject):
 
+    # Approximate number of samples fed to the model at once
+    INFERENCE_BLOCK_SIZE = 2**20
+
     def __init__(self, model: DataModel, parent=None):
         self.model = model
 
@@ -25,29 +29,58 @@ class ONNXInference(QtCore.QObject):
         inference_output = inference_session.get_outputs()[self.onnx_config.output_index]
 
         inference_input_size = np.prod(inference_input.shape[1:])
+        # Blocks are a multiple of the model input size
+        block_size = max(self.INFERENCE_BLOCK_SIZE // inference_input_size, 1) * inference_input_size
+
+        # Labelled annotations and their labels, the model is updated at once
+        labelled_annotations = []
+        labels = []
+
+        # Annotation samples are read ahead while the model runs
+        with ReadAhead(self.model) as reader:
+            for annotation in self.model.annotations:
+                annotation_start = self.model.time_to_sample(annotation.start)
+                annotation_stop = annotation_start + self.model.time_to_sample(annotation.length)
+
+                inference_sum = 0
+                inference_count = 0
+
+                for _, annotation_data in reader.iter_blocks(block_size,
+                                                             start=annotation_start,
+                                                             stop=annotation_stop):
+
+                    num_input_annotation = annotation_data.shape[0]//inference_input_size
+
+                    if num_input_annotation == 0:
+                        # Not enough samples left for a model input
+                        continue
+
+                    annotation_data = annotation_data[:num_input_annotation*inference_input_size]
 
-        for annotation in self.model.annotations:
-            annotation_data = self.model.read_time(annotation.start, annotation.start + annotation.length)
+                    if np.iscomplexobj(annotation_data):
+                        annotation_data_iq = annotation_data.astype(np.complex64, copy=False).view("(2,)float32")
+                        # Transform complex IQ data
+                        pass
+                    else:
+                        # annotation data in samples format
+                        pass
 
-            num_input_annotation = annotation_data.shape[0]//inference_input_size
+                    annotation_data_iq_reshaped = np.reshape(annotation_data_iq,
+                                                             tuple([-1] + inference_input.shape[1:]))
 
-            annotation_data = annotation_data[:num_input_annotation*inference_input_size]
+                    inference_result = inference_session.run(
+                        [inference_output.name],
+                        {inference_input.name: annotation_data_iq_reshaped}
+                    )[0]
 
-            if np.iscomplexobj(annotation_data):
-                annotation_data_iq = annotation_data.view("(2,)float32")
-                # Transform complex IQ data
-                pass
-            else:
-                # annotation data in samples format
-                pass
+                    inference_sum = inference_sum + np.sum(inference_result, axis=0)
+                    inference_count += inference_result.shape[0]
 
-            annotation_data_iq_reshaped = np.reshape(annotation_data_iq, tuple([-1] + inference_input.shape[1:]))
+                if inference_count == 0:
+                    continue
 
-            inference_result = inference_session.run(
-                [inference_output.name],
-                {inference_input.name: annotation_data_iq_reshaped}
-            )[0]
+                label_idx = np.argmax(inference_sum / inference_count)
+                labelled_annotations.append(annotation)
+                labels.append(self.onnx_config.labels_model.labels[label_idx])
 
-            label_idx = np.argmax(np.mean(inference_result, axis=0))
-            annotation.label = self.onnx_config.labels_model.labels[label_idx]
-            annotation.annotation_changed.emit(annotation)
+        self.model.update_annotations(labelled_annotations, label=labels)
@@ -0,0 +1,153 @@
+import collections
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class ReadAhead:
+    """
+    Read-ahead wrapper for sequential scans of a data model.
+
+    Samples are read by a small I/O thread pool while the caller processes the previous blocks, so computation and
+    disk latency overlap. iter_blocks knows the blocks in advance, read_samples and read_time predict the next range
+    from the access pattern (same count, same stride as the previous request). At most `depth` blocks are in flight
+    or ready at any time.
+
+    Any other attribute is delegated to the wrapped model. Reads of the wrapped model are only done by the I/O
+    threads (one by default, DigitalRF readers are not thread safe).
+
+    Usage:
+        with ReadAhead(model) as reader:
+            for offset, block in reader.iter_blocks(block_size):
+                ...
+    """
+
+    # Number of blocks in flight
+    DEPTH = 4
+    # Number of I/O threads
+    IO_WORKERS = 1
+
+    def __init__(self, model, depth: int = DEPTH, workers: int = IO_WORKERS):
+        """
+        :param model: Data model
+        :param depth: Maximum number of blocks read ahead
+        :param workers: Number of I/O threads, only use more than one if the model reads are thread safe
+        """
+        self.model = model
+        self.depth = max(depth, 1)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="read_ahead")
+
+        # Predicted reads by (start, count)
+        self.pending = collections.OrderedDict()
+        # Start of the previous read_samples request
+        self.last_start = None
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Cancels the reads in flight and stops the I/O threads
+        """
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
+        self.executor.shutdown(wait=True)
+
+    def _read(self, start: int, count: int) -> np.ndarray:
+        samples = self.model.read_samples(start, count)
+
+        if self._is_mapped(samples):
+            # Memory mapped samples are only read from disk when accessed, read them now in the I/O thread
+            samples = np.array(samples, copy=True)
+
+        return samples
+
+    @staticmethod
+    def _is_mapped(samples: np.ndarray) -> bool:
+        """
+        Checks whether an array is a view of a memory map (conversions return plain ndarray views of memmaps)
+        """
+        base = samples
+        while base is not None:
+            if isinstance(base, (np.memmap, mmap.mmap)):
+                return True
+            base = getattr(base, "base", None)
+        return False
+
+    def _submit(self, start: int, count: int):
+        return self.executor.submit(self._read, start, count)
+
+    def read_samples(self, start=0, count=None):
+        start = start or 0
+        if count is None:
+            count = self.model.get_sample_count() - start
+
+        future = self.pending.pop((start, count), None)
+        if future is None:
+            # Not predicted
+            future = self._submit(start, count)
+
+        # Next ranges: same stride as the last two requests or contiguous blocks
+        if self.last_start is not None and start > self.last_start:
+            stride = start - self.last_start
+        else:
+            stride = count
+        self.last_start = start
+
+        sample_count = self.model.get_sample_count()
+        predicted = [(start + stride * index, count) for index in range(1, self.depth + 1)
+                     if start + stride * index < sample_count]
+
+        # Drop the predictions that do not follow the current pattern
+        for key in [key for key in self.pending if key not in predicted]:
+            self.pending.pop(key).cancel()
+
+        for key in predicted:
+            if key not in self.pending:
+                self.pending[key] = self._submit(*key)
+
+        return future.result()
+
+    def read_time(self, start=0, length=None):
+        # Same samples as the model read_time (rounding and clamping of the model)
+        start_sample, count = self.model.time_span_to_samples(start, length)
+        if count <= 0:
+            return self.model.read_time(start, length)
+
+        return self.read_samples(start_sample, count)
+
+    def iter_blocks(self, block_size: int, overlap: int = 0, start: int = 0, stop: int = None):
+        """
+        Same as DataModel.iter_blocks, the following blocks are read while the current one is processed
+        """
+        if overlap >= block_size:
+            raise ValueError(f"Block overlap ({overlap}) must be smaller than block size ({block_size})")
+
+        sample_count = self.model.get_sample_count()
+        stop = sample_count if stop is None else min(stop, sample_count)
+
+        in_flight = collections.deque()
+
+        try:
+            for offset in self.model._block_offsets(block_size, overlap, start, stop):
+                in_flight.append((offset, self._submit(offset, min(block_size, stop - offset))))
+
+                if len(in_flight) > self.depth:
+                    offset, future = in_flight.popleft()
+                    yield offset, future.result()
+
+            while in_flight:
+                offset, future = in_flight.popleft()
+                yield offset, future.result()
+        finally:
+            # Iteration stopped early
+            for _, future in in_flight:
+                future.cancel()
@@ -8,9 +8,12 @@ from matplotlib import pyplot as plt
 import logging
 from typing import Tuple, List, Callable
 from s3re.detection import Detection
+from s3re.channelizer import Channelizer
 import matplotlib.patches as patches
 import operator
 import time
+import functools
+import math
 import multiprocessing
 from joblib import Parallel, delayed
 
@@ -74,9 +77,90 @@ br_lower_bound = 1e-4
 # Peak search region width
 rw = 30
 
+# Largest interpolation factor of the rational resampling ratio used to
+# extract signals (the larger it is, the closer the output rate gets to the
+# signal bandwidth, at the price of longer polyphase filters).
+resampling_max_up = 8
+
+# Half length of the polyphase extraction filter, in number of output samples
+# (per interpolation phase).
+resampling_half_len = 10
+
+
+class NCO:
+    r"""Numerically controlled oscillator, mixes signals by a fixed frequency.
+
+    The oscillator is computed once for a block of samples (complex64) and
+    rotated by the phase reached at the start of each block, so mixing is
+    vectorized and costs a couple of multiplications per sample. The phase is
+    kept across calls: mixing consecutive chunks of a stream gives the same
+    result as mixing the whole stream at once.
+    """
+
+    # Default number of samples of the precomputed oscillator block.
+    block_size = int(2 ** 16)
+
+    def __init__(self, df: float, phase: float = 0.0, block_size: int = None) -> None:
+        r"""Initialize an NCO.
+
+        Parameters
+        ----------
+        df: float
+        frequency of the oscillator (in (-.5, +.5))
+        phase: float
+        initial phase (in cycles)
+        block_size: int
+        number of samples of the oscillator block. If None, the class default
+        is used
+        """
+        if block_size is not None:
+            self.block_size = max(block_size, 1)
+        self.df = df
+        # Phase (in cycles) of the next sample. It is kept in [0, 1) and in
+        # double precision, so it does not drift on long streams.
+        self.phase = phase % 1
+        # Computing the block phases modulo 1 keeps the accuracy of the
+        # complex64 oscillator.
+        k = np.arange(self.block_size)
+        self.block = np.exp(2j * np.pi * ((df * k) % 1)).astype(np.complex64)
+
+    def mix(self, x: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        r"""Mix a chunk of signal with the oscillator, advancing its phase.
+
+        Parameters
+        ----------
+        x: np.ndarray
+        input signal chunk
+        out: np.ndarray
+        output array (complex, same length as x). It can be x itself to mix
+        in place. If None, a new complex64 (or complex128 for double
+        precision inputs) array is allocated
+
+        Returns
+        -------
+        y: np.ndarray
+        frequency-shifted signal chunk
+        """
+        x = np.asarray(x)
+        if out is None:
+            out = np.empty(len(x), dtype=np.result_type(x.dtype, np.complex64))
+
+        for start in range(0, len(x), self.block_size):
+            stop = min(start + self.block_size, len(x))
+            rotation = complex(np.exp(2j * np.pi * self.phase))
+
+            np.multiply(x[start:stop], self.block[:stop - start], out=out[start:stop])
+            out[start:stop] *= rotation
+
+            self.phase = (self.phase + self.df * (stop - start)) % 1
+
+        return out
+
 
 def freq_shift(x: np.ndarray, \
-               df: float) -> np.ndarray:
+               df: float, \
+               nco: NCO = None, \
+               out: np.ndarray = None) -> np.ndarray:
     r"""Frequency-shift a given signal by the desired amount.
 
     Parameters
@@ -85,16 +169,22 @@ def freq_shift(x: np.ndarray, \
     input signal
     df: float
     shift to impose (in (-.5, +.5))
+    nco: NCO
+    oscillator carrying the phase of previous chunks (streaming). If None,
+    the shift starts with a null phase
+    out: np.ndarray
+    output array, can be x itself to shift in place (see NCO.mix)
 
     Returns
     -------
     y: np.ndarray
     frequency-shifted signal
     """
-    xshift = np.array([np.exp(1j * df * 2 * np.pi * k) for k in range(0, len(x))])
-    y = [x[i] * xshift[i] for i in range(0, len(x))]
+    if nco is None:
+        # A single use oscillator does not need a block longer than the signal.
+        nco = NCO(df, block_size=min(NCO.block_size, len(x)))
 
-    return np.asarray(y)
+    return nco.mix(x, out)
 
 
 def extract_signal(x: np.ndarray, lf: float, hf: float,  debug: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray, float]:
@@ -168,10 +258,66 @@ def extract_signal(x: np.ndarray, lf: float, hf: float,  debug: bool = False) ->
     return z, centered_x, h, lp_cfreq
 
 
+@functools.lru_cache(maxsize=256)
+def resampling_ratio(bw: float) -> Tuple[int, int]:
+    r"""Find the rational resampling ratio closest to a bandwidth.
+
+    Parameters
+    ----------
+    bw: float
+    bandwidth of the signal (normalized frequency, in (0, 1])
+
+    Returns
+    -------
+    up: int
+    interpolation factor
+    down: int
+    decimation factor. The output rate up / down is never below bw, so the
+    band is kept whole
+    """
+    up, down = 1, 1
+    for u in range(1, resampling_max_up + 1):
+        d = max(int(np.floor(u / bw)), u)
+        if u / d < up / down:
+            up, down = u, d
+
+    g = math.gcd(up, down)
+    return up // g, down // g
+
+
+@functools.lru_cache(maxsize=64)
+def extraction_filter(lp_cfreq: float, up: int, down: int) -> np.ndarray:
+    r"""Design the low-pass filter of the polyphase band extractor.
+
+    Parameters
+    ----------
+    lp_cfreq: float
+    cut-off frequency (normalized to the input rate)
+    up: int
+    interpolation factor
+    down: int
+    decimation factor
+
+    Returns
+    -------
+    h: np.ndarray
+    filter taps, at the interpolated rate (read-only, it is shared)
+    """
+    ntaps = 2 * resampling_half_len * max(up, down) + 1
+    h = signal.firwin(ntaps, min(lp_cfreq, 0.5 * up / down), window=("kaiser", 5.0), fs=up)
+    h.setflags(write=False)
+
+    return h
+
+
 def extract_signal_with_resampling(x: np.ndarray, lf: float, hf: float, debug: bool = False) -> np.ndarray:
     r"""Extract the signal comprised in the [lf, hf] frequency band,
     appropriately resampling it to match the new bandwidth.
 
+    The band is centered with an NCO, then filtered and decimated in a single
+    polyphase step (the filter is only evaluated at the output samples), with
+    a filter designed once per bandwidth and resampling ratio.
+
     Parameters
     ----------
     x: np.ndarray
@@ -188,14 +334,20 @@ def extract_signal_with_resampling(x: np.ndarray, lf: float, hf: float, debug: b
     y: np.ndarray
     extracted signal
     """
-    z, centered_x, h, lp_cfreq = extract_signal(x, lf, hf, False)
+    # Center the signal, so that the low-pass filter keeps the band.
+    centered_x = freq_shift(x, -(lf + (hf - lf) / 2))
 
-    # Since the signal now occupies a much smaller bw, we can safely resample
-    # it.
+    # Cut-off frequency.
+    lp_cfreq = (hf - lf) / 2
+
+    # Since the signal occupies a much smaller bw, we can safely resample
+    # it (at a rational rate just above its bandwidth).
     resampling_factor = 1.0 / (hf - lf)
+    up, down = resampling_ratio(hf - lf)
 
-    y = signal.resample(z, int(np.ceil(len(z) / resampling_factor)))
-    y[:] = [y[i] * resampling_factor for i in range(0, len(y))]
+    h = extraction_filter(lp_cfreq, up, down)
+    y = signal.resample_poly(centered_x, up, down, window=h)
+    y *= resampling_factor
 
     # If we desire so, display debug information.
     if debug:
@@ -212,12 +364,10 @@ def extract_signal_with_resampling(x: np.ndarray, lf: float, hf: float, debug: b
         plt.subplot(3, 1, 2)
         plt.plot(np.linspace(-.5, .5, nfft),
                  np.abs(fft.fftshift(fft.fft(centered_x, nfft))))
-        plt.plot(np.linspace(-.5, .5, nfft),
-                 np.abs(fft.fftshift(fft.fft(h, nfft))))
         plt.axvline(-lp_cfreq, color="red")
         plt.axvline(0, color="red", ls="--")
         plt.axvline(+lp_cfreq, color="red")
-        plt.legend(["Centered signal", "Filter"])
+        plt.legend(["Centered signal"])
         plt.title("Spectrum of centered signal")
         plt.xlabel("Normalized frequency")
         plt.ylabel("V**2")
@@ -225,11 +375,9 @@ def extract_signal_with_resampling(x: np.ndarray, lf: float, hf: float, debug: b
         plt.subplot(3, 1, 3)
         plt.plot(np.linspace(-.5, .5, nfft),
                  np.abs(fft.fftshift(fft.fft(y, nfft))))
-        plt.plot(np.linspace(-.5, .5, nfft),
-                 np.abs(fft.fftshift(fft.fft(z, nfft))))
-        plt.legend(["Resampled filtered signal", "Filtered signal"])
-        plt.title("Spectrum of filtered and resampled signal")
-        plt.xlabel("Normalized frequency")
+        plt.legend(["Resampled filtered signal"])
+        plt.title("Spectrum of filtered and resampled signal (ratio %d/%d)" % (up, down))
+        plt.xlabel("Normalized frequency (output rate)")
         plt.ylabel("V**2")
 
         plt.show()
@@ -237,7 +385,45 @@ def extract_signal_with_resampling(x: np.ndarray, lf: float, hf: float, debug: b
     return y
 
 
-def freq_segmentation(x_chunks: np.ndarray, threshold_f: float, debug: bool = False) -> list:
+def chunks_psd(x_chunks: np.ndarray) -> np.ndarray:
+    r"""Compute the power spectra of a set of chunks at once, on a logarithmic
+    scale. The result is computed once per block by time_segmentation and
+    handed down to the frequency segmentation and the detection adjustment
+    (row i is the spectrum of chunk i).
+
+    Parameters
+    ----------
+    x_chunks: np.ndarray
+    signal chunks, one per row
+
+    Returns
+    -------
+    Pxx: np.ndarray
+    power spectra (in dB), one per row, with frequency 0 in the middle
+    """
+    dt = x_chunks.shape[-1]
+    f, Pxx = signal.welch(x_chunks,
+                          fs=1.0,
+                          nfft=dt,
+                          return_onesided=False,
+                          scaling="spectrum",
+                          axis=-1)
+    # Move frequency 0 in the middle.
+    Pxx = fft.fftshift(Pxx, axes=-1)
+    # Convert to logarithmic scale. This eases the setting of a threshold (it
+    # would be quite tricky to get the threshold right on a linear scale,
+    # especially to get all the sidelobes). Since we are operating in dB, to
+    # avoid having numerical issues, zeros in the power spectrum are replaced
+    # by an epsilon.
+    np.maximum(Pxx, 1e-12, out=Pxx)
+    np.log10(Pxx, out=Pxx)
+    Pxx *= 10
+
+    return Pxx
+
+
+def freq_segmentation(x_chunks: np.ndarray, threshold_f: float, debug: bool = False,
+                      psd: np.ndarray = None) -> list:
     r"""Detect occupied bands in the power spectral density.
 
     Parameters
@@ -249,6 +435,8 @@ def freq_segmentation(x_chunks: np.ndarray, threshold_f: float, debug: bool = Fa
     signal in the given band
     debug: bool
     activate debug information/plots
+    psd: np.ndarray
+    power spectra of the chunks (see chunks_psd). If None, they are computed
 
     Returns
     -------
@@ -264,21 +452,10 @@ def freq_segmentation(x_chunks: np.ndarray, threshold_f: float, debug: bool = Fa
     # all "holes" or "peaks" in the spectrum up to this width will be
     # ignored.
     deglitch_val = 100 * df
+    if psd is None:
+        psd = chunks_psd(x_chunks)
     for i in range(chunks_no):
-        f, Pxx = signal.welch(x_chunks[i, :],
-                              fs=1.0,
-                              nfft=dt,
-                              return_onesided=False,
-                              scaling="spectrum")
-        # Move frequency 0 in the middle.
-        Pxx = fft.fftshift(Pxx)
-        # Convert to logarithmic scale. This eases the setting of a
-        # threshold (it would be quite tricky to get the threshold right
-        # on a linear scale, especially to get all the sidelobes).
-        np.where(Pxx < 1e-12, 1e-12, Pxx)
-        # Keep a copy for comparison.
-        linear_Pxx = Pxx.copy()
-        Pxx = 10 * np.log10(Pxx)
+        Pxx = psd[i, :]
         # Now adopt the same strategy used in the time domain.
         # At the beginning we are not in a signal.
         in_boi = False
@@ -332,7 +509,7 @@ def freq_segmentation(x_chunks: np.ndarray, threshold_f: float, debug: bool = Fa
             plt.xlabel("Normalized frequency")
             plt.ylabel("Power [dB]")
             plt.subplot(2, 1, 2)
-            plt.plot(np.linspace(-.5, .5, N), linear_Pxx)
+            plt.plot(np.linspace(-.5, .5, N), 10 ** (Pxx / 10))
             for j in range(len(merged_boi)):
                 plt.axvline(merged_boi[j][0], color="red")
                 plt.axvline(merged_boi[j][1], color="red")
@@ -409,7 +586,8 @@ def analyze_chunks(x_chunks: np.ndarray, \
                    end_sample: int, \
                    threshold_f: float, \
                    user_cb: Callable[[np.ndarray, int, Detection], None], \
-                   debug: bool = False) -> None:
+                   debug: bool = False, \
+                   psd: np.ndarray = None) -> None:
     r"""Take the time chunks marked as occupied by a signal and explore their
     spectral occupancy.
 
@@ -429,8 +607,12 @@ def analyze_chunks(x_chunks: np.ndarray, \
     "rectangle" in the spectrogram)
     debug: bool
     activate debug information/plots
+    psd: np.ndarray
+    power spectra of the chunks (see chunks_psd). If None, they are computed
     """
     chunks_no, dt = x_chunks.shape
+    if psd is None:
+        psd = chunks_psd(x_chunks)
     # Frequency step.
     df = 1 / dt
     global detection_id
@@ -446,7 +628,8 @@ def analyze_chunks(x_chunks: np.ndarray, \
     # Retrieve the list of bands in each chunk.
     boi_per_chunk = freq_segmentation(x_chunks,
                                       threshold_f,
-                                      debug)
+                                      debug,
+                                      psd)
     # Now process the list of BOIs for each chunk, merging the adjacent ones
     # and setting the different detections.
     occupied_bands = list()
@@ -556,7 +739,8 @@ def analyze_chunks(x_chunks: np.ndarray, \
                                                                  df,
                                                                  dt,
                                                                  threshold_f,
-                                                                 debug)
+                                                                 debug,
+                                                                 psd)
 
     # Drop detections that are too small (in number of samples).
     to_keep = list()
@@ -629,32 +813,23 @@ def time_segmentation(x: np.ndarray, \
     x = x[0:dt * chunks_no]
     split_x = np.reshape(x, (chunks_no, dt))
 
+    # Power spectra of all the chunks at once (one row per chunk), they are
+    # handed down to the analysis of the chunks marked as occupied. Now get
+    # the max power of each chunk (in a single reduction) and use it to detect
+    # chunks containing signals.
+    psd = chunks_psd(split_x)
+    max_pwrs = np.max(psd, axis=-1)
+
     # At the beginning we are not in a signal
     in_sig = False
     start_idx = 0
-    # Go over the chunks one at a time and check their mean power level.
-    # Since we are operating in dB, to avoid having numerical issues, zeros
-    # in the power spectrum are replaced by an epsilon.
+    # Go over the chunks one at a time and check their power level.
     for i in range(0, chunks_no):
-        f, Pxx = signal.welch(split_x[i, :],
-                              fs=1.0,
-                              nfft=dt,
-                              return_onesided=False,
-                              scaling="spectrum")
-        # Move frequency 0 in the middle.
-        Pxx = fft.fftshift(Pxx)
-        # Convert to logarithmic scale. This eases the setting of a
-        # threshold (it would be quite tricky to get the threshold right
-        # on a linear scale, especially to get all the sidelobes).
-        np.where(Pxx < 1e-12, 1e-12, Pxx)
-        Pxx = 10 * np.log10(Pxx)
         if debug:
-            plt.plot(np.linspace(-.5, .5, dt), Pxx)
+            plt.plot(np.linspace(-.5, .5, dt), psd[i, :])
             plt.title("Power spectrum for chunk " + str(i))
             plt.show()
-        # Now get the max power for the chunk and use it to detect
-        # chunks containing signals.
-        max_pwr = np.max(Pxx)
+        max_pwr = max_pwrs[i]
 
         if not in_sig and max_pwr >= threshold_t:
             in_sig = True
@@ -672,7 +847,8 @@ def time_segmentation(x: np.ndarray, \
                                (i + 1) * dt - 1,
                                threshold_f,
                                user_cb,
-                               debug)
+                               debug,
+                               psd[start_idx:i + 1, :])
 
 
 def adjust_detections(x_chunks: np.ndarray, \
@@ -682,7 +858,8 @@ def adjust_detections(x_chunks: np.ndarray, \
 					  df: float, \
 					  dt: int, \
 					  threshold_f: float, \
-					  debug: bool) -> Tuple[Detection, Detection]:
+					  debug: bool, \
+					  psd: np.ndarray = None) -> Tuple[Detection, Detection]:
 		r"""Fix the issue with neighboring detections getting glued together. In
 		particular, this function avoids that a signal in a neighboring band
 		results in two separate detection in the time domain, with one of the
@@ -708,11 +885,16 @@ def adjust_detections(x_chunks: np.ndarray, \
 		detection threshold in the frequency domain
 		debug: bool
 		activate debug information/plots
+		psd: np.ndarray
+		power spectra of the chunks (see chunks_psd). If None, they are computed
 
 		Returns
 		-------
 		Updated detections.
 		"""
+		if psd is None:
+				psd = chunks_psd(x_chunks)
+
 		# Delta used to detect a difference in the logarithmic plot that marks
 		# the end of a signal
 		sig_end_delta = 10
@@ -766,15 +948,7 @@ def adjust_detections(x_chunks: np.ndarray, \
 		j = d1_start
 		found = False
 		while j < d2_end and found == False:
-				f, Pxx = signal.welch(x_chunks[j, :],
-									  fs=1.0,
-									  nfft=dt,
-									  return_onesided=False,
-									  scaling="spectrum")
-				# Move frequency 0 in the middle.
-				Pxx = fft.fftshift(Pxx)
-				np.where(Pxx < 1e-12, 1e-12, Pxx)
-				Pxx = 10*np.log10(Pxx)
+				Pxx = psd[j, :]
 				if np.mean(Pxx[d2_f_idx_l:d2_f_idx_h]) > threshold_f:
 						found = True
 						d2.start_sample = chunks_start + j*dt
@@ -785,15 +959,7 @@ def adjust_detections(x_chunks: np.ndarray, \
 		j = d1_start
 		found = False
 		while j < d2_end and found == False:
-				f, Pxx = signal.welch(x_chunks[j, :],
-									  fs=1.0,
-									  nfft=dt,
-									  return_onesided=False,
-									  scaling="spectrum")
-				# Move frequency 0 in the middle.
-				Pxx = fft.fftshift(Pxx)
-				np.where(Pxx < 1e-12, 1e-12, Pxx)
-				Pxx = 10*np.log10(Pxx)
+				Pxx = psd[j, :]
 				if np.mean(Pxx[d1_f_idx_l:d1_f_idx_h]) > threshold_f:
 						found = True
 						d1.start_sample = chunks_start + j*dt
@@ -804,15 +970,7 @@ def adjust_detections(x_chunks: np.ndarray, \
 		j = d2_start+1
 		found = False
 		while j < d2_end and found == False:
-				f, Pxx = signal.welch(x_chunks[j, :],
-									  fs=1.0,
-									  nfft=dt,
-									  return_onesided=False,
-									  scaling="spectrum")
-				# Move frequency 0 in the middle.
-				Pxx = fft.fftshift(Pxx)
-				np.where(Pxx < 1e-12, 1e-12, Pxx)
-				Pxx = 10*np.log10(Pxx)
+				Pxx = psd[j, :]
 				if np.mean(Pxx[d2_f_idx_l:d2_f_idx_h]) < threshold_f+sig_end_delta:
 						found = True
 						d2.end_sample = chunks_start + j*dt - 1
@@ -822,15 +980,7 @@ def adjust_detections(x_chunks: np.ndarray, \
 		j = d1_start+1
 		found = False
 		while j < d2_end and found == False:
-				f, Pxx = signal.welch(x_chunks[j, :],
-									  fs=1.0,
-									  nfft=dt,
-									  return_onesided=False,
-									  scaling="spectrum")
-				# Move frequency 0 in the middle.
-				Pxx = fft.fftshift(Pxx)
-				np.where(Pxx < 1e-12, 1e-12, Pxx)
-				Pxx = 10*np.log10(Pxx)
+				Pxx = psd[j, :]
 				if np.mean(Pxx[d1_f_idx_l:d1_f_idx_h]) < threshold_f+sig_end_delta:
 						found = True
 						d1.end_sample = chunks_start + j*dt
@@ -1293,7 +1443,8 @@ def estimate_sr(sig: np.ndarray, samp_rate : float,  debug: bool = False) -> flo
 
 def detection_analysis(x_chunks: np.ndarray, \
 					   start_sample: int, \
-					   det: Detection) -> None:
+					   det: Detection, \
+					   channelizer: Channelizer = None) -> None:
 		r"""Callback function, in charge of analysing each individual detection.
 
 		Parameters
@@ -1305,12 +1456,23 @@ def detection_analysis(x_chunks: np.ndarray, \
 		sample indexes from signal chunks)
 		det: Detection
 		detection to process
+		channelizer: Channelizer
+		channelizer of the chunks, to share between the detections of a block
+		(see detections_analysis). If None, the chunks are channelized for
+		this detection only
 		"""
 		debug = False
 		c_start_idx = int((det.start_sample - start_sample) / dt)
 		c_end_idx = int((det.end_sample+1 - start_sample) / dt)
-		x = x_chunks[c_start_idx:c_end_idx, :].flatten()
-		y, _, _, _ = extract_signal(x.copy(), det.l_freq, det.h_freq, False)
+
+		# The detection is rebuilt from the channels covering its band (at a
+		# rate close to its bandwidth).
+		if channelizer is None:
+				channelizer = Channelizer(x_chunks.flatten())
+		y, rate = channelizer.extract(det.l_freq,
+											det.h_freq,
+											c_start_idx * dt,
+											c_end_idx * dt)
 
 		logging.info("-----------------------------------------------------\n" +
 					 "Detection " + str(det.id) + ":\n" +
@@ -1321,11 +1483,7 @@ def detection_analysis(x_chunks: np.ndarray, \
 					 "\n\tfreq band   = [" + str(det.l_freq) +
 					 ", " + str(det.h_freq) + "]")
 
-		z = extract_signal_with_resampling(x.copy(),
-										   det.l_freq,
-										   det.h_freq,
-										   debug)
-		multicarrier_signal = is_multicarrier(z, debug)
+		multicarrier_signal = is_multicarrier(y, debug)
 
 		# If we just have Gaussian noise in our signal the check above (which
 		# tests the Gaussianity) will return that we have a multicarrier signal.
@@ -1344,5 +1502,27 @@ def detection_analysis(x_chunks: np.ndarray, \
 						logging.debug("\n\tMulti-carrier signal !")
 		else:
 				logging.debug("\n\tSingle-carrier signal !")
-				sr = estimate_sr(y, fs, debug)
+				# Symbol rate normalized to the input rate.
+				sr = estimate_sr(y, rate, debug) * rate
 				logging.debug("######## Estimated symbol rate: " + str(sr))
+
+
+def detections_analysis(x_chunks: np.ndarray, \
+						start_sample: int, \
+						detections: List[Detection]) -> None:
+		r"""Analyse all the detections of a block of chunks. The block is
+		channelized once and the channelizer is shared by the detections.
+
+		Parameters
+		----------
+		x_chunks: np.ndarray
+		chunks of the input signal that we are considering for analysis
+		start_sample: int
+		absolute index of the start sample of the chunk (to de-relativise the
+		sample indexes from signal chunks)
+		detections: List[Detection]
+		detections to process
+		"""
+		channelizer = Channelizer(x_chunks.flatten())
+		for det in detections:
+				detection_analysis(x_chunks, start_sample, det, channelizer)
@@ -0,0 +1,112 @@
+import numpy as np
+from numpy import fft
+from typing import Tuple
+
+
+class Channelizer:
+    r"""Uniform filter bank splitting a block of signal in M sub-bands.
+
+    Channel k covers the normalized frequencies
+    [-.5 + k / M, -.5 + (k + 1) / M). The whole block is transformed with a
+    single FFT, each channel being a contiguous group of bins (the filter bank
+    is implemented by fast convolution rather than with a time-domain
+    polyphase network). A band is rebuilt from the few channels covering it
+    with an inverse FFT of their bins only, so extracting a signal costs in
+    proportion to its bandwidth, whatever the number of signals in the block.
+    """
+
+    # Default number of channels.
+    channels_no = int(2 ** 10)
+
+    def __init__(self, x: np.ndarray, channels_no: int = None) -> None:
+        r"""Split a block of signal in channels.
+
+        Parameters
+        ----------
+        x: np.ndarray
+        input signal block
+        channels_no: int
+        number of channels (M). If None, the class default is used
+        """
+        if channels_no is not None:
+            self.channels_no = channels_no
+        self.length = len(x)
+        # Number of bins of each channel (the block is zero-padded to a
+        # multiple of the number of channels).
+        self.bins_no = int(np.ceil(self.length / self.channels_no))
+        # Spectrum of the block, frequency -.5 first.
+        self.spectrum = fft.fftshift(fft.fft(x, self.bins_no * self.channels_no))
+        # Rising half of the taper applied to the padding channels.
+        k = np.arange(self.bins_no)
+        self.ramp = .5 * (1 - np.cos(np.pi * (k + .5) / self.bins_no))
+
+    def channel_range(self, lf: float, hf: float) -> Tuple[int, int]:
+        r"""Find the channels covering a band.
+
+        Parameters
+        ----------
+        lf: float
+        lowest frequency of the band
+        hf: float
+        highest frequency of the band
+
+        Returns
+        -------
+        first: int
+        first channel
+        last: int
+        last channel (excluded)
+        """
+        first = int(np.floor((lf + .5) * self.channels_no))
+        last = int(np.ceil((hf + .5) * self.channels_no))
+        first = min(max(first, 0), self.channels_no - 1)
+        last = min(max(last, first + 1), self.channels_no)
+
+        return first, last
+
+    def extract(self, lf: float, hf: float, start: int = 0, end: int = None) -> Tuple[np.ndarray, float]:
+        r"""Rebuild the signal of a band from the channels covering it.
+
+        The signal is centered on the middle of the channels and sampled at
+        their aggregate rate. As in extract_signal_with_resampling, its
+        amplitude is scaled by the inverse of this rate.
+
+        Parameters
+        ----------
+        lf: float
+        lowest frequency of the signal of interest
+        hf: float
+        highest frequency of the signal of interest
+        start: int
+        first sample of the signal (at the input rate)
+        end: int
+        last sample of the signal, excluded (at the input rate). If None,
+        the signal goes to the end of the block
+
+        Returns
+        -------
+        y: np.ndarray
+        extracted signal
+        rate: float
+        sampling rate of the extracted signal (normalized to the input
+        rate)
+        """
+        if end is None:
+            end = self.length
+
+        # One more channel on each side (when there is one) holds the
+        # transition band, the channels covering the band are left flat.
+        band_first, band_last = self.channel_range(lf, hf)
+        first = max(band_first - 1, 0)
+        last = min(band_last + 1, self.channels_no)
+
+        bins = self.spectrum[first * self.bins_no:last * self.bins_no].copy()
+        if first < band_first:
+            bins[:self.bins_no] *= self.ramp
+        if last > band_last:
+            bins[-self.bins_no:] *= self.ramp[::-1]
+
+        y = fft.ifft(fft.ifftshift(bins))
+        rate = (last - first) / self.channels_no
+
+        return y[int(np.floor(start * rate)):int(np.ceil(end * rate))], rate
@@ -1,56 +1,73 @@
 import logging
-import math
+import os
+import shutil
+import tarfile
+import tempfile
+from pathlib import Path
+
+import numpy as np
 from sigmf import sigmffile, SigMFFile
 
 from data_model import DataModel
-from annotation import Annotation, AnnotationSource
+from annotation import AnnotationSource
+from sigmf_reader import SigMFReader, SIGMF_DATASET_EXT, get_sidecar_file, read_sidecar_metadata, write_metadata
 
 
 class SigMFModel(DataModel):
 
+    # Extension of the cache folder created next to the capture
+    CACHE_EXT = ".spectrogram"
+
     def __init__(self, filename):
 
         super(SigMFModel, self).__init__()
 
         # TODO: Use str or Path but consistently across all models
         self.file_name = filename
-        self.sigmf_file = sigmffile.fromarchive(filename)
+
+        try:
+            # Memory mapped access, the archive is not unpacked and samples are read on demand
+            self.reader = SigMFReader(filename)
+        except tarfile.ReadError:
+            # Compressed archives cannot be memory mapped, unpack them with the SigMF library
+            logging.warning(f"SigMF archive {filename} is compressed, samples will be unpacked")
+            self.reader = None
+            self.sigmf_file = sigmffile.fromarchive(filename)
+            # Metadata saved after the archive was written
+            sidecar_metadata = read_sidecar_metadata(filename)
+            if sidecar_metadata:
+                self.sigmf_file._metadata = sidecar_metadata
+        else:
+            self.sigmf_file = SigMFFile(metadata=self.reader.metadata)
 
         self.capture = 0
+        self.channel = 0
         self.sample_rate = self.sigmf_file.get_global_field(SigMFFile.SAMPLE_RATE_KEY)
 
         self.parse_metadata()
 
     def parse_metadata(self):
 
-        for sigmf_annotation in self.sigmf_file.get_annotations():
+        sigmf_annotations = self.sigmf_file.get_annotations()
 
-            # Mandatory fields transformed to time
-            start = sigmf_annotation[SigMFFile.START_INDEX_KEY] / self.sample_rate
-            length = sigmf_annotation[SigMFFile.LENGTH_INDEX_KEY] / self.sample_rate
+        # Annotations are loaded into the store columns, no annotation object is created
+        self.annotations.reset(self.sample_rate)
+        self.annotations.extend(
+            # Mandatory fields (sample indexes)
+            start=[a[SigMFFile.START_INDEX_KEY] for a in sigmf_annotations],
+            length=[a[SigMFFile.LENGTH_INDEX_KEY] for a in sigmf_annotations],
             # Optional fields
-            high = sigmf_annotation.get(SigMFFile.FHI_KEY, None)
-            low = sigmf_annotation.get(SigMFFile.FLO_KEY, None)
-            comment = sigmf_annotation.get(SigMFFile.COMMENT_KEY, None)
-
-            label = sigmf_annotation.get('core:label', None)
-            group = sigmf_annotation.get('group', None)
-
-            annotation = Annotation(source=AnnotationSource.FILE,
-                                    start=start,
-                                    length=length,
-                                    high=high,
-                                    low=low,
-                                    comment=comment,
-                                    label=label,
-                                    group=group)
-
-            self.annotations.append(annotation)
-
-        # print({a.label for a in self.annotations if a.label})
-        for label in {a.label for a in self.annotations if a.label}:
+            high=[a.get(SigMFFile.FHI_KEY, None) for a in sigmf_annotations],
+            low=[a.get(SigMFFile.FLO_KEY, None) for a in sigmf_annotations],
+            comment=[a.get(SigMFFile.COMMENT_KEY, None) for a in sigmf_annotations],
+            label=[a.get('core:label', None) or None for a in sigmf_annotations],
+            group=[a.get('group', None) or None for a in sigmf_annotations],
+            source=AnnotationSource.FILE
+        )
+
+        for label in self.annotations.get_used_values("label"):
             self.labels.add_label(label)
-        for group in {a.group for a in self.annotations if a.group}:
+        for group in self.annotations.get_used_values("group"):
             self.groups.add_group(group)
 
     def __len__(self):
@@ -60,7 +77,12 @@ class SigMFModel(DataModel):
         return self.sample_rate
 
     def get_sample_count(self):
-        return self.sigmf_file.sample_count
+        if self.reader is None:
+            return self.sigmf_file.sample_count
+        return self.reader.sample_count
+
+    def get_cache_path(self):
+        return Path(self.file_name).with_suffix(self.CACHE_EXT)
 
     def get_author(self):
         return self.sigmf_file.get_global_field(SigMFFile.AUTHOR_KEY)
@@ -75,8 +97,31 @@ class SigMFModel(DataModel):
         start += self.sigmf_file.get_captures()[self.capture].get(SigMFFile.START_INDEX_KEY, 0)
         if not count:
             # If sample count not given, read from start to end of the data
-            count = self.sigmf_file.sample_count - start
-        return self.sigmf_file.read_samples(start, count, autoscale=False, raw_components=False)
+            count = self.get_sample_count() - start
+        with self.read_lock:
+            if self.reader is None:
+                samples = self.sigmf_file.read_samples(start, count, autoscale=self.autoscale)
+            else:
+                samples = self.reader.get_samples(self.channel)[start:start + count]
+        return self.convert_samples(samples)
+
+    def iter_blocks(self, block_size: int, overlap: int = 0, start: int = 0, stop: int = None):
+        if self.reader is None:
+            yield from super(SigMFModel, self).iter_blocks(block_size, overlap, start, stop)
+            return
+
+        if overlap >= block_size:
+            raise ValueError(f"Block overlap ({overlap}) must be smaller than block size ({block_size})")
+
+        capture_start = self.sigmf_file.get_captures()[self.capture].get(SigMFFile.START_INDEX_KEY, 0)
+        samples = self.reader.get_samples(self.channel)
+        stop = self.get_sample_count() if stop is None else min(stop, self.get_sample_count())
+
+        for offset in self._block_offsets(block_size, overlap, start, stop):
+            # Blocks are views of the memory map, pages are read when the block is used
+            block_start = capture_start + offset
+            block_end = capture_start + min(offset + block_size, stop)
+            yield offset, self.convert_samples(samples[block_start:block_end])
 
     def get_central_frequency(self, idx=None):
         captures = self.sigmf_file.get_captures()
@@ -88,15 +133,28 @@ class SigMFModel(DataModel):
             logging.warning("SigMF MUST contain a top level capture object")
             return 0
 
-    def read_time(self, start=0, length=None):
+    def time_span_to_samples(self, start=0, length=None):
         # Calculate the sample for start timestamp
-        start_sample = start * self.get_sample_rate()
+        start_sample = int(start * self.get_sample_rate())
         if not length:
-            sample_count = None
+            sample_count = self.get_sample_count() - start_sample
         else:
-            sample_count = min(self.time_to_sample(length), self.get_sample_count()-start_sample)
+            sample_count = int(min(self.time_to_sample(length), self.get_sample_count()-start_sample))
 
-        return self.sigmf_file.read_samples(int(start_sample), int(sample_count))
+        # read_samples indices are relative to the capture start index, read_time ones are not
+        capture_start = self.sigmf_file.get_captures()[self.capture].get(SigMFFile.START_INDEX_KEY, 0)
+        return start_sample - capture_start, sample_count
+
+    def read_time(self, start=0, length=None):
+        start_sample, sample_count = self.time_span_to_samples(start, length)
+        start_sample += self.sigmf_file.get_captures()[self.capture].get(SigMFFile.START_INDEX_KEY, 0)
+
+        with self.read_lock:
+            if self.reader is None:
+                samples = self.sigmf_file.read_samples(start_sample, sample_count, autoscale=self.autoscale)
+            else:
+                samples = self.reader.get_samples(self.channel)[start_sample:start_sample + sample_count]
+        return self.convert_samples(samples)
 
     def create_sigmf_file(self):
         new_file = SigMFFile(metadata=None,
@@ -119,46 +177,97 @@ class SigMFModel(DataModel):
         """
 
         # TODO: In order to overwrite annotations we have to access the "protected" metadata
-        self.sigmf_file._metadata[SigMFFile.ANNOTATION_KEY] = [
-            self.get_sigmf_annotation(annotation) for annotation in sorted(self.annotations, key=lambda a: a.start)
-        ]
+        rows = self.annotations.get_rows()
+        rows = rows[np.argsort(self.annotations.columns["start"][rows], kind='stable')]
+        self.sigmf_file._metadata[SigMFFile.ANNOTATION_KEY] = [self.get_sigmf_annotation(row) for row in rows]
 
         if file_name:
-            # Save as
+            # Save as, full archive including the dataset
             if not file_name.endswith('.sigmf'):
                 file_name += ".sigmf"
 
-            self.sigmf_file.archive(file_name)
+            if self.reader is None:
+                self.sigmf_file.archive(file_name)
+            else:
+                self._archive(file_name)
+
+            if Path(file_name).resolve() == Path(self.file_name).resolve():
+                # The new archive contains the metadata, remove the outdated sidecar
+                get_sidecar_file(self.file_name).unlink(missing_ok=True)
+        elif self.reader is not None and not self.reader.is_archive():
+            # Save metadata of a metadata/dataset pair, the dataset is untouched
+            write_metadata(self.reader.metadata_file, self.sigmf_file._metadata)
         else:
-            # Save
-            self.sigmf_file.archive(self.file_name)
+            # Save metadata next to the archive, the archive (and its dataset) is untouched
+            write_metadata(get_sidecar_file(self.file_name), self.sigmf_file._metadata)
 
         self._modified = False
 
+    def _archive(self, file_name):
+        """
+        Writes the capture to a SigMF archive from the memory mapped dataset
+        The archive is written to a temporary file and renamed, the memory map of the original file stays valid
+        :param file_name: Archive file name
+        """
+        destination = Path(file_name).resolve()
+        temp_dir = tempfile.mkdtemp(dir=destination.parent)
+
+        try:
+            if self.reader.is_archive_member():
+                # SigMF library needs the dataset as a file, copy it out of the archive without loading it
+                data_file = Path(temp_dir).joinpath(destination.stem + SIGMF_DATASET_EXT)
+                with open(self.reader.data_file, 'rb') as source, open(data_file, 'wb') as target:
+                    source.seek(self.reader.data_offset)
+                    remaining = self.reader.data_size
+                    while remaining > 0:
+                        chunk = source.read(min(remaining, 2**24))
+                        target.write(chunk)
+                        remaining -= len(chunk)
+            else:
+                data_file = self.reader.data_file
+
+            self.sigmf_file.set_data_file(str(data_file))
+
+            temp_archive = Path(temp_dir).joinpath(destination.name)
+            self.sigmf_file.archive(str(temp_archive))
+            os.replace(temp_archive, destination)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+        if destination == Path(self.file_name).resolve():
+            # The original archive has been replaced, map the new one
+            self.reader = SigMFReader(self.file_name)
+
     def set_modified_status(self, value):
         if self._modified != value:
             self._modified = value
             self.modified_status.emit(self._modified)
 
-    def get_sigmf_annotation(self, annotation: Annotation):
+    def get_sigmf_annotation(self, row: int):
         """
-
-        :param annotation:
-        :return:
+        Returns the SigMF annotation of a row of the annotation store
+        :param row: Annotation row
+        :return: SigMF annotation dictionary
         """
+        annotations = self.annotations
         sigmf_annotation =  {
-            SigMFFile.START_INDEX_KEY: math.floor(annotation.start * self.get_sample_rate()),
-            SigMFFile.LENGTH_INDEX_KEY: math.ceil(annotation.length * self.get_sample_rate()),
-            SigMFFile.FHI_KEY: annotation.high,
-            SigMFFile.FLO_KEY: annotation.low,
+            # Start and length are stored in samples
+            SigMFFile.START_INDEX_KEY: int(annotations.columns["start"][row]),
+            SigMFFile.LENGTH_INDEX_KEY: int(annotations.columns["length"][row]),
+            SigMFFile.FHI_KEY: annotations.get_field(row, "high"),
+            SigMFFile.FLO_KEY: annotations.get_field(row, "low"),
         }
 
-        if annotation.metadata.get('author', None):
-            sigmf_annotation[SigMFFile.GENERATOR_KEY] = annotation.metadata['author']
-        if annotation.metadata.get('comment', None):
-            sigmf_annotation[SigMFFile.COMMENT_KEY] = annotation.metadata['comment']
-        if annotation.label:
+        author = annotations.get_field(row, "author")
+        comment = annotations.get_field(row, "comment")
+        label = annotations.get_field(row, "label")
+
+        if author:
+            sigmf_annotation[SigMFFile.GENERATOR_KEY] = author
+        if comment:
+            sigmf_annotation[SigMFFile.COMMENT_KEY] = comment
+        if label:
             # FIXME: annotation label is part of the specification (introduced in 259206243e13f63a1793a07972c3d916863183b8) but not label key in python source so we took it from the scheme
-            sigmf_annotation["core:label"] = annotation.label
+            sigmf_annotation["core:label"] = label
 
-        return sigmf_annotation
\ No newline at end of file
+        return sigmf_annotation
@@ -0,0 +1,224 @@
+import json
+import logging
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from sigmf import SigMFFile
+
+# SigMF file extensions
+SIGMF_ARCHIVE_EXT = ".sigmf"
+SIGMF_METADATA_EXT = ".sigmf-meta"
+SIGMF_DATASET_EXT = ".sigmf-data"
+
+# core:datatype format, e.g. cf32_le, ri16_be, cu8
+DATATYPE_REGEX = re.compile(r"^(?P<kind>[rc])(?P<type>[fiu])(?P<bits>8|16|32|64)(?:_(?P<endian>le|be))?$")
+
+
+def parse_datatype(datatype: str):
+    """
+    Parses a SigMF core:datatype string
+    :param datatype: SigMF datatype (e.g. cf32_le)
+    :return: Tuple with the numpy dtype of a single sample and True if the samples are complex
+    """
+    match = DATATYPE_REGEX.match(datatype or "")
+    if not match:
+        raise ValueError(f"Unsupported SigMF datatype {datatype}")
+
+    is_complex = match.group("kind") == "c"
+    component_type = match.group("type")
+    component_size = int(match.group("bits")) // 8
+    byte_order = ">" if match.group("endian") == "be" else "<"
+
+    if component_type == "f" and component_size < 4:
+        raise ValueError(f"Unsupported SigMF datatype {datatype}")
+
+    if is_complex and component_type == "f":
+        # Complex float samples can be mapped directly as numpy complex
+        sample_dtype = np.dtype(f"{byte_order}c{2 * component_size}")
+    elif is_complex:
+        # Complex integer samples are mapped as (I, Q) pairs
+        sample_dtype = np.dtype((f"{byte_order}{component_type}{component_size}", (2,)))
+    else:
+        sample_dtype = np.dtype(f"{byte_order}{component_type}{component_size}")
+
+    return sample_dtype, is_complex
+
+
+def get_sidecar_file(archive_file) -> Path:
+    """
+    Returns the metadata file saved next to an archive (e.g. capture.sigmf-meta for capture.sigmf)
+    """
+    return Path(archive_file).with_suffix(SIGMF_METADATA_EXT)
+
+
+def read_sidecar_metadata(archive_file):
+    """
+    Reads the metadata saved next to an archive
+    The sidecar is only used if it is newer than the archive, an archive replaced afterwards keeps its own metadata.
+    :param archive_file: SigMF archive (.sigmf)
+    :return: Metadata dictionary or None if there is no valid sidecar
+    """
+    sidecar_file = get_sidecar_file(archive_file)
+
+    try:
+        if sidecar_file.stat().st_mtime_ns < Path(archive_file).stat().st_mtime_ns:
+            logging.info(f"SigMF metadata {sidecar_file} is older than {archive_file} and is ignored")
+            return None
+        with open(sidecar_file, 'r') as metadata_fp:
+            return json.load(metadata_fp)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        logging.warning(f"SigMF metadata {sidecar_file} could not be read: {error}")
+        return None
+
+
+def write_metadata(metadata_file, metadata: dict):
+    """
+    Writes a SigMF metadata file atomically (temporary file in the same folder renamed over the destination)
+    :param metadata_file: Destination .sigmf-meta file
+    :param metadata: Metadata dictionary
+    """
+    metadata_file = Path(metadata_file)
+    fd, temp_file = tempfile.mkstemp(prefix=metadata_file.name + ".", suffix=".tmp", dir=metadata_file.parent)
+
+    try:
+        with os.fdopen(fd, 'w') as metadata_fp:
+            json.dump(metadata, metadata_fp, indent=4)
+            metadata_fp.flush()
+            os.fsync(metadata_fp.fileno())
+        # mkstemp creates the file readable by its owner only, the metadata keeps the permissions of the file it
+        # replaces (or the default ones of a new file)
+        if metadata_file.exists():
+            shutil.copymode(metadata_file, temp_file)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_file, 0o666 & ~umask)
+        os.replace(temp_file, metadata_file)
+    except BaseException:
+        os.unlink(temp_file)
+        raise
+
+
+class SigMFReader:
+    """
+    Memory mapped access to the samples of a SigMF capture.
+
+    The samples are never copied nor unpacked: for an archive (.sigmf) the byte offset of the dataset member inside
+    the tar is used as memory map offset, for a metadata/dataset pair the .sigmf-data file is mapped directly. Pages
+    are only read from disk when the returned views are accessed, so several views can share one capture.
+
+    Metadata of an archive is saved next to it (see write_metadata), a newer sidecar takes precedence over the
+    metadata member of the archive.
+    """
+
+    def __init__(self, filename: str):
+        self.file_name = Path(filename)
+        # Metadata file of a metadata/dataset pair (None for archives)
+        self.metadata_file = None
+        # File backing the samples and offset of the first sample within it
+        self.data_file = None
+        self.data_offset = 0
+        self.data_size = 0
+
+        if self.file_name.suffix == SIGMF_ARCHIVE_EXT:
+            self.metadata = self._open_archive()
+        else:
+            self.metadata = self._open_pair()
+
+        global_info = self.metadata.get(SigMFFile.GLOBAL_KEY, {})
+
+        self.sample_dtype, self.is_complex = parse_datatype(global_info.get(SigMFFile.DATATYPE_KEY))
+        self.num_channels = global_info.get(SigMFFile.NUM_CHANNELS_KEY, 1)
+
+        sample_size = self.sample_dtype.itemsize * self.num_channels
+        self.sample_count = self.data_size // sample_size
+
+        if self.data_size % sample_size:
+            logging.warning(f"SigMF dataset {self.data_file} size is not a multiple of the sample size")
+
+        if self.sample_count > 0:
+            self.samples = np.memmap(self.data_file,
+                                     dtype=self.sample_dtype,
+                                     mode='r',
+                                     offset=self.data_offset,
+                                     shape=(self.sample_count, self.num_channels))
+        else:
+            self.samples = np.empty((0, self.num_channels), dtype=self.sample_dtype)
+
+    def _open_archive(self):
+        """
+        Locates the metadata and dataset members of an uncompressed SigMF archive
+        :return: Metadata dictionary
+        """
+        metadata = None
+
+        # Compressed archives do not have a stable byte offset for the dataset (raises tarfile.ReadError)
+        with tarfile.open(self.file_name, mode='r:') as archive:
+            for member in archive.getmembers():
+                if not member.isfile():
+                    continue
+                if member.name.endswith(SIGMF_METADATA_EXT):
+                    metadata = json.load(archive.extractfile(member))
+                elif member.name.endswith(SIGMF_DATASET_EXT):
+                    self.data_file = self.file_name
+                    self.data_offset = member.offset_data
+                    self.data_size = member.size
+
+        # Metadata saved after the archive was written
+        metadata = read_sidecar_metadata(self.file_name) or metadata
+
+        if metadata is None:
+            raise ValueError(f"SigMF archive {self.file_name} does not contain a metadata file")
+
+        if self.data_file is None:
+            # Fall back to an uncompressed dataset next to the archive
+            data_file = self.file_name.with_suffix(SIGMF_DATASET_EXT)
+            if not data_file.exists():
+                raise ValueError(f"SigMF archive {self.file_name} does not contain a dataset file")
+            self.data_file = data_file
+            self.data_size = data_file.stat().st_size
+
+        return metadata
+
+    def _open_pair(self):
+        """
+        Opens a SigMF metadata (.sigmf-meta) and dataset (.sigmf-data) file pair
+        :return: Metadata dictionary
+        """
+        self.metadata_file = self.file_name.with_suffix(SIGMF_METADATA_EXT)
+
+        with open(self.metadata_file, 'r') as metadata_fp:
+            metadata = json.load(metadata_fp)
+
+        self.data_file = self.file_name.with_suffix(SIGMF_DATASET_EXT)
+        self.data_size = self.data_file.stat().st_size
+
+        return metadata
+
+    def is_archive(self):
+        """
+        Returns True if the capture was opened from a SigMF archive
+        """
+        return self.metadata_file is None
+
+    def is_archive_member(self):
+        """
+        Returns True if the samples are stored inside the SigMF archive
+        """
+        return self.data_file == self.file_name
+
+    def get_samples(self, channel: int = 0):
+        """
+        Returns a memory mapped view over all the samples of a channel
+        :param channel: Channel index
+        :return: numpy.memmap view (no data is read)
+        """
+        return self.samples[:, channel]
@@ -0,0 +1,393 @@
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal, fft
+
+from data_model import DataModel
+from read_ahead import ReadAhead
+
+# Default segment length used by scipy.signal.spectrogram
+DEFAULT_NPERSEG = 256
+# Default window used by scipy.signal.spectrogram
+DEFAULT_WINDOW = ('tukey', .25)
+
+# Default window used by scipy.signal.welch
+WELCH_WINDOW = 'hann'
+
+# Number of segments transformed at once by a thread (bounds the size of the complex intermediates)
+FFT_BLOCK_SEGMENTS = 1024
+# Number of values converted to dB at once (fits in cache)
+DB_CHUNK_SIZE = 2**16
+# Number of dB chunks converted by a thread
+DB_CHUNKS_PER_TASK = 16
+
+# Power floor of the dB conversion, zero power (e.g. capture gaps filled with zeros) would be -inf dB
+POWER_FLOOR = 1e-20
+POWER_FLOOR_DB = -200.0
+
+# Largest code of quantized spectrograms (uint8), code 0 is the lowest power of the quantization range
+QUANTIZED_MAX = 255
+
+# Largest read of the preview (several segments read at once when they are close)
+PREVIEW_READ_SAMPLES = 2**20
+# Segments are read at once only if at most this fraction of the read samples is skipped
+PREVIEW_MAX_SKIPPED = .75
+
+# Number of threads computing spectrograms
+WORKERS = os.cpu_count() or 1
+
+# Thread pool shared by all the spectrogram computations (see get_executor)
+_executor = None
+
+
+def resolve_parameters(sample_count: int, nperseg: int = None, noverlap: int = None, nfft: int = None):
+    """
+    Resolves spectrogram default parameters the same way as scipy.signal.spectrogram
+    :param sample_count: Number of samples of the signal
+    :param nperseg: Length of each segment (None for default)
+    :param noverlap: Number of samples to overlap between segments (None for default)
+    :param nfft: Length of the FFT (None to use nperseg)
+    :return: Tuple (nperseg, noverlap, nfft)
+    """
+    nperseg = min(nperseg or DEFAULT_NPERSEG, sample_count)
+    noverlap = nperseg // 8 if noverlap is None else noverlap
+    nfft = nfft or nperseg
+
+    if noverlap >= nperseg:
+        raise ValueError(f"Spectrogram overlap ({noverlap}) must be smaller than segment length ({nperseg})")
+
+    return nperseg, noverlap, nfft
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Returns the thread pool shared by all the spectrogram computations
+    numpy and scipy.fft release the GIL, so slabs of segments are computed in parallel.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="stft")
+    return _executor
+
+
+def _map_slabs(function, count: int, slab_size: int):
+    """
+    Calls function(first, last) for each slab of a range, in parallel when there are several slabs
+    :return: List of the results in slab order
+    """
+    slabs = [(first, min(first + slab_size, count)) for first in range(0, count, slab_size)]
+    if len(slabs) <= 1:
+        return [function(first, last) for first, last in slabs]
+    return list(get_executor().map(lambda slab: function(*slab), slabs))
+
+
+def stft_power(x: np.ndarray, nperseg: int, noverlap: int, nfft: int, win: np.ndarray, scale: float,
+               out: np.ndarray = None) -> np.ndarray:
+    """
+    Computes the scaled power of the short time Fourier transform of a signal with frequency 0 in the middle
+    Segments are split in slabs computed by the shared thread pool. A slab reads the samples of its own segments, so
+    consecutive slabs overlap by noverlap samples exactly like the segments do and the seams are identical to a single
+    pass. The power of each segment is written already shifted into a float32 time-major buffer.
+    :param x: Samples
+    :param nperseg: Length of each segment
+    :param noverlap: Number of samples to overlap between segments
+    :param nfft: Length of the FFT
+    :param win: Window with nperseg values
+    :param scale: Power scaling
+    :param out: Preallocated float32 buffer with shape (segments, nfft), None to allocate it
+    :return: Power with shape (segments, nfft)
+    """
+    step = nperseg - noverlap
+    segments = segment_count(len(x), nperseg, noverlap)
+
+    if out is None:
+        out = np.empty((segments, nfft), dtype=np.float32)
+
+    x = np.asarray(x).astype(np.complex64, copy=False)
+    scale = np.float32(scale)
+
+    # Frequency shift by index arithmetic: FFT bin k goes to row (k + nfft // 2) % nfft
+    positive = nfft - nfft // 2
+
+    # A single slab uses the FFT threads instead of the thread pool
+    fft_workers = WORKERS if segments <= FFT_BLOCK_SEGMENTS else 1
+
+    def compute_slab(first, last):
+        # Segments are strided views over the samples, copied once to remove their mean and apply the window
+        frames = sliding_window_view(x[first * step:(last - 1) * step + nperseg], nperseg)[::step]
+        frames = frames - np.mean(frames, axis=1, keepdims=True)
+        frames *= win
+
+        spectrum = fft.fft(frames, n=nfft, axis=1, overwrite_x=True, workers=fft_workers)
+
+        block = out[first:last]
+        np.abs(spectrum[:, :positive], out=block[:, nfft // 2:])
+        np.abs(spectrum[:, positive:], out=block[:, :nfft // 2])
+        np.square(block, out=block)
+        block *= scale
+
+    _map_slabs(compute_slab, segments, FFT_BLOCK_SEGMENTS)
+
+    return out
+
+
+def spectrogram(x: np.ndarray, fs: float, nperseg: int, window=None, noverlap: int = None, nfft: int = None,
+                out: np.ndarray = None):
+    """
+    Computes a two sided spectrogram with frequency 0 in the middle
+    Same result as scipy.signal.spectrogram (constant detrend, density scaling) in single precision.
+    :param x: Samples
+    :param fs: Sample rate
+    :param nperseg: Length of each segment
+    :param window: Window (None for default)
+    :param noverlap: Number of samples to overlap between segments
+    :param nfft: Length of the FFT
+    :param out: Preallocated float32 buffer with shape (segments, nfft), None to allocate it
+    :return: Power spectral density with shape (nfft, segments) (transposed view of the time-major buffer)
+    """
+    nperseg, noverlap, nfft = resolve_parameters(len(x), nperseg, noverlap, nfft)
+    win = get_window(window, nperseg)
+
+    return stft_power(x, nperseg, noverlap, nfft, win, 1 / (fs * np.sum(win.astype(np.float64) ** 2)), out).T
+
+
+def welch(x: np.ndarray, fs: float, nperseg: int = None, window=WELCH_WINDOW, noverlap: int = None, nfft: int = None,
+          scaling: str = "density"):
+    """
+    Computes a two sided averaged periodogram with frequency 0 in the middle
+    Same result as scipy.signal.welch (constant detrend, mean average) in single precision.
+    :param x: Samples
+    :param fs: Sample rate
+    :param nperseg: Length of each segment (None for default)
+    :param window: Window
+    :param noverlap: Number of samples to overlap between segments (None for half a segment)
+    :param nfft: Length of the FFT
+    :param scaling: "density" or "spectrum"
+    :return: Tuple (frequencies, power)
+    """
+    nperseg = min(nperseg or DEFAULT_NPERSEG, len(x))
+    nperseg, noverlap, nfft = resolve_parameters(len(x), nperseg, nperseg // 2 if noverlap is None else noverlap, nfft)
+    win = get_window(window, nperseg)
+
+    if scaling == "density":
+        scale = 1 / (fs * np.sum(win.astype(np.float64) ** 2))
+    elif scaling == "spectrum":
+        scale = 1 / np.sum(win.astype(np.float64)) ** 2
+    else:
+        raise ValueError(f"Unknown scaling {scaling}")
+
+    return frequencies(nfft, fs), np.mean(stft_power(x, nperseg, noverlap, nfft, win, scale), axis=0)
+
+
+def frequencies(nfft: int, fs: float) -> np.ndarray:
+    """
+    Returns the frequencies of the rows of a two sided spectrum with frequency 0 in the middle
+    """
+    return fft.fftshift(fft.fftfreq(nfft, 1 / fs))
+
+
+def power_to_db(sxx: np.ndarray):
+    """
+    Converts a power spectral density to dB in place and computes its range in the same pass
+    Each chunk is converted and scanned while it is still in cache, chunks are spread over the shared thread pool.
+    Power is floored to POWER_FLOOR, NaN (gaps) is kept. The range only covers the power above the floor, so gaps do
+    not stretch it (it is (inf, -inf) when there is no such power).
+    :param sxx: Float32 power spectral density, modified in place
+    :return: Tuple (sxx, minimum, maximum)
+    """
+    # Chunks along the contiguous axis of the buffer
+    rows = sxx.T if sxx.flags.f_contiguous else sxx
+    chunk_rows = max(DB_CHUNK_SIZE // max(int(np.prod(rows.shape[1:])), 1), 1)
+
+    def convert_chunk(first, last):
+        chunk = rows[first:last]
+        np.maximum(chunk, POWER_FLOOR, out=chunk)
+        np.log10(chunk, out=chunk)
+        chunk *= 10
+        # NaN compares False, floored and NaN bins are left out of the range
+        valid = chunk[chunk > POWER_FLOOR_DB]
+        if not valid.size:
+            return np.inf, -np.inf
+        return valid.min(), valid.max()
+
+    ranges = _map_slabs(convert_chunk, rows.shape[0], chunk_rows * DB_CHUNKS_PER_TASK)
+    if not ranges:
+        return sxx, np.inf, -np.inf
+
+    return sxx, float(min(r[0] for r in ranges)), float(max(r[1] for r in ranges))
+
+
+def quantize_db(sxx_db: np.ndarray, power_min: float, power_max: float) -> np.ndarray:
+    """
+    Quantizes a power (dB) spectrogram to uint8 codes, 0 for power_min and QUANTIZED_MAX for power_max (powers out of
+    the range are clipped, NaN is code 0). Each chunk is quantized while it is still in cache, chunks are spread over
+    the shared thread pool.
+    :param sxx_db: Float power (dB), not modified (e.g. memory mapped pyramid level)
+    :param power_min: Lowest power of the quantization range
+    :param power_max: Highest power of the quantization range
+    :return: uint8 array with the shape (and memory order) of sxx_db
+    """
+    # Chunks along the contiguous axis of the buffer
+    transposed = sxx_db.flags.f_contiguous and not sxx_db.flags.c_contiguous
+    rows = sxx_db.T if transposed else sxx_db
+    codes = np.empty(rows.shape, dtype=np.uint8)
+    chunk_rows = max(DB_CHUNK_SIZE // max(int(np.prod(rows.shape[1:])), 1), 1)
+
+    # Empty range (e.g. a capture made only of gaps), everything is code 0
+    if not (np.isfinite(power_min) and np.isfinite(power_max)):
+        power_min, power_max = POWER_FLOOR_DB, POWER_FLOOR_DB
+
+    scale = np.float32(QUANTIZED_MAX / max(power_max - power_min, np.finfo(np.float32).eps))
+    offset = np.float32(power_min)
+
+    def quantize_chunk(first, last):
+        chunk = rows[first:last].astype(np.float32)
+        chunk -= offset
+        chunk *= scale
+        np.clip(chunk, 0, QUANTIZED_MAX, out=chunk)
+        np.rint(chunk, out=chunk)
+        np.nan_to_num(chunk, copy=False, nan=0)
+        codes[first:last] = chunk
+
+    _map_slabs(quantize_chunk, rows.shape[0], chunk_rows * DB_CHUNKS_PER_TASK)
+
+    return codes.T if transposed else codes
+
+
+def read_spectrogram(model: DataModel, start: int, count: int, nperseg: int, window=None, noverlap: int = None,
+                     nfft: int = None, levels: tuple = None, cancelled=None):
+    """
+    Reads a span of samples and computes its spectrogram in log scale
+    :param model: Data model
+    :param start: First sample index
+    :param count: Number of samples
+    :param nperseg: Length of each segment
+    :param window: Window (None for default)
+    :param noverlap: Number of samples to overlap between segments
+    :param nfft: Length of the FFT
+    :param levels: Quantization range (minimum, maximum) in dB, None to keep the float power
+    :param cancelled: Callable returning True when the computation is not needed anymore
+    :return: Tuple (power (dB or quantized, see quantize_db) with shape (nfft, segments), minimum, maximum) or None
+    if cancelled
+    """
+    samples = model.read_samples(start, count)
+
+    if cancelled and cancelled():
+        return None
+
+    sxx_log, power_min, power_max = power_to_db(spectrogram(samples, model.get_sample_rate(), nperseg, window,
+                                                            noverlap, nfft))
+    if levels is not None:
+        sxx_log = quantize_db(sxx_log, *levels)
+
+    return sxx_log, power_min, power_max
+
+
+def get_window(window, nperseg: int) -> np.ndarray:
+    """
+    Returns a float32 window, cached per window specification and length
+    :param window: Window (None for default), any scipy.signal.get_window window specification
+    :param nperseg: Window length
+    :return: Read only window array
+    """
+    if window is None:
+        window = DEFAULT_WINDOW
+    if isinstance(window, np.ndarray):
+        return window.astype(np.float32)
+    if isinstance(window, list):
+        window = tuple(window)
+    return _cached_window(window, nperseg)
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_window(window, nperseg: int) -> np.ndarray:
+    win = signal.get_window(window, nperseg).astype(np.float32)
+    win.setflags(write=False)
+    return win
+
+
+def segment_count(sample_count: int, nperseg: int, noverlap: int) -> int:
+    """
+    Returns the number of spectrogram segments of a signal
+    """
+    if sample_count < nperseg:
+        return 0
+    return (sample_count - noverlap) // (nperseg - noverlap)
+
+
+def iter_spectrogram(model: DataModel, nperseg: int, window=None, noverlap: int = None, nfft: int = None,
+                     block_segments: int = 4096, start: int = 0, stop: int = None):
+    """
+    Computes the spectrogram of a model block by block
+    Blocks overlap so that the concatenation of the blocks is the spectrogram of the whole signal
+    :param model: Data model
+    :param nperseg: Length of each segment
+    :param window: Window (None for default)
+    :param noverlap: Number of samples to overlap between segments
+    :param nfft: Length of the FFT
+    :param block_segments: Number of segments computed from each block
+    :param start: First sample index
+    :param stop: Last sample index (excluded), None until the end of the data
+    :return: Generator of (segment, sxx) tuples where segment is the index of the first segment of sxx
+    """
+    stop = model.get_sample_count() if stop is None else stop
+    step = nperseg - noverlap
+
+    # Read only the samples that fill complete segments
+    segments = segment_count(stop - start, nperseg, noverlap)
+    if segments == 0:
+        return
+    block_size = block_segments * step + noverlap
+
+    for offset, block in model.iter_blocks(block_size, noverlap, start, start + segments * step + noverlap):
+        yield (offset - start) // step, spectrogram(block, model.get_sample_rate(), nperseg, window, noverlap, nfft)
+
+
+def preview_spectrogram(model: DataModel, columns: int, nperseg: int, window=None, nfft: int = None,
+                        quantized: bool = False, cancelled=None):
+    """
+    Computes a coarse spectrogram of the whole capture from a segment taken every few samples
+    :param model: Data model
+    :param columns: Number of columns (segments) of the preview
+    :param nperseg: Length of each segment
+    :param window: Window (None for default)
+    :param nfft: Length of the FFT
+    :param quantized: Quantize the power over its own range (see quantize_db)
+    :param cancelled: Callable returning True when the computation is not needed anymore
+    :return: Tuple (power (dB or quantized) with shape (nfft, columns), minimum, maximum) or None if cancelled or if
+    the capture is shorter than a segment
+    """
+    sample_count = model.get_sample_count()
+    if sample_count < nperseg:
+        # Not a single segment
+        return None
+
+    # Segments evenly spaced (constant stride, so the reads are predicted by ReadAhead)
+    columns = max(min(columns, sample_count // nperseg), 1)
+    stride = (sample_count - nperseg) // max(columns - 1, 1)
+
+    # Close segments are read at once
+    columns_per_read = 1
+    if nperseg >= stride * (1 - PREVIEW_MAX_SKIPPED):
+        columns_per_read = max((PREVIEW_READ_SAMPLES - nperseg) // stride + 1, 1) if stride else columns
+
+    segments = []
+    with ReadAhead(model) as reader:
+        for column in range(0, columns, columns_per_read):
+            if cancelled and cancelled():
+                return None
+            read_columns = min(columns_per_read, columns - column)
+            samples = reader.read_samples(column * stride, (read_columns - 1) * stride + nperseg)
+            segments.extend(samples[index * stride:index * stride + nperseg] for index in range(read_columns))
+
+    # Consecutive segments without overlap, a column per segment
+    sxx_log, power_min, power_max = power_to_db(spectrogram(np.concatenate(segments), model.get_sample_rate(),
+                                                            nperseg, window, 0, nfft))
+    if quantized:
+        sxx_log = quantize_db(sxx_log, power_min, power_max)
+
+    return sxx_log, power_min, power_max
@@ -0,0 +1,287 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+import spectrogram_engine as engine
+from data_model import DataModel
+
+
+class SpectrogramTilePyramid:
+    """
+    Multi-resolution spectrogram stored on disk next to the capture.
+
+    Level 0 holds the full resolution spectrogram (one column per segment). Each following level merges DECIMATION
+    columns of the previous one, keeping both the maximum (max-hold) and the mean power. Levels are stored as
+    time-major float32 numpy files (one row per column, power in dB) and are memory mapped when read, so only the
+    tiles (groups of TILE_COLUMNS columns) that are displayed are loaded. Float power only lives in these files, tiles
+    are quantized to uint8 when read (see read) so the display keeps a byte per pixel.
+
+    The pyramid is built once per capture and spectrogram parameters. When the capture grows (live capture), the
+    pyramid of its first samples is still used and is extended with the columns of the new samples only (see build).
+    """
+
+    # Number of columns of each tile
+    TILE_COLUMNS = 1024
+    # Number of columns of a level merged in a column of the next level
+    DECIMATION = 4
+    # Number of segments computed at once while building
+    BUILD_BLOCK_SEGMENTS = 4096
+
+    MAX = "max"
+    MEAN = "mean"
+
+    MANIFEST_FILE = "pyramid.json"
+
+    def __init__(self, model: DataModel, nperseg: int = None, window=None, noverlap: int = None, nfft: int = None):
+        self.model = model
+        self.window = window
+        self.nperseg, self.noverlap, self.nfft = engine.resolve_parameters(model.get_sample_count(),
+                                                                           nperseg, noverlap, nfft)
+        self.step = self.nperseg - self.noverlap
+
+        parameters = repr((self.nperseg, self._window_key(), self.noverlap, self.nfft))
+        self.path = Path(model.get_cache_path()).joinpath(hashlib.sha1(parameters.encode()).hexdigest()[:16])
+
+        self.manifest = self._read_manifest()
+
+    def _window_key(self):
+        """
+        Window description used in the pyramid folder name and manifest, array windows are described by a hash of
+        their values (their repr is truncated)
+        """
+        window = engine.DEFAULT_WINDOW if self.window is None else self.window
+        if isinstance(window, np.ndarray):
+            return "array:" + hashlib.sha1(np.ascontiguousarray(window, dtype=np.float32).tobytes()).hexdigest()
+        return repr(window)
+
+    def _capture_info(self):
+        """
+        Capture description used to detect stale pyramids
+        """
+        # The sample count is not part of it, a capture that grew keeps its pyramid (see is_outdated)
+        return {
+            "sample_rate": self.model.get_sample_rate(),
+            "autoscale": self.model.autoscale,
+            "nperseg": self.nperseg,
+            "window": self._window_key(),
+            "noverlap": self.noverlap,
+            "nfft": self.nfft
+        }
+
+    def _read_manifest(self):
+        try:
+            with open(self.path.joinpath(self.MANIFEST_FILE), 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+        except (OSError, ValueError):
+            return None
+
+        if manifest.get("capture") != self._capture_info() or \
+                manifest.get("sample_count", math.inf) > self.model.get_sample_count():
+            logging.info(f"Spectrogram pyramid {self.path} does not match the capture and will be rebuilt")
+            return None
+
+        return manifest
+
+    def is_built(self):
+        return self.manifest is not None
+
+    def is_outdated(self):
+        """
+        Checks whether the capture grew since the pyramid was built (the new columns are added by build)
+        """
+        return self.get_missing_columns() > 0
+
+    def get_missing_columns(self) -> int:
+        """
+        Number of full resolution columns of the capture that are not in the pyramid
+        """
+        columns = engine.segment_count(self.model.get_sample_count(), self.nperseg, self.noverlap)
+        return columns - (self.manifest["levels"][0] if self.manifest is not None else 0)
+
+    @property
+    def levels(self):
+        return len(self.manifest["levels"])
+
+    @property
+    def levels_range(self):
+        """
+        Minimum and maximum power (dB) of the spectrogram
+        """
+        return self.manifest["min"], self.manifest["max"]
+
+    def get_columns(self, level: int) -> int:
+        return self.manifest["levels"][level]
+
+    def get_column_samples(self, level: int) -> int:
+        """
+        Number of samples represented by each column of a level
+        """
+        return self.step * self.DECIMATION ** level
+
+    def _level_file(self, path: Path, level: int, mode: str) -> Path:
+        if level == 0:
+            return path.joinpath("level_0.npy")
+        return path.joinpath(f"level_{level}_{mode}.npy")
+
+    def select_level(self, samples: int, columns: int) -> int:
+        """
+        Selects the coarsest level that still has at least one column per requested column
+        :param samples: Number of samples to display
+        :param columns: Number of columns available to display them (e.g. screen pixels)
+        :return: Level index
+        """
+        for level in reversed(range(self.levels)):
+            if samples / self.get_column_samples(level) >= columns:
+                return level
+        return 0
+
+    def read(self, level: int, first_tile: int, last_tile: int, mode: str = MAX, levels: tuple = None):
+        """
+        Reads the columns of a range of tiles of a level
+        :param level: Level index
+        :param first_tile: First tile index
+        :param last_tile: Last tile index (excluded)
+        :param mode: Decimation mode (MAX or MEAN), ignored for level 0
+        :param levels: Quantization range (minimum, maximum) in dB, None for the pyramid range, see
+        engine.quantize_db
+        :return: Tuple with the first column index and the quantized power (uint8) with shape (nfft, columns)
+        """
+        columns = np.load(self._level_file(self.path, level, mode), mmap_mode='r')
+        first_column = first_tile * self.TILE_COLUMNS
+        last_column = min(last_tile * self.TILE_COLUMNS, columns.shape[0])
+        power_min, power_max = levels if levels is not None else self.levels_range
+        return first_column, engine.quantize_db(columns[first_column:last_column].T, power_min, power_max)
+
+    def build(self, cancelled=None):
+        """
+        Computes the spectrogram of the whole capture and stores the pyramid levels
+        If a pyramid of the first samples of the capture is already built, only the columns of the new samples are
+        computed, the columns already stored are copied.
+        :param cancelled: Callable returning True when the build has to be stopped
+        :return: True if the pyramid has been built, False if cancelled
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Each build uses its own folder, a cancelled build might still be running
+        build_path = Path(tempfile.mkdtemp(prefix=self.path.name + ".", suffix=".partial", dir=self.path.parent))
+
+        # Columns of each level of the current pyramid, they stay the same when the capture grows
+        previous_levels = self.manifest["levels"] if self.manifest is not None else []
+
+        try:
+            sample_count = self.model.get_sample_count()
+            levels = [engine.segment_count(sample_count, self.nperseg, self.noverlap)]
+            while levels[-1] > self.TILE_COLUMNS:
+                levels.append(levels[-1] // self.DECIMATION)
+
+            # Full resolution level
+            level_0 = np.lib.format.open_memmap(self._level_file(build_path, 0, self.MAX),
+                                                mode='w+', dtype=np.float32, shape=(levels[0], self.nfft))
+            power_min, power_max = np.inf, -np.inf
+            if previous_levels and self.levels_range != (engine.POWER_FLOOR_DB, engine.POWER_FLOOR_DB):
+                power_min, power_max = self.levels_range
+
+            first_segment = self._copy_columns(level_0, 0, self.MAX, previous_levels)
+            for segment, sxx in engine.iter_spectrogram(self.model, self.nperseg, self.window, self.noverlap,
+                                                        self.nfft, self.BUILD_BLOCK_SEGMENTS,
+                                                        first_segment * self.step, sample_count):
+                segment += first_segment
+                sxx_log, block_min, block_max = engine.power_to_db(sxx)
+                level_0[segment:segment + sxx_log.shape[1]] = sxx_log.T
+                power_min = min(power_min, block_min)
+                power_max = max(power_max, block_max)
+
+                if cancelled and cancelled():
+                    del level_0
+                    shutil.rmtree(build_path, ignore_errors=True)
+                    return False
+
+            level_0.flush()
+            del level_0
+
+            # Capture without any power above the floor (only gaps)
+            if power_min > power_max:
+                power_min = power_max = engine.POWER_FLOOR_DB
+
+            # Decimated levels, each one computed from the previous one
+            for level in range(1, len(levels)):
+                for mode in (self.MAX, self.MEAN):
+                    self._build_level(build_path, level, levels[level], mode, previous_levels)
+
+                if cancelled and cancelled():
+                    shutil.rmtree(build_path, ignore_errors=True)
+                    return False
+
+            with open(build_path.joinpath(self.MANIFEST_FILE), 'w') as manifest_file:
+                json.dump({
+                    "capture": self._capture_info(),
+                    "sample_count": sample_count,
+                    "levels": levels,
+                    "min": float(power_min),
+                    "max": float(power_max)
+                }, manifest_file)
+
+            # Replace the previous pyramid only when the new one is complete
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.replace(build_path, self.path)
+        except Exception:
+            shutil.rmtree(build_path, ignore_errors=True)
+            raise
+
+        self.manifest = self._read_manifest()
+        return True
+
+    def _copy_columns(self, current: np.ndarray, level: int, mode: str, previous_levels: list) -> int:
+        """
+        Copies the columns of a level of the current pyramid into a level being built
+        :param current: Memory mapped level being built
+        :param previous_levels: Columns of each level of the current pyramid
+        :return: Number of copied columns
+        """
+        if level >= len(previous_levels):
+            return 0
+
+        columns = min(previous_levels[level], current.shape[0])
+        previous = np.load(self._level_file(self.path, level, mode), mmap_mode='r')
+        for first_column in range(0, columns, self.TILE_COLUMNS):
+            last_column = min(first_column + self.TILE_COLUMNS, columns)
+            current[first_column:last_column] = previous[first_column:last_column]
+
+        return columns
+
+    def _build_level(self, path: Path, level: int, columns: int, mode: str, previous_levels: list = ()):
+        previous = np.load(self._level_file(path, level - 1, mode), mmap_mode='r')
+        current = np.lib.format.open_memmap(self._level_file(path, level, mode),
+                                            mode='w+', dtype=np.float32, shape=(columns, self.nfft))
+
+        # Columns of the current pyramid only merge columns that did not change
+        copied = self._copy_columns(current, level, mode, list(previous_levels))
+
+        # Decimate a tile of the new level at a time
+        for first_column in range(copied, columns, self.TILE_COLUMNS):
+            last_column = min(first_column + self.TILE_COLUMNS, columns)
+            merged = previous[first_column * self.DECIMATION:last_column * self.DECIMATION]
+            merged = merged.reshape(last_column - first_column, self.DECIMATION, self.nfft)
+
+            if mode == self.MAX:
+                current[first_column:last_column] = np.max(merged, axis=1)
+            else:
+                # Mean of the linear power
+                current[first_column:last_column] = 10 * np.log10(np.mean(10 ** (merged / 10), axis=1))
+
+        current.flush()
+
+    @staticmethod
+    def tile_range(first_column: float, last_column: float):
+        """
+        Returns the tiles covering a range of columns
+        """
+        first_tile = max(int(math.floor(first_column / SpectrogramTilePyramid.TILE_COLUMNS)), 0)
+        last_tile = max(int(math.ceil(last_column / SpectrogramTilePyramid.TILE_COLUMNS)), first_tile + 1)
+        return first_tile, last_tile
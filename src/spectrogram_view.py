@@ -5,12 +5,14 @@ from PySide6 import QtCore, QtWidgets, QtGui
 import numpy as np
 import pyqtgraph as pg
 
-from scipy import signal, fftpack
-
 from annotation import Annotation, AnnotationSource
+from annotation_layer import AnnotationLayer
 from annotation_roi import AnnotationROI
 from sigmf_model import SigMFModel
 from spectrogram_parameters_view import SpectrogramParametersView
+from spectrogram_tiles import SpectrogramTilePyramid
+from spectrogram_worker import SpectrogramWorkerPool
+import spectrogram_engine as engine
 from annotation_dialog import AnnotationDialog
 
 # pg.setConfigOptions(imageAxisOrder='row-major')
@@ -38,6 +40,15 @@ class SpectrogramViewBox(pg.ViewBox):
 
 class SpectrogramView(pg.PlotWidget):
 
+    # Delay (ms) between the last view range change and the level of detail update
+    DETAIL_UPDATE_DELAY = 100
+    # Number of columns of the waterfall showing the samples appended to a live capture
+    WATERFALL_COLUMNS = 2048
+    # Delay (ms) before the ROI of an annotation left by the mouse cursor is replaced by its rectangle
+    DEMOTE_DELAY = 300
+    # Maximum number of selected annotations of the view range edited with a ROI, the others are drawn by the layer
+    MAX_SELECTED_ROIS = 256
+
     def __init__(self, parent=None):
 
         self.view_box = SpectrogramViewBox()
@@ -46,20 +57,31 @@ class SpectrogramView(pg.PlotWidget):
         self.view_box.merge_selected.triggered.connect(self.merge_selected_annotations)
         self.view_box.remove_selected.triggered.connect(self.remove_selected_annotations)
         self.view_box.group_selected.triggered.connect(self.group_selected_annotations)
-        self.view_box.sigRangeChangedManually.connect(self.sigRegionChanged)
+        self.view_box.sigXRangeChanged.connect(self.sigRegionChanged)
         # self.view_box.sigXRangeChanged.connect(self.test)
 
         super(SpectrogramView, self).__init__(parent=parent, viewBox=self.view_box)
 
-        colormap = pg.ColorMap(pos=np.linspace(0.0, 1.0, 5), color=colors)
+        self.colormap = pg.ColorMap(pos=np.linspace(0.0, 1.0, 5), color=colors)
         # colormap = pg.colormap.get('turbo_r', source='matplotlib', skipCache=True)
         # self.image = pg.ImageItem(lut=colormap.getLookupTable())
         self.image = pg.ImageItem()
         self.image.setOpts(axisOrder='row-major')
-
-        self.colorbar = pg.ColorBarItem(interactive=True, cmap=colormap, label="Power")
-        self.colorbar.setImageItem(self.image, insert_in=self.getPlotItem())
+        # Full resolution spectrogram of the view range drawn over the pyramid image
+        self.detail_image = pg.ImageItem()
+        self.detail_image.setOpts(axisOrder='row-major')
+        # Spectrogram of the samples appended to a live capture (tail mode)
+        self.waterfall_image = pg.ImageItem()
+        self.waterfall_image.setOpts(axisOrder='row-major')
+
+        # Images hold quantized power (uint8 codes over db_range), the colorbar levels only remap their lookup table
+        self.colorbar = pg.ColorBarItem(interactive=True, cmap=self.colormap, label="Power")
+        self.getPlotItem().layout.addItem(self.colorbar, 2, 5)
+        self.getPlotItem().layout.setColumnFixedWidth(4, 5)
+        self.colorbar.sigLevelsChanged.connect(self.update_lut)
         self.colorbar.hide()
+        # Power range (dB) of the quantization codes shared by all the images
+        self.db_range = None
 
         # self.pos_label = self.add
 
@@ -82,6 +104,39 @@ class SpectrogramView(pg.PlotWidget):
         self.edit_mode = False
         self.edit_new_roi = False
 
+        # Annotations are drawn by the annotation layer, hovered and selected annotations are edited with a ROI
+        self.annotation_layer = None
+        # ROI of each edited annotation
+        self.annotation_rois = {}
+        self.demote_timer = QtCore.QTimer(self)
+        self.demote_timer.setSingleShot(True)
+        self.demote_timer.setInterval(self.DEMOTE_DELAY)
+        self.demote_timer.timeout.connect(self.demote_annotations)
+        # Selected annotations entering or leaving the view range are promoted or demoted
+        self.view_box.sigRangeChanged.connect(self.view_range_changed)
+
+        # Spectrogram tile pyramid of the current model and parameters
+        self.pyramid = None
+        self.loaded_tiles = None
+        # Decimation used to display zoomed out levels (SpectrogramTilePyramid.MAX or SpectrogramTilePyramid.MEAN)
+        self.decimation_mode = SpectrogramTilePyramid.MAX
+
+        # Spectrogram computations run in the background
+        self.workers = SpectrogramWorkerPool(self)
+
+        # Ring buffer of waterfall columns (time-major, quantized codes), next column position and number of valid columns
+        self.waterfall = None
+        self.waterfall_position = 0
+        self.waterfall_columns = 0
+        # First sample of the next waterfall column
+        self.tail_sample = None
+
+        # Level of detail is updated once the view range stops changing
+        self.detail_timer = QtCore.QTimer(self)
+        self.detail_timer.setSingleShot(True)
+        self.detail_timer.setInterval(self.DETAIL_UPDATE_DELAY)
+        self.detail_timer.timeout.connect(self.update_detail)
+
         settings = QtCore.QSettings("config.ini", QtCore.QSettings.IniFormat)
 
         settings.beginGroup('spectrogram')
@@ -157,9 +212,7 @@ class SpectrogramView(pg.PlotWidget):
                                               "Invalid group",
                                               f"You must introduce a valid group ({group_value})")
             else:
-                for annotation in self.model.get_selected_annotations():
-                    annotation.group = group_value
-                    annotation.annotation_changed.emit(annotation)
+                self.model.update_annotations(self.model.get_selected_annotations(), group=group_value)
                 self.model.groups.add_group(group_value)
         else:
             pass
@@ -203,26 +256,40 @@ class SpectrogramView(pg.PlotWidget):
         # Update plot limits
         self.getPlotItem().setLimits(xMin=0, xMax=model_time_limit,
                                      yMin=-model_freq_limit, yMax=model_freq_limit)
-        # Read all data
-        self.data = model.read_samples()
-
-        # Clean the plotItem (this includes all images)
+        # Clean the plotItem (this includes all images and ROIs)
         self.getPlotItem().clear()
+        self.annotation_rois = {}
+        self.demote_timer.stop()
         # Add the main image
         self.addItem(self.image, row=0, col=0)
+        self.addItem(self.detail_image)
+        self.detail_image.hide()
+        self.addItem(self.waterfall_image)
+        self.waterfall_image.hide()
+        # Show the whole capture, the tiles are loaded for the view range
+        self.getPlotItem().setRange(xRange=(0, model_time_limit),
+                                    yRange=(-model_freq_limit, model_freq_limit),
+                                    padding=0)
 
         # Update plot with read data from model
         self.update()
 
-        # Add annotations from the model to the plot
-        for annotation in self.model.annotations:
-            self.add_annotation(annotation)
+        # Add annotations from the model to the plot (the layer follows the changes of the annotation store)
+        self.annotation_layer = AnnotationLayer(self.model.annotations, self.model.labels,
+                                                QtCore.QRectF(0, -model_freq_limit,
+                                                              model_time_limit, 2 * model_freq_limit))
+        self.annotation_layer.annotation_hovered.connect(self.promote_annotation)
+        self.addItem(self.annotation_layer)
+        # Selected annotations of the view range are edited
+        self.promote_selected_annotations()
 
         self.annotation_dialog.set_model(model)
 
         # Link model annotations events with view
-        self.model.annotation_added.connect(self.add_annotation)
-        self.model.annotation_removed.connect(self.remove_annotation)
+        self.model.annotations.annotations_selected.connect(self.selection_changed)
+        self.model.annotations_removed.connect(self.remove_annotations)
+        self.model.annotations_changed.connect(self.update_annotations)
+        self.model.samples_appended.connect(self.append_samples)
 
     def set_spectrogram_params(self, nperseg=None, window=None, noverlap=None, nfft=None):
         #TODO: Add parameters checkings
@@ -232,40 +299,262 @@ class SpectrogramView(pg.PlotWidget):
         self.nfft = nfft
 
     def update(self):
-        # Compute spectrogram
-        f, t, sxx = signal.spectrogram(self.data,
-                                       fs=self.model.get_sample_rate(),
-                                       nperseg=self.nperseg,
-                                       # window=self.window,
-                                       noverlap=self.noverlap,
-                                       nfft=self.nfft,
-                                       return_onesided=False)
-
-        # Frequency shift for both sides
-        f = fftpack.fftshift(f)
-        sxx = fftpack.fftshift(sxx, axes=0)
-
-        # Spectrogram log scale
-        sxx_log = 10 * np.log10(sxx)
+        # Results of previous parameters or models are not needed anymore
+        self.workers.cancel()
+
+        # Spectrogram pyramid is computed only once per capture and parameters
+        self.pyramid = SpectrogramTilePyramid(self.model, self.nperseg, None, self.noverlap, self.nfft)
+        # self.pyramid = SpectrogramTilePyramid(self.model, self.nperseg, self.window, self.noverlap, self.nfft)
+
+        self.loaded_tiles = None
+        self.detail_image.hide()
+
+        # Waterfall columns continue the pyramid columns
+        self.waterfall = None
+        self.tail_sample = None
+        self.waterfall_image.hide()
+
+        if self.pyramid.is_built():
+            self.pyramid_built(True)
+            if self.pyramid.is_outdated():
+                # The capture grew, only the columns of the new samples are computed
+                self.workers.start("pyramid", self.pyramid.build,
+                                   on_finished=self.pyramid_built,
+                                   on_failed=self.spectrogram_failed)
+        else:
+            logging.info(f"Building spectrogram pyramid {self.pyramid.path}")
+            # Fast coarse spectrogram shown while the pyramid is built in the background
+            self.workers.start("preview", engine.preview_spectrogram,
+                               self.model,
+                               max(int(self.view_box.width()), 1),
+                               self.pyramid.nperseg,
+                               self.pyramid.window,
+                               self.pyramid.nfft,
+                               quantized=True,
+                               on_finished=self.set_preview,
+                               priority=1)
+            self.workers.start("pyramid", self.pyramid.build,
+                               on_finished=self.pyramid_built,
+                               on_failed=self.spectrogram_failed)
+
+    def set_levels(self, power_min, power_max):
+        """
+        Sets the power range of the quantized images and resets the colorbar levels to it
+        """
+        # Spectrogram without any power above the floor (only gaps)
+        if power_min > power_max:
+            power_min = power_max = engine.POWER_FLOOR_DB
+
+        self.db_range = (power_min, power_max)
+
+        self.colorbar.lo_lim = power_min
+        self.colorbar.hi_lim = power_max
+
+        self.colorbar.setLevels(low=power_min, high=power_max)
+        self.update_lut()
+
+        self.colorbar.show()
+
+    @QtCore.Slot()
+    def update_lut(self, *args):
+        """
+        Maps the quantization codes to the colorbar levels and colour map, images are not touched
+        """
+        if self.db_range is None:
+            return
+
+        low, high = self.colorbar.levels()
+        power = np.linspace(self.db_range[0], self.db_range[1], engine.QUANTIZED_MAX + 1)
+        lut = self.colormap.map(np.clip((power - low) / max(high - low, np.finfo(float).eps), 0.0, 1.0),
+                                mode='byte')
+
+        for image in (self.image, self.detail_image, self.waterfall_image):
+            image.setLookupTable(lut)
+            image.setLevels((0, engine.QUANTIZED_MAX))
+
+    @QtCore.Slot(object)
+    def set_preview(self, result):
+        """
+        Shows the coarse spectrogram of the whole capture
+        :param result: Tuple (quantized power with shape (nfft, columns), minimum, maximum)
+        """
+        if result is None or self.pyramid.is_built():
+            return
+
+        sxx_log, power_min, power_max = result
 
         x = 0 * self.model.get_sample_rate()
-        w = self.data.shape[0] / self.model.get_sample_rate()
+        w = self.model.get_sample_count() / self.model.get_sample_rate()
 
         y = 0 - self.model.get_sample_rate()/2
         h = self.model.get_sample_rate()
 
-        self.image.setImage(sxx_log, rect=[x, y, w, h])
+        self.set_levels(power_min, power_max)
+        self.image.setImage(sxx_log, autoLevels=False, rect=[x, y, w, h])
 
-        self.colorbar.lo_lim = np.min(sxx_log)
-        self.colorbar.hi_lim = np.max(sxx_log)
+    @QtCore.Slot(object)
+    def pyramid_built(self, built):
+        if not built:
+            return
 
-        self.colorbar.setLevels(low=np.min(sxx_log), high=np.max(sxx_log))
+        # Colorbar levels are kept when an extended pyramid has the same range
+        if self.db_range != tuple(self.pyramid.levels_range):
+            self.set_levels(*self.pyramid.levels_range)
 
-        self.colorbar.show()
+        # Force reloading tiles
+        self.loaded_tiles = None
+        self.update_tiles()
+        self.update_detail()
 
+    @QtCore.Slot(str)
+    def spectrogram_failed(self, error):
+        QtWidgets.QMessageBox.critical(self, "Spectrogram error", error)
+
+    @QtCore.Slot()
+    def update_tiles(self):
+        """
+        Loads the spectrogram pyramid tiles for the current view range and zoom level
+        """
+        if self.pyramid is None or not self.pyramid.is_built():
+            return
+
+        x_view_range = self.view_box.viewRange()[0]
+        sample_rate = self.model.get_sample_rate()
+
+        view_start = max(self.model.time_to_sample(x_view_range[0]), 0)
+        view_end = min(self.model.time_to_sample(x_view_range[1]), self.model.get_sample_count())
+
+        # Aim for a column per screen pixel
+        level = self.pyramid.select_level(view_end - view_start, max(int(self.view_box.width()), 1))
+        column_samples = self.pyramid.get_column_samples(level)
+
+        first_tile, last_tile = self.pyramid.tile_range(view_start / column_samples, view_end / column_samples)
+
+        if self.loaded_tiles == (level, first_tile, last_tile):
+            return
+        self.loaded_tiles = (level, first_tile, last_tile)
+
+        first_column, sxx_log = self.pyramid.read(level, first_tile, last_tile, self.decimation_mode, self.db_range)
+
+        x = first_column * column_samples / sample_rate
+        w = sxx_log.shape[1] * column_samples / sample_rate
+
+        y = 0 - sample_rate/2
+        h = sample_rate
+
+        self.image.setImage(sxx_log, autoLevels=False, rect=[x, y, w, h])
+
+    @QtCore.Slot(int, int)
+    def append_samples(self, previous_count: int, sample_count: int):
+        """
+        Appends the spectrogram columns of the new samples of a live capture to the waterfall
+        Only the new samples are read and transformed (in the background, see set_waterfall), the waterfall is a fixed
+        size ring buffer. The pyramid is extended once the waterfall does not show all the columns it lacks.
+        :param previous_count: Sample count before the new samples
+        :param sample_count: New sample count
+        """
+        if self.pyramid is None:
+            return
+
+        nperseg, noverlap, step = self.pyramid.nperseg, self.pyramid.noverlap, self.pyramid.step
+
+        if self.tail_sample is None:
+            self.tail_sample = engine.segment_count(previous_count, nperseg, noverlap) * step
+            self.waterfall = np.empty((self.WATERFALL_COLUMNS, self.pyramid.nfft), dtype=np.uint8)
+            self.waterfall_position = 0
+            self.waterfall_columns = 0
+
+        # Extend the plot and keep following the head of the capture if it was visible
+        previous_time_limit = self.model.sample_to_time(previous_count)
+        time_limit = self.model.sample_to_time(sample_count)
+        self.getPlotItem().setLimits(xMax=time_limit)
+        if self.annotation_layer is not None:
+            bounds = self.annotation_layer.boundingRect()
+            self.annotation_layer.set_bounds(QtCore.QRectF(bounds.left(), bounds.top(), time_limit, bounds.height()))
+
+        view_start, view_end = self.view_box.viewRange()[0]
+        if view_end >= previous_time_limit:
+            self.getPlotItem().setXRange(view_start + time_limit - previous_time_limit, time_limit, padding=0)
+
+        if self.pyramid.is_built() and not self.workers.is_running("pyramid") and \
+                self.pyramid.get_missing_columns() > self.WATERFALL_COLUMNS // 2:
+            self.workers.start("pyramid", self.pyramid.build,
+                               on_finished=self.pyramid_built,
+                               on_failed=self.spectrogram_failed)
+
+        # Quantized with the range of the pyramid (or preview) so the colorbar applies to the waterfall too. New
+        # samples are read by the next poll while a waterfall task is running.
+        if self.db_range is None or self.workers.is_running("waterfall"):
+            return
+
+        segments = engine.segment_count(sample_count - self.tail_sample, nperseg, noverlap)
+        if segments == 0:
+            return
+
+        # Columns that would not fit in the waterfall are not computed
+        skipped = max(segments - self.WATERFALL_COLUMNS, 0)
+        self.tail_sample += skipped * step
+        segments -= skipped
+
+        first_sample = self.tail_sample
+        self.workers.start("waterfall", engine.read_spectrogram,
+                           self.model,
+                           first_sample,
+                           segments * step + noverlap,
+                           nperseg,
+                           self.pyramid.window,
+                           noverlap,
+                           self.pyramid.nfft,
+                           self.db_range,
+                           on_finished=lambda result: self.set_waterfall(result, first_sample),
+                           priority=2)
+        self.tail_sample += segments * step
+
+    def set_waterfall(self, result, start):
+        """
+        Writes the new columns of a live capture into the waterfall ring buffer and shows it
+        :param result: Tuple (quantized power with shape (nfft, columns), minimum, maximum)
+        :param start: Sample index of the first column
+        """
+        if result is None or self.waterfall is None:
+            return
+
+        codes, _, _ = result
+        segments = codes.shape[1]
+        step = self.pyramid.step
+        sample_rate = self.model.get_sample_rate()
+
+        positions = (self.waterfall_position + np.arange(segments)) % self.WATERFALL_COLUMNS
+        self.waterfall[positions] = codes.T
+        self.waterfall_position = (self.waterfall_position + segments) % self.WATERFALL_COLUMNS
+        self.waterfall_columns = min(self.waterfall_columns + segments, self.WATERFALL_COLUMNS)
+
+        # Oldest column first
+        if self.waterfall_columns < self.WATERFALL_COLUMNS:
+            columns = self.waterfall[:self.waterfall_columns]
+        else:
+            columns = np.concatenate((self.waterfall[self.waterfall_position:],
+                                      self.waterfall[:self.waterfall_position]))
+
+        x = (start + (segments - self.waterfall_columns) * step) / sample_rate
+        w = self.waterfall_columns * step / sample_rate
+
+        y = 0 - sample_rate/2
+        h = sample_rate
+
+        self.waterfall_image.setImage(columns.T, autoLevels=False, rect=[x, y, w, h])
+        self.waterfall_image.show()
+
+    @QtCore.Slot(int)
+    def promote_annotation(self, row: int):
+        """
+        Replaces the rectangle of an annotation by an interactive ROI
+        :param row: Row of the annotation in the model annotation store
+        """
+        annotation = self.model.annotations.proxy(row)
+        if annotation in self.annotation_rois or annotation.low is None or annotation.high is None:
+            return
 
-    @QtCore.Slot(object)
-    def add_annotation(self, annotation: Annotation):
         # View box limits defines the max/min x,y values of the whole plot (ref set_model)
         vb_limits = self.getPlotItem().getViewBox().getState()['limits']
 
@@ -281,10 +570,74 @@ class SpectrogramView(pg.PlotWidget):
         annotation_roi.sigRemoveRequested.connect(self.remove_roi)
         annotation_roi.export_roi_signal.connect(self.export_annotation)
         annotation_roi.open_roi_signal.connect(self.open_roi)
+        annotation_roi.leave_roi_signal.connect(self.roi_left)
         annotation_roi.setPen(self.model.labels.get_label_colour(annotation.label))
+        if annotation.selected:
+            annotation_roi.select_roi(annotation)
 
+        self.annotation_rois[annotation] = annotation_roi
+        self.annotation_layer.set_hidden_rows(a.row for a in self.annotation_rois)
         self.addItem(annotation_roi)
 
+        # The previously hovered annotations are drawn again
+        self.demote_timer.start()
+
+    @QtCore.Slot(object)
+    def roi_left(self, roi):
+        self.demote_timer.start()
+
+    def get_selected_view_rows(self) -> np.ndarray:
+        """
+        Returns the rows of the selected annotations intersecting the view range, at most MAX_SELECTED_ROIS
+        """
+        view = self.view_box.viewRect()
+        annotations = self.model.annotations
+        rows = annotations.index.query(view.left(), view.right(), view.top(), view.bottom())
+        rows = rows[annotations.columns["selected"][rows]]
+        return rows[:self.MAX_SELECTED_ROIS]
+
+    def promote_selected_annotations(self):
+        """
+        Edits the selected annotations of the view range with a ROI
+        """
+        for row in self.get_selected_view_rows().tolist():
+            self.promote_annotation(row)
+
+    @QtCore.Slot()
+    def view_range_changed(self, *args):
+        if self.annotation_layer is not None:
+            self.demote_timer.start()
+
+    @QtCore.Slot()
+    def demote_annotations(self):
+        """
+        Replaces the ROIs that are not hovered, moved or selected in the view range by rectangles, and edits the
+        selected annotations that entered the view range
+        """
+        selected_rows = set(self.get_selected_view_rows().tolist())
+        for annotation, annotation_roi in list(self.annotation_rois.items()):
+            if not (annotation.row in selected_rows or annotation_roi.isMoving or annotation_roi.is_hovered()):
+                self.remove_roi_item(annotation)
+
+        self.annotation_layer.set_hidden_rows(a.row for a in self.annotation_rois)
+
+        for row in selected_rows - {a.row for a in self.annotation_rois}:
+            self.promote_annotation(row)
+
+    def remove_roi_item(self, annotation: Annotation):
+        annotation_roi = self.annotation_rois.pop(annotation, None)
+        if annotation_roi is not None:
+            annotation.annotation_selected.disconnect(annotation_roi.select_roi)
+            annotation.annotation_changed.disconnect(annotation_roi.annotation_changed)
+            self.removeItem(annotation_roi)
+
+    @QtCore.Slot(object)
+    def selection_changed(self, rows):
+        # A single annotation selected with the mouse is edited at once, the others once the timer expires
+        if len(rows) == 1 and self.model.annotations.columns["selected"][rows[0]]:
+            self.promote_annotation(int(rows[0]))
+        self.demote_timer.start()
+
     @QtCore.Slot(object)
     def remove_roi(self, roi):
         logging.debug(f"Remove ROI at {roi.pos()}")
@@ -296,13 +649,20 @@ class SpectrogramView(pg.PlotWidget):
         self.annotation_dialog.set_annotation(annotation)
         self.annotation_dialog.exec()
 
-    @QtCore.Slot(object)
-    def remove_annotation(self, annotation: Annotation):
-        logging.debug(f"Remove annotation at {annotation.start}")
-        for item in self.getPlotItem().items:
-            if isinstance(item, AnnotationROI) and item.annotation == annotation:
-                self.removeItem(item)
-                break
+    @QtCore.Slot(list)
+    def remove_annotations(self, annotations: list):
+        logging.debug(f"Remove {len(annotations)} annotations")
+        for annotation in annotations:
+            self.remove_roi_item(annotation)
+        self.annotation_layer.set_hidden_rows(a.row for a in self.annotation_rois)
+
+    @QtCore.Slot(list)
+    def update_annotations(self, annotations: list):
+        for annotation in annotations:
+            annotation_roi = self.annotation_rois.get(annotation)
+            if annotation_roi is not None:
+                annotation_roi.annotation_changed(annotation)
+                annotation_roi.setPen(self.model.labels.get_label_colour(annotation.label))
 
     def mousePressEvent(self, ev):
         """ Capture mouse press event to start drawing ROI
@@ -382,15 +742,82 @@ class SpectrogramView(pg.PlotWidget):
             super().mouseMoveEvent(ev)
 
     @QtCore.Slot()
-    def sigRegionChanged(self, ev):
-        print(ev)
-        if ev[0]:
-            x_view_range = self.view_box.viewRange()[0]
-            print("X axis range", x_view_range)
-            # self.data = self.model.read_time(x_view_range[0], x_view_range[1] - x_view_range[0])
-            # print(self.data.shape, self.data.nbytes/1024**2)
-        else:
-            print("X axis did not change")
+    def sigRegionChanged(self, *args):
+        """
+        View range changed, load the pyramid tiles and schedule the level of detail update
+        """
+        self.update_tiles()
+        self.detail_timer.start()
+
+    @QtCore.Slot()
+    def update_detail(self):
+        """
+        Computes the spectrogram of the visible time span with a column per screen pixel when the pyramid full
+        resolution level does not have enough columns (zoomed in view)
+        """
+        if self.pyramid is None or not self.pyramid.is_built():
+            return
+
+        x_view_range = self.view_box.viewRange()[0]
+        sample_count = self.model.get_sample_count()
+        pixels = max(int(self.view_box.width()), 1)
+
+        view_start = max(self.model.time_to_sample(x_view_range[0]), 0)
+        view_end = min(self.model.time_to_sample(x_view_range[1]), sample_count)
+
+        if (view_end - view_start) / self.pyramid.step >= pixels:
+            # Pyramid tiles have enough resolution
+            self.workers.cancel("detail")
+            self.detail_image.hide()
+            return
+
+        # Segment step (hop) giving a column per pixel, segment length is kept
+        nperseg = self.pyramid.nperseg
+        hop = max((view_end - view_start) // pixels, 1)
+
+        # Read just the visible samples (plus a segment to fill the borders)
+        read_start = max(view_start - nperseg // 2, 0)
+        read_end = min(view_end + nperseg // 2, sample_count)
+
+        if read_end - read_start < nperseg:
+            self.detail_image.hide()
+            return
+
+        # Computed in the background, a newer view range cancels it
+        self.workers.start("detail", engine.read_spectrogram,
+                           self.model,
+                           read_start,
+                           read_end - read_start,
+                           nperseg,
+                           self.pyramid.window,
+                           nperseg - hop,
+                           self.pyramid.nfft,
+                           self.db_range,
+                           on_finished=lambda result: self.set_detail(result, read_start, hop),
+                           priority=2)
+
+    def set_detail(self, result, start, hop):
+        """
+        Shows the full resolution spectrogram of the view range
+        :param result: Tuple (quantized power with shape (nfft, columns), minimum, maximum)
+        :param start: Sample index of the first column
+        :param hop: Number of samples between columns
+        """
+        if result is None:
+            return
+
+        sxx_log, power_min, power_max = result
+
+        sample_rate = self.model.get_sample_rate()
+
+        x = start / sample_rate
+        w = sxx_log.shape[1] * hop / sample_rate
+
+        y = 0 - sample_rate/2
+        h = sample_rate
+
+        self.detail_image.setImage(sxx_log, autoLevels=False, rect=[x, y, w, h])
+        self.detail_image.show()
 
     @QtCore.Slot()
     def test(self):
@@ -0,0 +1,136 @@
+import logging
+import threading
+
+from PySide6 import QtCore
+
+
+class SpectrogramTaskSignals(QtCore.QObject):
+
+    # Task generation and result
+    finished = QtCore.Signal(int, object)
+    # Task generation and error message
+    failed = QtCore.Signal(int, str)
+    # Task generation, emitted when the task ends (even if cancelled)
+    done = QtCore.Signal(int)
+
+
+class SpectrogramTask(QtCore.QRunnable):
+    """
+    Runs a spectrogram computation in a thread pool.
+
+    The computation function receives a `cancelled` callable as keyword argument that it must check between blocks of
+    work, it returns as soon as possible once the task has been cancelled. Results are delivered through the signals
+    (in the receiver thread), tagged with the generation of the request so that stale results can be discarded.
+    """
+
+    def __init__(self, generation: int, function, *args, **kwargs):
+        super(SpectrogramTask, self).__init__()
+
+        self.generation = generation
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+        self.signals = SpectrogramTaskSignals()
+        self._cancelled = threading.Event()
+
+        # The pool keeps the task alive until it is done
+        self.setAutoDelete(False)
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self):
+        return self._cancelled.is_set()
+
+    def run(self):
+        try:
+            if not self.is_cancelled():
+                result = self.function(*self.args, cancelled=self.is_cancelled, **self.kwargs)
+                if not self.is_cancelled():
+                    self.signals.finished.emit(self.generation, result)
+        except Exception as error:
+            logging.error(f"Spectrogram computation error {error}")
+            self.signals.failed.emit(self.generation, str(error))
+        finally:
+            self.signals.done.emit(self.generation)
+
+
+class SpectrogramWorkerPool(QtCore.QObject):
+    """
+    Thread pool running the spectrogram computations of a view.
+
+    Starting a task of a given kind (e.g. "pyramid", "detail") cancels the tasks of the same kind still in flight.
+    """
+
+    def __init__(self, parent=None):
+        super(SpectrogramWorkerPool, self).__init__(parent)
+
+        self.thread_pool = QtCore.QThreadPool(self)
+        # Generation of the last request
+        self.generation = 0
+        # Tasks in flight by kind
+        self.tasks = {}
+        # Kind, task and callbacks by task generation
+        self.callbacks = {}
+
+    def start(self, kind: str, function, *args, on_finished=None, on_failed=None, priority=0, **kwargs):
+        """
+        Starts a new task cancelling the previous tasks of the same kind
+        :param kind: Task kind
+        :param function: Computation function
+        :param on_finished: Slot receiving the result
+        :param on_failed: Slot receiving the error message
+        :param priority: Thread pool priority (higher runs first)
+        :return: Task
+        """
+        self.cancel(kind)
+
+        self.generation += 1
+        task = SpectrogramTask(self.generation, function, *args, **kwargs)
+
+        self.tasks.setdefault(kind, []).append(task)
+        self.callbacks[task.generation] = (kind, task, on_finished, on_failed)
+
+        # Slots of this object run in its (GUI) thread
+        task.signals.finished.connect(self._task_finished)
+        task.signals.failed.connect(self._task_failed)
+        task.signals.done.connect(self._task_done)
+
+        self.thread_pool.start(task, priority)
+        return task
+
+    def is_running(self, kind: str) -> bool:
+        """
+        Checks whether tasks of a kind are in flight (including cancelled tasks not done yet)
+        """
+        return bool(self.tasks.get(kind))
+
+    def cancel(self, kind: str = None):
+        """
+        Cancels tasks in flight
+        :param kind: Task kind, None for all tasks
+        """
+        kinds = list(self.tasks.keys()) if kind is None else [kind]
+        for task_kind in kinds:
+            # Cancelled tasks are kept until they are done
+            for task in self.tasks.get(task_kind, []):
+                task.cancel()
+
+    @QtCore.Slot(int, object)
+    def _task_finished(self, generation, result):
+        kind, task, on_finished, on_failed = self.callbacks[generation]
+        # Discard results of cancelled (stale) tasks
+        if on_finished and not task.is_cancelled():
+            on_finished(result)
+
+    @QtCore.Slot(int, str)
+    def _task_failed(self, generation, error):
+        kind, task, on_finished, on_failed = self.callbacks[generation]
+        if on_failed and not task.is_cancelled():
+            on_failed(error)
+
+    @QtCore.Slot(int)
+    def _task_done(self, generation):
+        kind, task, on_finished, on_failed = self.callbacks.pop(generation)
+        self.tasks[kind].remove(task)
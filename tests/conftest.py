@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Modules of the application are imported from src (as main.py does)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent.joinpath("src")))
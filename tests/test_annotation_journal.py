@@ -0,0 +1,38 @@
+from annotation_journal import AnnotationJournal
+
+
+def test_append_after_crash_mid_line(tmp_path):
+    path = tmp_path.joinpath("capture.annotations.journal")
+    journal = AnnotationJournal(path)
+    journal.append([{"op": AnnotationJournal.ADD, "id": 1}, {"op": AnnotationJournal.ADD, "id": 2}])
+
+    # Crash while appending the third record
+    with open(path, 'a') as journal_file:
+        journal_file.write('{"op": "modify", "id"')
+
+    journal = AnnotationJournal(path)
+    assert [record["id"] for record in journal.read()] == [1, 2]
+
+    journal.append([{"op": AnnotationJournal.DELETE, "id": 1}, {"op": AnnotationJournal.ADD, "id": 3}])
+
+    records = AnnotationJournal(path).read()
+    assert [(record["op"], record["id"]) for record in records] == [
+        (AnnotationJournal.ADD, 1), (AnnotationJournal.ADD, 2), (AnnotationJournal.DELETE, 1),
+        (AnnotationJournal.ADD, 3)]
+
+
+def test_read_skips_corrupt_line(tmp_path):
+    path = tmp_path.joinpath("capture.annotations.journal")
+    path.write_text('{"op": "add", "id": 1}\n{"op": "add", "id\n{"op": "add", "id": 2}\n')
+
+    assert [record["id"] for record in AnnotationJournal(path).read()] == [1, 2]
+
+
+def test_crash_before_first_line(tmp_path):
+    path = tmp_path.joinpath("capture.annotations.journal")
+    path.write_text('{"op": "ad')
+
+    journal = AnnotationJournal(path)
+    journal.append([{"op": AnnotationJournal.ADD, "id": 1}])
+
+    assert journal.read() == [{"op": AnnotationJournal.ADD, "id": 1}]
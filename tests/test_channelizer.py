@@ -0,0 +1,18 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+from s3re.channelizer import Channelizer
+
+
+def test_band_on_channel_edges_is_flat():
+    # Tones at the first and last bin of the band [-.25, 0) (channels 16 to 31)
+    n = np.arange(64 * 16)
+    for f in (-.25, -1 / (64 * 16)):
+        tone = np.exp(2j * np.pi * f * n)
+        channelizer = Channelizer(tone, channels_no=64)
+        y, rate = channelizer.extract(-.25, 0)
+
+        # Band channels plus one padding channel on each side
+        assert rate == pytest.approx(18 / 64)
+        # Amplitude scaled by the inverse of the rate, not attenuated
+        assert np.abs(y).mean() == pytest.approx(1 / rate, rel=1e-6)
@@ -0,0 +1,98 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pyqtgraph")
+engine = pytest.importorskip("spectrogram_engine")
+
+
+def gap_filled_chunk():
+    """
+    Noise with a span filled with zeros and a span filled with NaN (capture gaps)
+    """
+    rng = np.random.default_rng(0)
+    samples = (rng.standard_normal(8192) + 1j * rng.standard_normal(8192)).astype(np.complex64)
+    samples[2048:4096] = 0
+    samples[6144:] = np.nan
+    return samples
+
+
+def test_power_to_db_ignores_gaps():
+    sxx = engine.spectrogram(gap_filled_chunk(), 1.0, 256, noverlap=0)
+    sxx_log, power_min, power_max = engine.power_to_db(sxx)
+
+    assert np.isfinite(power_min) and np.isfinite(power_max)
+    assert engine.POWER_FLOOR_DB < power_min < power_max
+    # Zero power is floored, NaN is kept
+    assert not np.isneginf(sxx_log).any()
+    assert np.isnan(sxx_log).any()
+
+
+def test_quantize_gap_filled_chunk():
+    sxx = engine.spectrogram(gap_filled_chunk(), 1.0, 256, noverlap=0)
+    sxx_log, power_min, power_max = engine.power_to_db(sxx)
+    codes = engine.quantize_db(sxx_log, power_min, power_max)
+
+    assert codes.dtype == np.uint8
+    assert codes.shape == sxx_log.shape
+    # Noise segments use the whole code range, gaps are code 0
+    assert codes.max() == engine.QUANTIZED_MAX
+    assert (codes[:, 8:16] == 0).all()
+    assert (codes[:, 24:] == 0).all()
+
+
+def test_quantize_only_gaps():
+    sxx = engine.spectrogram(np.zeros(4096, dtype=np.complex64), 1.0, 256, noverlap=0)
+    sxx_log, power_min, power_max = engine.power_to_db(sxx)
+
+    assert power_min > power_max
+    assert (engine.quantize_db(sxx_log, power_min, power_max) == 0).all()
+
+
+def test_get_window_array():
+    window = np.hanning(256)
+    result = engine.get_window(window, 256)
+
+    assert result.dtype == np.float32
+    np.testing.assert_allclose(result, window, rtol=1e-6)
+    assert engine.get_window(None, 256) is engine.get_window(engine.DEFAULT_WINDOW, 256)
+
+
+class ArrayModel:
+    """
+    Minimal data model over an array of samples
+    """
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.reads = []
+
+    def get_sample_count(self):
+        return len(self.samples)
+
+    def get_sample_rate(self):
+        return 1.0
+
+    def read_samples(self, start=0, count=None):
+        assert start >= 0
+        self.reads.append((start, count))
+        return self.samples[start:start + count]
+
+
+def test_preview_shorter_than_a_segment():
+    assert engine.preview_spectrogram(ArrayModel(np.ones(100, dtype=np.complex64)), 64, 256) is None
+
+
+def test_preview_batches_close_segments():
+    rng = np.random.default_rng(0)
+    samples = (rng.standard_normal(2**16) + 1j * rng.standard_normal(2**16)).astype(np.complex64)
+    model = ArrayModel(samples)
+
+    sxx_log, power_min, power_max = engine.preview_spectrogram(model, 128, 256)
+
+    assert sxx_log.shape == (256, 128)
+    # Segments 514 samples apart are read at once (further reads are only predicted by ReadAhead)
+    stride = (len(samples) - 256) // 127
+    assert model.reads[0] == (0, 127 * stride + 256)
+    expected = engine.spectrogram(np.concatenate([samples[i * stride:i * stride + 256] for i in range(128)]),
+                                  1.0, 256, noverlap=0)
+    np.testing.assert_allclose(sxx_log, engine.power_to_db(expected)[0], rtol=1e-5)